@@ -0,0 +1,8 @@
+#! /usr/bin/env python3
+
+from internal.admin import run_admin_action
+from internal.config import parse_admin_args
+
+
+if __name__ == "__main__":
+    run_admin_action(parse_admin_args())
@@ -0,0 +1,8 @@
+#! /usr/bin/env python3
+
+from internal.benchmark import run_benchmarks
+from internal.config import parse_benchmark_args
+
+
+if __name__ == "__main__":
+    run_benchmarks(parse_benchmark_args())
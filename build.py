@@ -1,8 +1,14 @@
 #! /usr/bin/env python3
 
-from internal.config import parse_args
+import sys
+
+from internal.config import parse_args, parse_transfer_args
 from internal.docker import build_image
+from internal.transfer import transfer_images
 
 
 if __name__ == "__main__":
-    build_image(parse_args())
+    if sys.argv[1:2] in [["export"], ["import"]]:
+        transfer_images(parse_transfer_args())
+    else:
+        build_image(parse_args(build=True))
@@ -0,0 +1,256 @@
+"""Batch operations on every user's containers, for administrators of shared
+machines."""
+
+import concurrent.futures
+import dataclasses
+import functools
+import os
+import re
+import subprocess
+import sys
+import time
+from typing import Callable
+
+import internal.docker_api
+import internal.images
+import internal.log_archive
+from internal import logger
+from internal.config import AdminConfig, Config, available_tags
+from internal.docker import get_launch_labels_env
+from internal.env import _get_container_host
+from internal.log_utils import print_table
+
+COMPOSE_PROJECT_LABEL = "com.docker.compose.project"
+
+# e.g. "alice-noetic-see-spot-run"
+_PROJECT_PATTERN = re.compile(r"^(?P<user>.+)-noetic-(?P<tag>[\w.-]+)$")
+
+
+@dataclasses.dataclass
+class UserContainer:
+    name: str
+    project: str
+    user: str
+    tag: str
+    running: bool
+    uid: str
+    runtime: str
+    display: str
+
+    def get_env(self) -> "dict[str, str]":
+        """Return the environment the container was launched with, like
+        internal.env.get_env does for the calling user."""
+        env = {
+            "CONTAINER_HOST": _get_container_host(),
+            "CONTAINER_RUNTIME": self.runtime,
+            "CONTAINER_UID": self.uid,
+            "CONTAINER_USER": self.user,
+            "DISPLAY": self.display,
+            "DOCKER_SCAN_SUGGEST": "false",
+            "IMAGE_TAG": self.tag,
+        }
+        return {**env, **get_launch_labels_env(env)}
+
+
+@dataclasses.dataclass
+class ActionResult:
+    container: UserContainer
+    error: str = ""
+    seconds: float = 0.0
+
+
+def find_user_containers(
+    users: "list[str]", tags: "list[str]"
+) -> "list[UserContainer]":
+    """Return every user's noetic containers, optionally only those of users
+    and for tags."""
+    names = internal.docker_api.list_containers(COMPOSE_PROJECT_LABEL)
+    if not names:
+        return []
+
+    containers = []
+    for obj in internal.docker_api.inspect(names, object_type="container"):
+        config = obj.get("Config") or {}
+        project = (config.get("Labels") or {}).get(COMPOSE_PROJECT_LABEL, "")
+        match = _PROJECT_PATTERN.match(project)
+        if match is None:
+            continue
+        if users and match["user"] not in users:
+            continue
+        if tags and match["tag"] not in tags:
+            continue
+
+        env = dict(entry.partition("=")[::2] for entry in config.get("Env") or [])
+        containers.append(
+            UserContainer(
+                name=obj["Name"].lstrip("/"),
+                project=project,
+                user=match["user"],
+                tag=match["tag"],
+                running=obj["State"].get("Running", False),
+                # The user is set as "uid:gid" in compose.shared.yaml.
+                uid=(config.get("User") or "").partition(":")[0],
+                runtime=(obj.get("HostConfig") or {}).get("Runtime", ""),
+                display=env.get("DISPLAY", ""),
+            )
+        )
+
+    return sorted(containers, key=lambda container: container.name)
+
+
+def _start(container: UserContainer) -> None:
+    internal.docker_api.start(container.name)
+    container.running = True
+
+
+def _stop(container: UserContainer) -> None:
+    internal.docker_api.stop(container.name, timeout=0)
+    container.running = False
+
+
+def _restart(container: UserContainer) -> None:
+    _stop(container)
+    _start(container)
+
+
+def _run_on_each(
+    container_action: "Callable[[UserContainer], None]",
+    containers: "list[UserContainer]",
+) -> None:
+    for container in containers:
+        container_action(container)
+
+
+def _rebuild(containers: "list[UserContainer]") -> None:
+    """Rebuild one user's images for containers, then recreate them from the
+    new images."""
+    for container in containers:
+        if container.tag not in available_tags():
+            raise RuntimeError(f"no Dockerfile for tag {container.tag}")
+
+    tags = sorted({container.tag for container in containers})
+    if not internal.images.build_images(
+        Config(tag=tags[0], tags=tags, _require_x_display=False),
+        tags,
+        env=containers[0].get_env(),
+        quiet=True,
+    ):
+        raise RuntimeError("image build failed")
+
+    for container in containers:
+        # Keep stopped containers stopped.
+        up_args = ["--detach"] if container.running else ["--no-start"]
+        result = subprocess.run(
+            [
+                "docker",
+                "compose",
+                "--project-directory",
+                str(internal.images.NOETIC_DIR / container.tag),
+                "--project-name",
+                container.project,
+                "up",
+                "-t",
+                "0",
+                *up_args,
+            ],
+            env={**os.environ, **container.get_env()},
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            lines = result.stderr.strip().splitlines() or ["docker compose up failed"]
+            raise RuntimeError(lines[-1])
+
+
+def _run_in_parallel(
+    groups: "list[list[UserContainer]]",
+    action: "Callable[[list[UserContainer]], None]",
+    jobs: int,
+) -> "list[ActionResult]":
+    """Run action on each group of containers, up to jobs groups at a time."""
+
+    def run(group: "list[UserContainer]") -> "list[ActionResult]":
+        t_start = time.time()
+        error = ""
+        try:
+            action(group)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            logger.error(f"{', '.join(c.name for c in group)}: {error}")
+        seconds = time.time() - t_start
+        return [ActionResult(container, error, seconds) for container in group]
+
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        for group_results in executor.map(run, groups):
+            results += group_results
+    return results
+
+
+def _print_status_table(results: "list[ActionResult]", show_results: bool) -> None:
+    header = ["CONTAINER", "USER", "TAG", "STATE"]
+    if show_results:
+        header += ["RESULT", "TIME"]
+
+    rows = [header]
+    for result in results:
+        container = result.container
+        row = [
+            container.name,
+            container.user,
+            container.tag,
+            "running" if container.running else "stopped",
+        ]
+        if show_results:
+            row += [
+                f"failed: {result.error}" if result.error else "ok",
+                f"{result.seconds:.1f} s",
+            ]
+        rows.append(row)
+
+    print_table(rows)
+
+
+def run_admin_action(config: AdminConfig) -> None:
+    containers = find_user_containers(config.users, config.tags)
+    if not containers:
+        logger.warning("No noetic containers found")
+        return
+
+    if config.action == "status":
+        _print_status_table([ActionResult(c) for c in containers], show_results=False)
+        return
+
+    internal.log_archive.add_tags(sorted({container.tag for container in containers}))
+    t_start = time.time()
+    if config.action == "rebuild":
+        internal.log_archive.enable()
+        # A user's images build on each other, so each user's containers are
+        # rebuilt together.
+        by_user: "dict[str, list[UserContainer]]" = {}
+        for container in containers:
+            by_user.setdefault(container.user, []).append(container)
+        groups = list(by_user.values())
+        action = _rebuild
+    else:
+        container_action = {"start": _start, "stop": _stop, "restart": _restart}[
+            config.action
+        ]
+        groups = [[container] for container in containers]
+        action = functools.partial(_run_on_each, container_action)
+
+    logger.info(f"Running {config.action} on {len(containers)} containers")
+    results = _run_in_parallel(groups, action, config.jobs)
+    _print_status_table(results, show_results=True)
+
+    failures = [result for result in results if result.error]
+    if failures:
+        logger.error(
+            f"{config.action} failed for {len(failures)} of {len(results)} "
+            "containers"
+        )
+        sys.exit(1)
+    logger.success(
+        f"Finished {config.action} on {len(results)} containers in "
+        f"{time.time() - t_start:.1f} s"
+    )
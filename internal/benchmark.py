@@ -0,0 +1,300 @@
+"""Times the build and launch paths against stand-ins for docker, git, ssh,
+glxinfo, make, and catkin_make, so that they can be measured on any Linux
+machine without a Docker daemon or a network connection.
+
+Each run of a phase is a new Python process with an empty home directory and
+the stand-ins first on PATH. It reports how long the phase took and the peak
+memory of the process, which are compared to a baseline saved by an earlier
+run with the same settings.
+"""
+
+import importlib
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import internal.docker
+import internal.env
+import internal.git
+import internal.ros
+from internal import logger
+from internal.cache import cache_dir, load_json, save_json
+from internal.config import BENCHMARK_PHASES, BenchmarkConfig, Config, parse_args
+from internal.log_utils import print_table
+
+BASELINE_FILE = "benchmark_baseline.json"
+
+# The tag whose compose files and packages the phases use
+BENCHMARK_TAG = "see-spot-run"
+
+# The only X display that the stand-in glxinfo can open
+BENCHMARK_DISPLAY = ":3"
+
+# parse_args is too fast to time one call.
+_PARSE_ARGS_ITERATIONS = 100
+
+# Differences smaller than these are noise, however large they are relative to
+# the baseline.
+_MIN_REGRESSION_SECONDS = 0.05
+_MIN_REGRESSION_KB = 4 * 1024
+
+_STAND_IN_PRELUDE = """#! /bin/sh
+[ "$BENCHMARK_LATENCY" = 0 ] || sleep "$BENCHMARK_LATENCY"
+"""
+
+# The parts of each command's behavior that the phases depend on
+_STAND_INS = {
+    "docker": """
+case "$1" in
+    info) echo '{"Runtimes": {"runc": {}}, "DefaultRuntime": "runc"}' ;;
+    # Nothing exists, so launch_container starts the container.
+    inspect) echo '[]'; exit 1 ;;
+esac
+""",
+    "git": """
+case "$1" in
+    clone) for dest; do :; done; mkdir -p "$dest/.git" ;;
+    rev-parse) echo 0000000000000000000000000000000000000000 ;;
+esac
+""",
+    "ssh": """
+echo "Hi benchmark! You've successfully authenticated, but GitHub does not \
+provide shell access." >&2
+exit 1
+""",
+    "glxinfo": """
+for display; do :; done
+[ "$display" = "$BENCHMARK_DISPLAY" ]
+""",
+    "make": """
+seq "$BENCHMARK_OUTPUT_LINES" \
+    | sed 's|.*|[ 50%] Building CXX object src/CMakeFiles/benchmark.dir/file&.cpp.o|'
+""",
+}
+_STAND_INS["catkin_make"] = _STAND_INS["make"]
+
+
+def _parse_args() -> None:
+    sys.argv = ["build.py", BENCHMARK_TAG, "--with-initial-user-setup"]
+    for _ in range(_PARSE_ARGS_ITERATIONS):
+        parse_args(build=True)
+
+
+def _get_env() -> None:
+    internal.env.get_env(Config(tag=BENCHMARK_TAG))
+
+
+def _launch_container() -> None:
+    internal.docker.launch_container(Config(tag=BENCHMARK_TAG))
+
+
+def _clone_packages() -> None:
+    tag_spec = importlib.import_module(f"noetic.{BENCHMARK_TAG}.initial_user_setup")
+    tag_spec.InitialUserSetup.clone_packages(
+        jobs=4, github_protocol=internal.git.GitHubProtocol.HTTPS
+    )
+
+
+def _check_github_ssh_auth() -> None:
+    internal.git.check_github_ssh_auth()
+
+
+def _capture_process_output() -> None:
+    process = subprocess.Popen(
+        ["make"], stderr=subprocess.STDOUT, stdout=subprocess.PIPE
+    )
+    internal.ros.capture_process_output(process, "benchmark", live_tail=False)
+    process.wait()
+
+
+def _build_catkin_packages() -> None:
+    internal.ros.build_catkin_packages()
+
+
+_PHASES: "dict[str, Callable[[], None]]" = {
+    "parse_args": _parse_args,
+    "get_env": _get_env,
+    "launch_container": _launch_container,
+    "clone_packages": _clone_packages,
+    "check_github_ssh_auth": _check_github_ssh_auth,
+    "capture_process_output": _capture_process_output,
+    "build_catkin_packages": _build_catkin_packages,
+}
+assert list(_PHASES) == BENCHMARK_PHASES
+
+
+def _install_stand_ins(bin_dir: Path) -> None:
+    bin_dir.mkdir()
+    for name, body in _STAND_INS.items():
+        path = bin_dir / name
+        path.write_text(_STAND_IN_PRELUDE + body.lstrip("\n"))
+        path.chmod(0o755)
+
+
+def _get_phase_env(
+    config: BenchmarkConfig, bin_dir: Path, home: Path
+) -> "dict[str, str]":
+    env = dict(os.environ)
+    # Nothing may reach the real Docker daemon, the real cache, or an
+    # ssh-agent.
+    for name in ["XDG_CACHE_HOME", "DOCKER_CONTEXT", "SSH_AUTH_SOCK", "DISPLAY"]:
+        env.pop(name, None)
+    env.update(
+        {
+            "HOME": str(home),
+            "PATH": f"{bin_dir}{os.pathsep}{env.get('PATH', '')}",
+            "DOCKER_HOST": f"unix://{home / 'docker.sock'}",
+            "BENCHMARK_LATENCY": str(config.latency),
+            "BENCHMARK_OUTPUT_LINES": str(config.output_lines),
+            "BENCHMARK_DISPLAY": BENCHMARK_DISPLAY,
+        }
+    )
+    return env
+
+
+def _run_phase(
+    phase: str, config: BenchmarkConfig, work_dir: Path
+) -> "Optional[dict[str, float]]":
+    """Run phase in a new process and return its time and peak memory, or None
+    if it failed."""
+    home = Path(tempfile.mkdtemp(dir=work_dir, prefix=f"{phase}-"))
+    (home / "catkin_ws/src").mkdir(parents=True)
+    result_path = home / "result.json"
+    output_path = home / "output.log"
+
+    with open(output_path, "wb") as output:
+        process = subprocess.run(
+            [sys.executable, "-m", "internal.benchmark", phase, str(result_path)],
+            cwd=internal.git.get_repository_root(__file__),
+            env=_get_phase_env(config, work_dir / "bin", home),
+            stdin=subprocess.DEVNULL,
+            stdout=output,
+            stderr=subprocess.STDOUT,
+        )
+
+    result = load_json(result_path)
+    if process.returncode != 0 or result is None:
+        logger.error(
+            f"{phase} failed:\n"
+            + "\n".join(
+                f"    {line}"
+                for line in output_path.read_text(errors="replace").splitlines()[-20:]
+            )
+        )
+        return None
+    return result  # type: ignore
+
+
+def _get_settings_key(config: BenchmarkConfig) -> str:
+    return f"latency={config.latency:g} output_lines={config.output_lines}"
+
+
+def _format_seconds(seconds: Optional[float]) -> str:
+    return "-" if seconds is None else f"{seconds:.3f} s"
+
+
+def _format_kb(kb: Optional[float]) -> str:
+    return "-" if kb is None else f"{kb / 1024:.1f} MB"
+
+
+def _compare(
+    result: "dict[str, float]",
+    baseline: "Optional[dict[str, float]]",
+    tolerance: int,
+) -> str:
+    if baseline is None:
+        return "no baseline"
+
+    problems = []
+    allowed = 1 + tolerance / 100
+    seconds, baseline_seconds = result["seconds"], baseline["seconds"]
+    if (
+        seconds > baseline_seconds * allowed
+        and seconds - baseline_seconds > _MIN_REGRESSION_SECONDS
+    ):
+        problems.append(f"{seconds / baseline_seconds - 1:.0%} slower")
+    kb, baseline_kb = result["peak_rss_kb"], baseline["peak_rss_kb"]
+    if kb > baseline_kb * allowed and kb - baseline_kb > _MIN_REGRESSION_KB:
+        problems.append(f"{kb / baseline_kb - 1:.0%} more memory")
+    return ", ".join(problems) or "ok"
+
+
+def run_benchmarks(config: BenchmarkConfig) -> None:
+    phases = config.phases or BENCHMARK_PHASES
+    settings_key = _get_settings_key(config)
+    baseline_path = (
+        Path(config.baseline) if config.baseline else cache_dir() / BASELINE_FILE
+    )
+    baselines: "dict[str, dict[str, Any]]" = load_json(baseline_path, default={})
+    baseline = baselines.get(settings_key, {})
+
+    logger.info(f"Running {', '.join(phases)} {config.repeat} times ({settings_key})")
+    results: "dict[str, Optional[dict[str, float]]]" = {}
+    with tempfile.TemporaryDirectory(prefix="ros-noetic-docker-benchmark-") as tmp:
+        work_dir = Path(tmp)
+        _install_stand_ins(work_dir / "bin")
+        for phase in phases:
+            runs = [_run_phase(phase, config, work_dir) for _ in range(config.repeat)]
+            if None in runs:
+                results[phase] = None
+                continue
+            results[phase] = {
+                "seconds": statistics.median(run["seconds"] for run in runs),  # type: ignore
+                "peak_rss_kb": max(run["peak_rss_kb"] for run in runs),  # type: ignore
+            }
+
+    rows = [["PHASE", "TIME", "BASELINE", "PEAK MEMORY", "BASELINE", "RESULT"]]
+    regressed = False
+    for phase, result in results.items():
+        phase_baseline = baseline.get(phase)
+        if result is None:
+            comparison = "failed"
+        else:
+            comparison = _compare(result, phase_baseline, config.tolerance)
+        regressed = regressed or comparison not in ["ok", "no baseline"]
+        rows.append(
+            [
+                phase,
+                _format_seconds(result and result["seconds"]),
+                _format_seconds(phase_baseline and phase_baseline["seconds"]),
+                _format_kb(result and result["peak_rss_kb"]),
+                _format_kb(phase_baseline and phase_baseline["peak_rss_kb"]),
+                comparison,
+            ]
+        )
+    print_table(rows)
+
+    if config.save_baseline:
+        measured = {phase: result for phase, result in results.items() if result}
+        baselines[settings_key] = {**baseline, **measured}
+        save_json(baseline_path, baselines)
+        logger.success(f"Saved the baseline to {baseline_path}")
+    elif regressed:
+        logger.error(
+            f"Some phases failed or are more than {config.tolerance}% slower or "
+            "larger than the baseline"
+        )
+        sys.exit(1)
+
+
+def _run_phase_in_process() -> None:
+    """Run one phase and write its time and peak memory to a file. This is what
+    _run_phase runs in a new process."""
+    phase, result_path = sys.argv[1:]
+    t_start = time.perf_counter()
+    _PHASES[phase]()
+    seconds = time.perf_counter() - t_start
+    # In kilobytes on Linux
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    save_json(Path(result_path), {"seconds": seconds, "peak_rss_kb": peak_rss_kb})
+
+
+if __name__ == "__main__":
+    _run_phase_in_process()
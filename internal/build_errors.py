@@ -0,0 +1,141 @@
+"""Finds the first errors in a build's output while the build runs, so that a
+failed build shows what went wrong instead of thousands of lines of output.
+
+Recognizes errors from gcc, clang, the linker, CMake, and make. Only the first
+few distinct errors are kept, each with a few lines of context, so memory use
+does not grow with the output.
+"""
+
+import collections
+import dataclasses
+import re
+from typing import Deque, Optional
+
+_ANSI_ESCAPE_PATTERN = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+
+# Each pattern has a message group and may have a location group.
+_ERROR_PATTERNS = [
+    # e.g. "/home/amrl/catkin_ws/src/a/main.cpp:12:5: error: 'b' was not declared"
+    re.compile(
+        r"^(?P<location>[^\s:][^:]*:\d+(?::\d+)?): (?:fatal )?error: (?P<message>.+)$"
+    ),
+    # e.g. "main.cpp:(.text+0x1d): undefined reference to `b()'"
+    re.compile(
+        r"^(?P<location>[^\s:][^:]*):(?:\d+|\([^)]*\)): "
+        r"(?P<message>undefined reference to .+)$"
+    ),
+    # e.g. "/usr/bin/ld: cannot find -lglog"
+    re.compile(r"^(?:\S*/)?ld(?:\.\w+)?: (?P<message>cannot find .+)$"),
+    # e.g. "CMake Error at CMakeLists.txt:12 (find_package):"
+    re.compile(r"^CMake Error at (?P<location>[^\s:][^:]*:\d+) (?P<message>\(.+\)):$"),
+    # e.g. "CMake Error: The source directory "/a" does not exist."
+    re.compile(r"^CMake Error(?: in (?P<location>[^:]+))?: ?(?P<message>.*)$"),
+    # e.g. "Makefile:3: *** missing separator.  Stop."
+    re.compile(r"^(?P<location>[^\s:][^:]*:\d+): \*\*\* (?P<message>.+)$"),
+    # e.g. "make[2]: *** No rule to make target 'a.h', needed by 'a.o'.  Stop."
+    # but not "make[2]: *** [Makefile:76: all] Error 2", which only says that
+    # a command failed.
+    re.compile(r"^g?make(?:\[\d+\])?: \*\*\* (?P<message>(?!\[.*\] Error \d+$).+)$"),
+]
+
+# Lines that lead up to an error, e.g. "a.cpp: In function 'int main()':" or
+# "In file included from a.cpp:1:"
+_CONTEXT_BEFORE_PATTERN = re.compile(
+    r"^In file included from |^\s+from \S+:\d+|: (?:In|in|At) "
+)
+
+
+def _is_context_after(line: str) -> bool:
+    """Return whether line explains the error before it, e.g. the source line
+    and caret that gcc prints, a note, or the rest of a CMake message."""
+    return line == "" or line[0].isspace() or ": note: " in line
+
+
+@dataclasses.dataclass
+class BuildError:
+    location: str
+    message: str
+    # The error's line with the lines of context around it
+    lines: "list[str]"
+    count: int = 1
+
+
+class ErrorExtractor:
+    """A line handler for OutputCapture that keeps the first max_errors
+    distinct errors in the output."""
+
+    CONTEXT_BEFORE = 4
+    CONTEXT_AFTER = 8
+    MAX_LINE_LENGTH = 500
+
+    def __init__(self, max_errors: int = 5) -> None:
+        self.max_errors = max_errors
+        self.errors: "list[BuildError]" = []
+        # Errors that were not kept because max_errors were already found
+        self.omitted_count = 0
+        self._context_before: "Deque[str]" = collections.deque(
+            maxlen=self.CONTEXT_BEFORE
+        )
+        self._collecting: Optional[BuildError] = None
+        self._context_after_count = 0
+
+    def handle_line(self, line: str) -> None:
+        line = _ANSI_ESCAPE_PATTERN.sub("", line)[: self.MAX_LINE_LENGTH]
+
+        match = None
+        for pattern in _ERROR_PATTERNS:
+            match = pattern.match(line)
+            if match is not None:
+                break
+        if match is None:
+            self._handle_other_line(line)
+            return
+
+        location = match.groupdict().get("location") or ""
+        message = match["message"]
+        self._collecting = None
+        context_before = list(self._context_before)
+        self._context_before.clear()
+
+        for error in self.errors:
+            # e.g. an error in a header that many files include
+            if error.location == location and error.message == message:
+                error.count += 1
+                return
+
+        if len(self.errors) == self.max_errors:
+            self.omitted_count += 1
+            return
+
+        error = BuildError(location, message, [*context_before, line])
+        self.errors.append(error)
+        self._collecting = error
+        self._context_after_count = 0
+
+    def _handle_other_line(self, line: str) -> None:
+        if self._collecting is not None:
+            if self._context_after_count < self.CONTEXT_AFTER and _is_context_after(
+                line
+            ):
+                self._collecting.lines.append(line)
+                self._context_after_count += 1
+                return
+            self._collecting = None
+
+        if _CONTEXT_BEFORE_PATTERN.search(line):
+            self._context_before.append(line)
+        else:
+            self._context_before.clear()
+
+    def format(self) -> str:
+        """Return the errors that were found, indented, with a blank line
+        between them."""
+        blocks = []
+        for error in self.errors:
+            lines = list(error.lines)
+            while lines and lines[-1] == "":
+                lines.pop()
+            if error.count > 1:
+                lines.append(f"(seen {error.count} times)")
+            blocks.append("\n".join(f"    {line}".rstrip() for line in lines))
+        return "\n\n".join(blocks)
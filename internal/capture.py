@@ -0,0 +1,132 @@
+import collections
+import os
+import select
+import shutil
+import subprocess
+import sys
+import time
+from typing import Callable
+
+import internal.ansi as ansi
+import internal.log_archive
+from internal.cache import log_dir
+from internal.log_utils import flush_logs
+
+LineHandler = Callable[[str], None]
+
+
+class OutputCapture:
+    """Capture a subprocess's output without holding it in memory.
+
+    The full output is spooled to a log file, and only the last few lines are
+    kept for a live tail on the terminal, which is redrawn at most FRAME_RATE
+    times per second.
+    """
+
+    FRAME_RATE = 10
+    MAX_TAIL_LINES = 10
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, name: str, live_tail: bool = True) -> None:
+        self.name = name
+        self.log_path = log_dir() / f"{name}.log"
+        self.live_tail = live_tail and sys.stdout.isatty()
+        self.line_handlers: "list[LineHandler]" = []
+
+        terminal_size = shutil.get_terminal_size()
+        self.max_line_count = min(self.MAX_TAIL_LINES, terminal_size.lines - 2)
+        self.max_line_width = terminal_size.columns - 4
+        self.tail: "collections.deque[str]" = collections.deque(
+            maxlen=max(self.max_line_count, 1)
+        )
+        self.lines_to_clear = 0
+
+    def add_line_handler(self, handler: LineHandler) -> None:
+        """Call handler with every line of output as it is read."""
+        self.line_handlers.append(handler)
+
+    def capture(self, process: subprocess.Popen) -> int:
+        """Read the process's output until it exits and return its exit code.
+
+        The caller should redirect stdout to pipe and stderr to stdout.
+        """
+        if process.stdout is None:
+            # no output to capture
+            return process.wait()
+
+        # The tail is redrawn by moving the cursor up over it, and a previous
+        # capture with the same name must be archived before it is overwritten.
+        flush_logs()
+
+        draw_tail = self.live_tail and self.max_line_count > 0
+        frame_interval = 1 / self.FRAME_RATE
+        next_frame = 0.0
+        tail_changed = False
+        partial_line = b""
+
+        fd = process.stdout.fileno()
+        with open(self.log_path, "wb") as log_file:
+            while True:
+                timeout = None
+                if tail_changed:
+                    timeout = max(0.0, next_frame - time.monotonic())
+
+                readable, _, _ = select.select([fd], [], [], timeout)
+                if readable:
+                    chunk = os.read(fd, self.READ_SIZE)
+                    if not chunk:
+                        break
+
+                    log_file.write(chunk)
+                    lines = (partial_line + chunk).split(b"\n")
+                    partial_line = lines.pop()
+                    for line in lines:
+                        self._handle_line(line)
+                    # Without a tail to draw, select waits for output instead
+                    # of the next frame.
+                    tail_changed = draw_tail and (tail_changed or len(lines) > 0)
+
+                if draw_tail and tail_changed and time.monotonic() >= next_frame:
+                    self._draw_tail()
+                    next_frame = time.monotonic() + frame_interval
+                    tail_changed = False
+
+            if partial_line:
+                self._handle_line(partial_line)
+
+        if draw_tail:
+            self._clear_tail()
+
+        internal.log_archive.add_capture(self.name, self.log_path)
+        return process.wait()
+
+    def dump(self) -> None:
+        """Copy the full output to stdout."""
+        flush_logs()
+        sys.stdout.flush()
+        with open(self.log_path, "rb") as log_file:
+            shutil.copyfileobj(log_file, sys.stdout.buffer, self.READ_SIZE)
+        sys.stdout.buffer.flush()
+
+    def _handle_line(self, raw_line: bytes) -> None:
+        # Progress bars redraw a line with carriage returns, so only keep the
+        # most recent state of the line.
+        line = raw_line.decode(errors="replace").rstrip().rpartition("\r")[2]
+        self.tail.append(line)
+        for handler in self.line_handlers:
+            handler(line)
+
+    def _draw_tail(self) -> None:
+        tail = [line[: self.max_line_width] for line in self.tail]
+        sys.stdout.write(
+            f"{ansi.PREV_LINE}{ansi.CLEAR_LINE}" * self.lines_to_clear
+            + "\n".join(tail)
+            + "\n"
+        )
+        sys.stdout.flush()
+        self.lines_to_clear = len(tail)
+
+    def _clear_tail(self) -> None:
+        sys.stdout.write(f"{ansi.PREV_LINE}{ansi.CLEAR_LINE}" * self.lines_to_clear)
+        sys.stdout.flush()
+        self.lines_to_clear = 0
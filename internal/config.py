@@ -1,9 +1,10 @@
 import argparse
 import dataclasses
 import os
+import re
 import sys
 from pathlib import Path
-from typing import NoReturn
+from typing import NoReturn, Optional
 
 
 class ArgumentParser(argparse.ArgumentParser):
@@ -18,10 +19,111 @@ class ArgumentParser(argparse.ArgumentParser):
 @dataclasses.dataclass
 class Config:
     tag: str
+    # (Build only) Every tag to build, including tag
+    tags: "list[str]" = dataclasses.field(default_factory=list)
     with_initial_user_setup: bool = False
+    refresh_host_facts: bool = False
+    clone_jobs: int = 4
+    git_mirror_dir: Optional[str] = None
+    catkin_backend: str = "catkin_make"
+    catkin_isolate_devel: bool = False
+    force: bool = False
+    # (Build only) Write a report of how long each image build step took
+    profile: bool = False
+    # (Build only) Where to write a Chrome trace of the build
+    trace: Optional[str] = None
+    # (Build only) Download packages through a caching proxy on the host
+    package_cache: bool = False
+    package_cache_size: int = 20
     _require_x_display: bool = True
 
 
+@dataclasses.dataclass
+class BuildOptions:
+    """Options for building packages inside the container.
+
+    Each field must also be a field of Config. build.py passes them to the
+    container as command line arguments.
+    """
+
+    catkin_backend: str = "catkin_make"
+    catkin_isolate_devel: bool = False
+    force: bool = False
+
+
+@dataclasses.dataclass
+class AdminConfig:
+    # One of ADMIN_ACTIONS
+    action: str
+    # Only act on these users' containers, or every user's if empty
+    users: "list[str]" = dataclasses.field(default_factory=list)
+    # Only act on containers for these tags, or every tag's if empty
+    tags: "list[str]" = dataclasses.field(default_factory=list)
+    jobs: int = 8
+
+
+@dataclasses.dataclass
+class SyncConfig:
+    tag: str
+    jobs: int = 8
+
+
+@dataclasses.dataclass
+class TransferConfig:
+    # "export" or "import"
+    action: str
+    # (Export only) Tags whose images to export
+    tags: "list[str]" = dataclasses.field(default_factory=list)
+    # Where to write or read the stream, or None for stdout or stdin
+    file: Optional[str] = None
+    # (Export only) A file listing the layers that the target already has
+    exclude_layers: Optional[str] = None
+    # (Import only) Print the local layers instead of importing
+    list_layers: bool = False
+    jobs: int = 1
+
+
+@dataclasses.dataclass
+class LogsConfig:
+    # A run ID, a prefix of one, or "last". None lists the runs.
+    run: Optional[str] = None
+    # A phase of run whose captured output to print
+    phase: Optional[str] = None
+    tag: Optional[str] = None
+    failed: bool = False
+    limit: int = 20
+
+
+@dataclasses.dataclass
+class BenchmarkConfig:
+    # Phases to run, from BENCHMARK_PHASES, or every phase if empty
+    phases: "list[str]" = dataclasses.field(default_factory=list)
+    # How many times to run each phase
+    repeat: int = 3
+    # How long each stand-in command takes
+    latency: float = 0.0
+    # How many lines the stand-in make and catkin_make print
+    output_lines: int = 10000
+    # Where the baseline is saved, or None for the cache directory
+    baseline: Optional[str] = None
+    save_baseline: bool = False
+    # How much slower or larger than the baseline a phase may get, in percent
+    tolerance: int = 25
+
+
+ADMIN_ACTIONS = ["status", "start", "stop", "restart", "rebuild"]
+
+BENCHMARK_PHASES = [
+    "parse_args",
+    "get_env",
+    "launch_container",
+    "clone_packages",
+    "check_github_ssh_auth",
+    "capture_process_output",
+    "build_catkin_packages",
+]
+
+
 def available_tags() -> "list[str]":
     tags = []
 
@@ -39,8 +141,175 @@ def available_tags() -> "list[str]":
     return tags
 
 
-def parse_args() -> Config:
+# e.g. "FROM ${CONTAINER_USER}-noetic:amrl-base"
+_PARENT_TAG_PATTERN = re.compile(
+    r"^FROM\s+\$\{CONTAINER_USER\}-noetic:(?P<parent>[\w.-]+)", re.IGNORECASE
+)
+
+
+def get_parent_tag(tag: str) -> Optional[str]:
+    """Return the tag that tag's Dockerfile builds on, or None if it builds on
+    an image from outside this repository."""
+    dockerfile = Path(__file__).parent.parent / "noetic" / tag / "Dockerfile"
+    with open(dockerfile) as f:
+        for line in f:
+            match = _PARENT_TAG_PATTERN.match(line.strip())
+            if match is not None:
+                return match["parent"]
+    return None
+
+
+def parse_args(build: bool = False) -> Config:
+    """Parse the command line for launch.py, or for build.py if build is True,
+    which accepts several tags."""
     argparser = ArgumentParser()
+    if build:
+        argparser.epilog = (
+            "To move images between machines, see `build.py export --help` and "
+            "`build.py import --help`."
+        )
+        argparser.add_argument(
+            "tags",
+            type=str,
+            nargs="*",
+            metavar="TAG",
+            help=f"One or more of {available_tags()}",
+        )
+        argparser.add_argument(
+            "--all",
+            action="store_true",
+            help="Build every tag.",
+        )
+        argparser.add_argument(
+            "--profile",
+            action="store_true",
+            help="Rebuild the images without Docker's build cache and report "
+            "their slowest build steps and largest layers.",
+        )
+        argparser.add_argument(
+            "--trace",
+            type=str,
+            metavar="FILE",
+            help="Write how long each build phase and command took to FILE, "
+            "which https://ui.perfetto.dev can open.",
+        )
+        argparser.add_argument(
+            "--package-cache",
+            action="store_true",
+            help="Download apt and pip packages through a caching proxy on this "
+            "host, starting it if it is not running.",
+        )
+        argparser.add_argument(
+            "--package-cache-size",
+            type=int,
+            default=20,
+            metavar="GB",
+            help="Remove the least recently used packages once the package cache "
+            "is larger than GB. Applies when the proxy starts. "
+            "(default: %(default)s)",
+        )
+    else:
+        argparser.add_argument(
+            "tag",
+            type=str,
+            metavar="TAG",
+            choices=available_tags(),
+            help=f"One of {available_tags()}",
+        )
+    argparser.add_argument(
+        "--with-initial-user-setup",
+        action="store_true",
+        help="[Beta] (Build only) Also set up initial ROS packages.",
+    )
+    argparser.add_argument(
+        "--clone-jobs",
+        type=int,
+        default=4,
+        metavar="N",
+        help="(Build only) Clone up to N repositories at a time during initial "
+        "user setup. Requires HTTPS or an ssh-agent. (default: %(default)s)",
+    )
+    argparser.add_argument(
+        "--git-mirror-dir",
+        type=str,
+        metavar="DIR",
+        help="(Build only) Clone repositories from host-wide bare mirrors in DIR, "
+        "creating or refreshing them as needed. Share DIR between users through "
+        "a common group.",
+    )
+    argparser.add_argument(
+        "--refresh-host-facts",
+        action="store_true",
+        help="Query Docker and the host again instead of using cached values.",
+    )
+    _add_build_option_arguments(argparser)
+
+    args = argparser.parse_args()
+
+    if build:
+        # argparse cannot check choices for an empty nargs="*" list.
+        tags = available_tags() if args.all else args.tags
+        del args.all
+        if len(tags) == 0:
+            argparser.error("at least one TAG or --all is required")
+        for tag in tags:
+            if tag not in available_tags():
+                argparser.error(
+                    f"invalid TAG: '{tag}' (choose from {available_tags()})"
+                )
+        if args.with_initial_user_setup and len(tags) > 1:
+            argparser.error("--with-initial-user-setup requires exactly one TAG")
+
+        args.tag = tags[0]
+        args.tags = tags
+
+    config = Config(**vars(args))
+    return config
+
+
+def parse_admin_args() -> AdminConfig:
+    argparser = ArgumentParser(
+        description="Manage every user's noetic containers on this host."
+    )
+    argparser.add_argument(
+        "action",
+        choices=ADMIN_ACTIONS,
+        help="Show, start, stop, or restart the containers, or rebuild their "
+        "images and recreate them.",
+    )
+    argparser.add_argument(
+        "--users",
+        type=str,
+        nargs="+",
+        default=[],
+        metavar="USER",
+        help="Only act on these users' containers.",
+    )
+    argparser.add_argument(
+        "--tags",
+        type=str,
+        nargs="+",
+        default=[],
+        metavar="TAG",
+        help="Only act on containers for these tags.",
+    )
+    argparser.add_argument(
+        "--jobs",
+        type=int,
+        default=8,
+        metavar="N",
+        help="Act on up to N containers, or rebuild images for up to N users, "
+        "at a time. (default: %(default)s)",
+    )
+
+    args = argparser.parse_args()
+    return AdminConfig(**vars(args))
+
+
+def parse_sync_args() -> SyncConfig:
+    argparser = ArgumentParser(
+        description="Fetch and fast-forward the packages cloned for a tag."
+    )
     argparser.add_argument(
         "tag",
         type=str,
@@ -49,11 +318,233 @@ def parse_args() -> Config:
         help=f"One of {available_tags()}",
     )
     argparser.add_argument(
-        "--with-initial-user-setup",
+        "--jobs",
+        type=int,
+        default=8,
+        metavar="N",
+        help="Sync up to N repositories at a time. (default: %(default)s)",
+    )
+
+    args = argparser.parse_args()
+    return SyncConfig(**vars(args))
+
+
+def parse_transfer_args() -> TransferConfig:
+    """Parse the command line for build.py export and build.py import."""
+    argparser = ArgumentParser(
+        prog="build.py", description="Move images between machines."
+    )
+    subparsers = argparser.add_subparsers(dest="action", required=True)
+    jobs = len(os.sched_getaffinity(0))
+
+    export_parser = subparsers.add_parser(
+        "export", help="Write a compressed stream of images to stdout."
+    )
+    export_parser.add_argument(
+        "tags",
+        type=str,
+        nargs="+",
+        metavar="TAG",
+        choices=available_tags(),
+        help=f"One or more of {available_tags()}",
+    )
+    export_parser.add_argument(
+        "--output",
+        dest="file",
+        type=str,
+        metavar="FILE",
+        help="Write the stream to FILE instead of stdout.",
+    )
+    export_parser.add_argument(
+        "--exclude-layers",
+        type=str,
+        metavar="FILE",
+        help="Leave out the layers listed in FILE, which the target writes with "
+        "`build.py import --list-layers`.",
+    )
+    export_parser.add_argument(
+        "--jobs",
+        type=int,
+        default=jobs,
+        metavar="N",
+        help="Compress on up to N cores. (default: %(default)s)",
+    )
+
+    import_parser = subparsers.add_parser(
+        "import", help="Load images from a stream that export wrote to stdin."
+    )
+    import_parser.add_argument(
+        "--input",
+        dest="file",
+        type=str,
+        metavar="FILE",
+        help="Read the stream from FILE instead of stdin.",
+    )
+    import_parser.add_argument(
+        "--list-layers",
         action="store_true",
-        help="[Beta] (Build only) Also set up initial ROS packages.",
+        help="Print the layers of the images on this machine, for export "
+        "--exclude-layers, instead of importing.",
+    )
+    import_parser.add_argument(
+        "--jobs",
+        type=int,
+        default=jobs,
+        metavar="N",
+        help="Decompress on up to N cores. (default: %(default)s)",
     )
 
     args = argparser.parse_args()
-    config = Config(**vars(args))
-    return config
+    return TransferConfig(**vars(args))
+
+
+def parse_logs_args() -> LogsConfig:
+    argparser = ArgumentParser(
+        description="List archived runs, or print the logs of one run."
+    )
+    argparser.add_argument(
+        "run",
+        type=str,
+        nargs="?",
+        metavar="RUN",
+        help='A run ID, a unique prefix of one, or "last"',
+    )
+    argparser.add_argument(
+        "phase",
+        type=str,
+        nargs="?",
+        metavar="PHASE",
+        help="Print the captured output of this phase of RUN",
+    )
+    argparser.add_argument(
+        "--tag",
+        type=str,
+        metavar="TAG",
+        help="Only list runs for TAG",
+    )
+    argparser.add_argument(
+        "--failed",
+        action="store_true",
+        help="Only list runs that logged an error",
+    )
+    argparser.add_argument(
+        "--limit",
+        type=int,
+        default=20,
+        metavar="N",
+        help="List the N most recent runs. (default: %(default)s)",
+    )
+
+    args = argparser.parse_args()
+    return LogsConfig(**vars(args))
+
+
+def parse_benchmark_args() -> BenchmarkConfig:
+    argparser = ArgumentParser(
+        description="Time the build and launch paths against stand-ins for docker, "
+        "git, ssh, glxinfo, make, and catkin_make, and compare them to a baseline."
+    )
+    argparser.add_argument(
+        "phases",
+        type=str,
+        nargs="*",
+        metavar="PHASE",
+        help=f"Zero or more of {BENCHMARK_PHASES}. (default: all of them)",
+    )
+    argparser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        metavar="N",
+        help="Run each phase N times and compare the median time. "
+        "(default: %(default)s)",
+    )
+    argparser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="Make each stand-in command take SECONDS. (default: %(default)s)",
+    )
+    argparser.add_argument(
+        "--output-lines",
+        type=int,
+        default=10000,
+        metavar="N",
+        help="Make the stand-in make and catkin_make print N lines. "
+        "(default: %(default)s)",
+    )
+    argparser.add_argument(
+        "--baseline",
+        type=str,
+        metavar="FILE",
+        help="Compare to the baseline in FILE instead of the one in the cache "
+        "directory.",
+    )
+    argparser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Save the results as the baseline for these settings.",
+    )
+    argparser.add_argument(
+        "--tolerance",
+        type=int,
+        default=25,
+        metavar="PERCENT",
+        help="Fail if a phase is more than PERCENT slower or larger than its "
+        "baseline. (default: %(default)s)",
+    )
+
+    args = argparser.parse_args()
+    for phase in args.phases:
+        if phase not in BENCHMARK_PHASES:
+            argparser.error(
+                f"invalid PHASE: '{phase}' (choose from {BENCHMARK_PHASES})"
+            )
+    return BenchmarkConfig(**vars(args))
+
+
+def _add_build_option_arguments(argparser: argparse.ArgumentParser) -> None:
+    argparser.add_argument(
+        "--catkin-backend",
+        choices=["catkin_make", "catkin_tools"],
+        default="catkin_make",
+        help="(Build only) Build the catkin workspace with catkin_make, one job "
+        "at a time, or with catkin_tools' `catkin build`, which builds packages "
+        "in parallel in dependency order. (default: %(default)s)",
+    )
+    argparser.add_argument(
+        "--catkin-isolate-devel",
+        action="store_true",
+        help="(Build only) With catkin_tools, give each package its own devel "
+        "space for packages that break in a merged devel space.",
+    )
+    argparser.add_argument(
+        "--force",
+        action="store_true",
+        help="(Build only) Rebuild images and packages even if nothing has "
+        "changed since they were last built.",
+    )
+
+
+def container_build_args(config: Config) -> "list[str]":
+    """Convert the build options in config to arguments for
+    parse_build_options."""
+    args = []
+    for field in dataclasses.fields(BuildOptions):
+        value = getattr(config, field.name)
+        flag = "--" + field.name.replace("_", "-")
+        if isinstance(value, bool):
+            if value:
+                args.append(flag)
+        elif value is not None:
+            args += [flag, str(value)]
+    return args
+
+
+def parse_build_options() -> BuildOptions:
+    argparser = ArgumentParser()
+    _add_build_option_arguments(argparser)
+
+    args = argparser.parse_args()
+    return BuildOptions(**vars(args))
@@ -1,14 +1,47 @@
+import concurrent.futures
+import hashlib
 import importlib
+import json
 import os
 import subprocess
 import sys
+import time
 from pathlib import Path
+from typing import Optional
 
+import internal.docker_api
 import internal.git
+import internal.images
+import internal.log_archive
+import internal.manifest
 import internal.ros
+import internal.rosdep
+import internal.tasks
+import internal.trace
 from internal import logger
-from internal.config import Config
+from internal.cache import cache_dir, load_json, save_json
+from internal.config import (
+    Config,
+    SyncConfig,
+    container_build_args,
+    parse_build_options,
+)
 from internal.env import _get_container_user, get_env
+from internal.log_utils import print_table
+
+DOCKERENV_SNAPSHOT_FILE = "dockerenv_snapshot.json"
+
+# Set on each container through the labels in compose.shared.yaml.
+LAUNCH_FINGERPRINT_LABEL = "com.github.ut-amrl.ros-noetic-docker.launch-fingerprint"
+# The environment from get_env that the container was launched with, as JSON
+LAUNCH_ENV_LABEL = "com.github.ut-amrl.ros-noetic-docker.launch-env"
+
+# Where the container writes its half of a --trace for the host to merge.
+CONTAINER_TRACE_FILE = "container_trace.json"
+
+# The environment this process started with, before sourcing /.dockerenv.
+_BASE_ENV = dict(os.environ)
+_VOLATILE_ENV_VARS = ["_", "OLDPWD", "PWD", "SHLVL"]
 
 
 class InitialUserSetup:
@@ -18,24 +51,131 @@ class InitialUserSetup:
 
     @classmethod
     def get_rosbuild_package_urls(cls) -> "list[str]":
-        """These must be specified in build dependency order."""
+        """Build order and concurrency come from each package's package.xml or
+        manifest.xml. Packages without either are built after the packages
+        listed before them."""
         return []
 
     @classmethod
-    def clone_packages(cls) -> None:
+    def clone_packages(
+        cls,
+        jobs: int = 1,
+        mirror_dir: Optional[Path] = None,
+        github_protocol: Optional[internal.git.GitHubProtocol] = None,
+    ) -> None:
+        """Clone every package. The user is asked for github_protocol if it is
+        not given."""
         # Log the Git SHA for build failure reproducibility.
         logger.info("git hash: " + internal.git.get_repository_hash(__file__))
 
-        github_protocol = internal.git.get_user_protocol_preference()
+        if github_protocol is None:
+            github_protocol = internal.git.get_user_protocol_preference()
 
-        for catkin_pkg in cls.get_catkin_package_urls():
-            internal.ros.clone_catkin_package(catkin_pkg, github_protocol)
+        if jobs > 1 and not internal.git.can_clone_in_parallel(github_protocol):
+            logger.warning(
+                "Cloning one repository at a time since git may prompt for an "
+                "SSH key password. Add your key to an ssh-agent to clone in parallel."
+            )
+            jobs = 1
+
+        if jobs == 1:
+            for catkin_pkg in cls.get_catkin_package_urls():
+                internal.ros.clone_catkin_package(
+                    catkin_pkg, github_protocol, mirror_dir=mirror_dir
+                )
 
-        for rosbuild_pkg in cls.get_rosbuild_package_urls():
-            internal.ros.clone_amrl_package(rosbuild_pkg, github_protocol)
+            for rosbuild_pkg in cls.get_rosbuild_package_urls():
+                internal.ros.clone_amrl_package(
+                    rosbuild_pkg, github_protocol, mirror_dir=mirror_dir
+                )
+        else:
+            cls._clone_packages_in_parallel(github_protocol, jobs, mirror_dir)
 
         logger.success("Cloned package repositories")
 
+    @classmethod
+    def _clone_packages_in_parallel(
+        cls,
+        github_protocol: internal.git.GitHubProtocol,
+        jobs: int,
+        mirror_dir: Optional[Path],
+    ) -> None:
+        # Submodules may use SSH even if the user chose HTTPS, so only fetch
+        # them in parallel when git will not prompt for a password.
+        submodule_jobs = jobs if internal.git.has_ssh_agent() else 1
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(
+                    internal.ros.clone_catkin_package,
+                    catkin_pkg,
+                    github_protocol,
+                    quiet=True,
+                    mirror_dir=mirror_dir,
+                )
+                for catkin_pkg in cls.get_catkin_package_urls()
+            ] + [
+                executor.submit(
+                    internal.ros.clone_amrl_package,
+                    rosbuild_pkg,
+                    github_protocol,
+                    quiet=True,
+                    submodule_jobs=submodule_jobs,
+                    mirror_dir=mirror_dir,
+                )
+                for rosbuild_pkg in cls.get_rosbuild_package_urls()
+            ]
+
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    @classmethod
+    def get_package_dirs(cls) -> "list[Path]":
+        return [
+            Path.home() / "catkin_ws/src" / Path(catkin_pkg).stem
+            for catkin_pkg in cls.get_catkin_package_urls()
+        ] + [
+            Path.home() / "ut-amrl" / Path(rosbuild_pkg).stem
+            for rosbuild_pkg in cls.get_rosbuild_package_urls()
+        ]
+
+    @classmethod
+    def sync_packages(cls, jobs: int = 1) -> "list[internal.git.RepositoryStatus]":
+        """Fetch every cloned package, fast-forward it if it has no local
+        commits, and update its submodules."""
+        package_dirs = cls.get_package_dirs()
+
+        if jobs > 1 and not internal.git.has_ssh_agent():
+            if any(
+                not internal.git.get_remote_url(package_dir).startswith("https://")
+                for package_dir in package_dirs
+                if package_dir.exists()
+            ):
+                logger.warning(
+                    "Syncing one repository at a time since git may prompt for "
+                    "an SSH key password. Add your key to an ssh-agent to sync "
+                    "in parallel."
+                )
+                jobs = 1
+
+        # Submodules may use SSH even if their repository uses HTTPS.
+        submodule_jobs = jobs if internal.git.has_ssh_agent() else 1
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            return list(
+                executor.map(
+                    lambda package_dir: internal.git.sync_repository(
+                        package_dir, submodule_jobs=submodule_jobs
+                    ),
+                    package_dirs,
+                )
+            )
+
     @classmethod
     def post_clone_packages(cls) -> None:
         pass  # override me!
@@ -48,20 +188,38 @@ class InitialUserSetup:
             if internal.docker.are_we_in_the_container():
                 InitialUserSetup.build_packages()
         """
+        internal.log_archive.enable()
         logger.info("We're inside the docker container now")
+        internal.trace.enable_from_env("container")
+
+        options = parse_build_options()
+        manifest = internal.manifest.BuildManifest(force=options.force)
 
         source_dockerenv()
 
-        internal.ros.rosdep_update()
+        amrl_package_dirs = [
+            Path.home() / "ut-amrl" / Path(rosbuild_pkg).stem
+            for rosbuild_pkg in cls.get_rosbuild_package_urls()
+        ]
 
-        internal.ros.build_catkin_packages()
+        internal.rosdep.check_dependencies(
+            [Path.home() / "catkin_ws/src", *amrl_package_dirs], force=options.force
+        )
+
+        internal.ros.reset_compiler_cache_stats()
+
+        internal.ros.build_catkin_packages(
+            backend=options.catkin_backend,
+            isolate_devel=options.catkin_isolate_devel,
+            manifest=manifest,
+        )
         # We need to grab new environment variables after the catkin build.
-        source_dockerenv()
+        source_dockerenv(refresh=True)
 
-        for rosbuild_pkg in cls.get_rosbuild_package_urls():
-            internal.ros.build_amrl_package(
-                Path.home() / "ut-amrl" / Path(rosbuild_pkg).stem
-            )
+        internal.ros.build_amrl_packages(amrl_package_dirs, manifest=manifest)
+
+        internal.ros.log_compiler_cache_stats()
+        manifest.log_report()
 
         logger.success("Build finished")
 
@@ -72,50 +230,215 @@ class InitialUserSetup:
 
 
 def build_image(config: Config) -> None:
-    subprocess_args = ["make", "-f", f"noetic/{config.tag}/Makefile"]
-
+    internal.log_archive.enable()
+    internal.log_archive.add_tags(config.tags or [config.tag])
     config._require_x_display = False
-    result = subprocess.run(subprocess_args, env=get_env(config))
-    if result.returncode != 0:
-        logger.critical("Build failed. Check build logs.")
-        sys.exit(result.returncode)
+    if config.trace is not None:
+        internal.trace.enable("host", Path(config.trace))
 
+    tag_spec = None
+    github_protocol = None
     if config.with_initial_user_setup:
         try:
             tag_spec = importlib.import_module(
                 f"noetic.{config.tag}.initial_user_setup"
             )
-            tag_spec.InitialUserSetup.clone_packages()
-            tag_spec.InitialUserSetup.post_clone_packages()
+        except ImportError:
+            logger.error(f"No build spec for {config.tag}")
+        else:
+            # Ask before building images so that the rest of the build can run
+            # unattended.
+            github_protocol = internal.git.ask_user_protocol_preference()
+
+    tasks = [
+        internal.tasks.Task(
+            "image build",
+            lambda: internal.images.build_images(config, config.tags or [config.tag]),
+            draws_to_terminal=True,
+        )
+    ]
+    if github_protocol == internal.git.GitHubProtocol.SSH:
+        if internal.git.has_ssh_agent():
+            # ssh will not prompt for a key password, so check while the images
+            # build.
+            tasks.append(
+                internal.tasks.Task(
+                    "GitHub SSH check", internal.git.check_github_ssh_auth
+                )
+            )
+        else:
+            internal.git.check_github_ssh_auth()
 
-            logger.info(
-                "Moving execution into the Docker container to build packages..."
+    if not internal.tasks.run_tasks(tasks)["image build"]:
+        logger.critical("Build failed. Check build logs.")
+        sys.exit(1)
+
+    if tag_spec is not None:
+        with internal.trace.span("clone_packages"):
+            tag_spec.InitialUserSetup.clone_packages(
+                jobs=config.clone_jobs,
+                mirror_dir=(
+                    Path(config.git_mirror_dir) if config.git_mirror_dir else None
+                ),
+                github_protocol=github_protocol,
             )
-            config._require_x_display = False
-            launch_container(config)
-            result = subprocess.run(
+        with internal.trace.span("post_clone_packages"):
+            tag_spec.InitialUserSetup.post_clone_packages()
+
+        logger.info("Moving execution into the Docker container to build packages...")
+        config._require_x_display = False
+        launch_container(config)
+
+        exec_env = {
+            internal.manifest.IMAGE_ID_ENV_VAR: _get_image_id(config),
+            internal.log_archive.PARENT_RUN_ENV_VAR: internal.log_archive.get_run_id(),
+        }
+        container_trace_file = cache_dir() / CONTAINER_TRACE_FILE
+        if internal.trace.is_enabled():
+            exec_env[internal.trace.TRACE_FILE_ENV_VAR] = str(container_trace_file)
+
+        with internal.trace.span("build_packages"):
+            returncode = internal.docker_api.exec_in_container(
+                f"{_get_container_user()}-noetic-{config.tag}-app-1",
                 [
-                    "docker",
-                    "exec",
-                    "--tty",
-                    "--workdir",
-                    internal.git.get_repository_root(__file__),
-                    f"{_get_container_user()}-noetic-{config.tag}-app-1",
                     "python3",
                     "-m",
                     f"noetic.{config.tag}.initial_user_setup",
-                ]
+                    *container_build_args(config),
+                ],
+                env=exec_env,
+                workdir=str(internal.git.get_repository_root(__file__)),
+                tty=True,
             )
-            stop_container(config)
-            if result.returncode != 0:
-                sys.exit(result.returncode)
+        if internal.trace.is_enabled():
+            internal.trace.merge(container_trace_file)
+
+        stop_container(config)
+        if returncode != 0:
+            sys.exit(returncode)
 
+        with internal.trace.span("post_build_packages"):
             tag_spec.InitialUserSetup.post_build_packages()
-        except ImportError:
-            logger.error(f"No build spec for {config.tag}")
 
 
+def sync_packages(config: SyncConfig) -> None:
+    try:
+        tag_spec = importlib.import_module(f"noetic.{config.tag}.initial_user_setup")
+    except ImportError:
+        logger.error(f"No build spec for {config.tag}")
+        sys.exit(1)
+
+    internal.log_archive.add_tags([config.tag])
+    logger.info(f"Syncing the packages for {config.tag}")
+    t_start = time.time()
+    statuses = tag_spec.InitialUserSetup.sync_packages(jobs=config.jobs)
+
+    rows = [["REPOSITORY", "BRANCH", "AHEAD", "BEHIND", "DIRTY", "RESULT"]]
+    for status in statuses:
+        rows.append(
+            [
+                str(status.path.relative_to(Path.home())),
+                status.branch,
+                str(status.ahead),
+                str(status.behind),
+                "yes" if status.dirty else "",
+                status.result,
+            ]
+        )
+    print_table(rows)
+
+    failures = [status for status in statuses if status.failed]
+    if failures:
+        logger.error(f"Failed to sync {len(failures)} of {len(statuses)} repositories")
+        sys.exit(1)
+    logger.success(
+        f"Synced {len(statuses)} repositories in {time.time() - t_start:.1f} s"
+    )
+
+
+def _get_image_id(config: Config) -> str:
+    images = internal.docker_api.inspect(
+        [f"{_get_container_user()}-noetic:{config.tag}"], object_type="image"
+    )
+    return images[0]["Id"] if images else ""  # type: ignore
+
+
+def get_launch_fingerprint(env: "dict[str, str]") -> str:
+    """Hash the compose files for env["IMAGE_TAG"] and the environment that
+    docker compose resolves them with, e.g. DISPLAY and the container runtime.
+    """
+    tag_dir = internal.images.NOETIC_DIR / env["IMAGE_TAG"]
+    compose_files = [
+        *sorted(internal.images.NOETIC_DIR.glob("compose*.yaml")),
+        *sorted(tag_dir.glob("compose*.yaml")),
+    ]
+
+    digest = hashlib.sha256()
+    for name, value in sorted(env.items()):
+        if name != "LAUNCH_FINGERPRINT":
+            digest.update(f"{name}={value}\0".encode())
+    for compose_file in compose_files:
+        digest.update(f"{compose_file.name}\0".encode())
+        digest.update(compose_file.read_bytes())
+    return digest.hexdigest()
+
+
+def get_launch_labels_env(env: "dict[str, str]") -> "dict[str, str]":
+    """Return the variables that compose.shared.yaml turns into the launch
+    labels of a container launched with env."""
+    return {
+        "LAUNCH_ENV": json.dumps(env, sort_keys=True),
+        "LAUNCH_FINGERPRINT": get_launch_fingerprint(env),
+    }
+
+
+def _is_container_up_to_date(config: Config) -> bool:
+    """Return whether the container is running with the current compose files
+    and the current image for its tag.
+
+    The environment is the one stored in the container's labels, so nothing
+    on the host is probed.
+    """
+    container_name = f"{_get_container_user()}-noetic-{config.tag}-app-1"
+    image_name = f"{_get_container_user()}-noetic:{config.tag}"
+
+    objects = internal.docker_api.inspect([container_name, image_name])
+    containers = [obj for obj in objects if "State" in obj]
+    images = [obj for obj in objects if "RepoTags" in obj]
+    if len(containers) != 1 or len(images) != 1:
+        return False
+
+    container = containers[0]
+    labels = (container.get("Config") or {}).get("Labels") or {}
+    try:
+        launch_env = json.loads(labels.get(LAUNCH_ENV_LABEL, ""))
+    except ValueError:
+        # Launched before the label existed
+        return False
+    if not isinstance(launch_env, dict) or launch_env.get("IMAGE_TAG") != config.tag:
+        return False
+
+    return (
+        container["State"].get("Running", False)
+        and labels.get(LAUNCH_FINGERPRINT_LABEL) == get_launch_fingerprint(launch_env)
+        and container.get("Image") == images[0]["Id"]
+    )
+
+
+@internal.trace.traced
 def launch_container(config: Config) -> None:
+    """Start the container for config.tag with docker compose, unless it is
+    already running with the same compose files and image.
+
+    That check needs a single docker inspect call, so relaunching a running
+    container skips querying Docker, probing X displays, and any prompts about
+    them.
+    """
+    internal.log_archive.add_tags([config.tag])
+    if not config.refresh_host_facts and _is_container_up_to_date(config):
+        logger.info(f"Container for {config.tag} is already running")
+        return
+
     subprocess_args = [
         "docker",
         "compose",
@@ -129,37 +452,84 @@ def launch_container(config: Config) -> None:
         "--detach",
     ]
 
+    env = get_env(config)
     subprocess.run(
         subprocess_args,
-        env=get_env(config),
+        env={**os.environ, **env, **get_launch_labels_env(env)},
     )
 
 
+@internal.trace.traced
 def stop_container(config: Config) -> None:
-    subprocess_args = [
-        "docker",
-        "stop",
-        "--time",
-        "0",
-        f"{_get_container_user()}-noetic-{config.tag}-app-1",
+    internal.docker_api.stop(
+        f"{_get_container_user()}-noetic-{config.tag}-app-1", timeout=0
+    )
+
+
+def _get_dockerenv_snapshot_key() -> str:
+    """Hash everything that sourcing /.dockerenv depends on."""
+    digest = hashlib.sha256()
+
+    catkin_ws = Path.home() / "catkin_ws"
+    paths = [
+        Path("/.dockerenv"),
+        *sorted(Path("/opt/ros/noetic").glob("setup.*")),
+        *sorted((catkin_ws / "devel").glob("setup.*")),
+        # Adding or removing a package changes these directories' mtimes.
+        catkin_ws / "src",
+        Path.home() / "ut-amrl",
     ]
+    for path in paths:
+        try:
+            stat = path.stat()
+        except OSError:
+            digest.update(f"{path}:missing\0".encode())
+            continue
+
+        digest.update(f"{path}:{stat.st_mtime_ns}:{stat.st_size}\0".encode())
+        if path.is_file():
+            digest.update(path.read_bytes())
+
+    for key, value in sorted(_BASE_ENV.items()):
+        if key not in _VOLATILE_ENV_VARS:
+            digest.update(f"{key}={value}\0".encode())
+
+    return digest.hexdigest()
+
 
-    subprocess.run(subprocess_args, stdout=subprocess.DEVNULL)
+def source_dockerenv(refresh: bool = False) -> None:
+    """Grab shell environment variables after sourcing ROS-related files.
 
+    The result is cached, and only regenerated when a file that /.dockerenv
+    sources changes, or when refresh is True.
+    """
+    snapshot_file = cache_dir() / DOCKERENV_SNAPSHOT_FILE
+    key = _get_dockerenv_snapshot_key()
 
-def source_dockerenv() -> None:
-    """Grab shell environment variables after sourcing ROS-related files."""
+    snapshot = load_json(snapshot_file)
+    if not refresh and snapshot is not None and snapshot.get("key") == key:
+        os.environ.update(snapshot["env"])
+        return
 
+    # Source from the environment this process started with so that paths are
+    # not appended to twice.
     result = subprocess.run(
-        "SHELL=bash source /.dockerenv && env",
+        "SHELL=bash source /.dockerenv && env -0",
         shell=True,
         executable="/bin/bash",
+        env=_BASE_ENV,
         capture_output=True,
         text=True,
     )
-    for line in result.stdout.splitlines():
-        key, _, value = line.partition("=")
-        os.environ[key] = value
+    env = {}
+    for line in result.stdout.split("\0"):
+        name, _, value = line.partition("=")
+        if name:
+            env[name] = value
+
+    os.environ.update(env)
+    if result.returncode == 0:
+        save_json(snapshot_file, {"env": env, "key": key})
 
 
 def are_we_in_the_container() -> bool:
@@ -0,0 +1,489 @@
+"""A minimal Docker Engine API client over the daemon's unix socket.
+
+Talking to the daemon directly saves starting a docker CLI process for every
+query. The functions at the bottom of this module fall back to the docker CLI
+when the socket cannot be used, e.g. when DOCKER_HOST or a docker context
+points at a remote daemon.
+"""
+
+import contextlib
+import http.client
+import json
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import urllib.parse
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Iterator, Mapping, Optional
+
+DEFAULT_SOCKET_PATH = "/var/run/docker.sock"
+
+# Exec output without a TTY is split into frames, each with a header of the
+# stream type (1 for stdout, 2 for stderr), three zero bytes, and the size.
+_FRAME_HEADER = struct.Struct(">BxxxI")
+
+_client: "Optional[DockerClient]" = None
+_client_lock = threading.Lock()
+
+
+class DockerAPIError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(f"Docker API error {status}: {message}")
+        self.status = status
+        self.message = message
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: Optional[float] = None) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class DockerClient:
+    """Sends requests to the Docker daemon over reused connections.
+
+    Each request checks out an idle connection, or opens a new one, so requests
+    from several threads run at the same time, and a long request such as wait
+    does not hold up the others. Streamed exec output uses a connection of its
+    own, since the daemon takes over the connection for it.
+    """
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH) -> None:
+        self.socket_path = socket_path
+        self._idle_connections: "list[_UnixHTTPConnection]" = []
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        with self._lock:
+            connections = self._idle_connections
+            self._idle_connections = []
+        for connection in connections:
+            connection.close()
+
+    def _get_connection(self) -> _UnixHTTPConnection:
+        with self._lock:
+            if self._idle_connections:
+                return self._idle_connections.pop()
+        return _UnixHTTPConnection(self.socket_path)
+
+    def _put_connection(self, connection: _UnixHTTPConnection) -> None:
+        with self._lock:
+            self._idle_connections.append(connection)
+
+    def _request(
+        self,
+        method: str,
+        path: str,
+        body: "Optional[dict[str, Any]]" = None,
+        query: "Optional[dict[str, Any]]" = None,
+    ) -> "tuple[int, Any]":
+        if query:
+            path += "?" + urllib.parse.urlencode(query)
+        headers = {}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+
+        connection = self._get_connection()
+        # The daemon may have closed an idle connection, so retry once on a
+        # new connection.
+        for attempt in range(2):
+            try:
+                connection.request(method, path, payload, headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (
+                http.client.RemoteDisconnected,
+                BrokenPipeError,
+                ConnectionResetError,
+            ):
+                connection.close()
+                if attempt == 1:
+                    raise
+            except BaseException:
+                connection.close()
+                raise
+        self._put_connection(connection)
+
+        if response.status >= 400:
+            try:
+                message = json.loads(data)["message"]
+            except (ValueError, KeyError, TypeError):
+                message = data.decode(errors="replace")
+            raise DockerAPIError(response.status, message)
+
+        if response.getheader("Content-Type", "").startswith("application/json"):
+            return response.status, json.loads(data)
+        return response.status, data
+
+    def ping(self) -> None:
+        self._request("GET", "/_ping")
+
+    def info(self) -> "dict[str, Any]":
+        return self._request("GET", "/info")[1]  # type: ignore
+
+    def inspect_container(self, name: str) -> "Optional[dict[str, Any]]":
+        """Return the container's details, or None if it does not exist."""
+        try:
+            return self._request("GET", f"/containers/{_quote(name)}/json")[1]
+        except DockerAPIError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def inspect_image(self, name: str) -> "Optional[dict[str, Any]]":
+        """Return the image's details, or None if it does not exist."""
+        try:
+            return self._request("GET", f"/images/{_quote(name)}/json")[1]
+        except DockerAPIError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def exec(
+        self,
+        container: str,
+        command: "list[str]",
+        env: "Optional[Mapping[str, str]]" = None,
+        workdir: Optional[str] = None,
+        tty: bool = False,
+        stdout: Optional[BinaryIO] = None,
+        stderr: Optional[BinaryIO] = None,
+    ) -> int:
+        """Run command in container, stream its output as it is produced, and
+        return its exit code."""
+        config: "dict[str, Any]" = {
+            "AttachStdout": True,
+            "AttachStderr": True,
+            "Cmd": command,
+            "Tty": tty,
+        }
+        if env:
+            config["Env"] = [f"{name}={value}" for name, value in env.items()]
+        if workdir is not None:
+            config["WorkingDir"] = workdir
+
+        exec_id = self._request(
+            "POST", f"/containers/{_quote(container)}/exec", body=config
+        )[1]["Id"]
+
+        stdout = stdout or sys.stdout.buffer
+        stderr = stderr or sys.stderr.buffer
+        stream_connection = _UnixHTTPConnection(self.socket_path)
+        try:
+            stream_connection.request(
+                "POST",
+                f"/exec/{exec_id}/start",
+                json.dumps({"Detach": False, "Tty": tty}).encode(),
+                {"Content-Type": "application/json"},
+            )
+            response = stream_connection.getresponse()
+            if response.status >= 400:
+                raise DockerAPIError(
+                    response.status, response.read().decode(errors="replace")
+                )
+
+            if tty:
+                # Like docker exec --tty, the terminal in the container follows
+                # the size of the terminal here.
+                self._resize_exec(exec_id, stdout)
+                with _on_terminal_resize(lambda: self._resize_exec(exec_id, stdout)):
+                    _copy_raw_stream(response, stdout)
+            else:
+                _copy_multiplexed_stream(response, stdout, stderr)
+        finally:
+            stream_connection.close()
+
+        return self._request("GET", f"/exec/{exec_id}/json")[1]["ExitCode"]  # type: ignore
+
+    def _resize_exec(self, exec_id: str, output: BinaryIO) -> None:
+        """Set the size of the exec's terminal to the size of output's."""
+        try:
+            size = os.get_terminal_size(output.fileno())
+        except (OSError, ValueError, AttributeError):
+            # Not a terminal
+            return
+        try:
+            self._request(
+                "POST",
+                f"/exec/{exec_id}/resize",
+                query={"h": size.lines, "w": size.columns},
+            )
+        except (OSError, http.client.HTTPException, DockerAPIError):
+            # e.g. the process already exited
+            pass
+
+    def list_containers(self, label: str) -> "list[str]":
+        """Return the names of all containers, running or not, with label."""
+        containers = self._request(
+            "GET",
+            "/containers/json",
+            query={"all": "true", "filters": json.dumps({"label": [label]})},
+        )[1]
+        return [container["Names"][0].lstrip("/") for container in containers]
+
+    def list_images(self) -> "list[str]":
+        """Return the IDs of all images."""
+        images = self._request("GET", "/images/json")[1]
+        return [image["Id"] for image in images]
+
+    def start(self, container: str) -> None:
+        """Start container. Starting a running container does nothing."""
+        # 304 means the container was already running.
+        self._request("POST", f"/containers/{_quote(container)}/start")
+
+    def stop(self, container: str, timeout: int = 10) -> None:
+        """Stop container. Stopping a stopped container does nothing."""
+        # 304 means the container was already stopped.
+        self._request(
+            "POST", f"/containers/{_quote(container)}/stop", query={"t": timeout}
+        )
+
+    def wait(self, container: str) -> int:
+        """Wait until container stops and return its exit code."""
+        result = self._request(
+            "POST",
+            f"/containers/{_quote(container)}/wait",
+            query={"condition": "not-running"},
+        )[1]
+        return result["StatusCode"]  # type: ignore
+
+
+def _quote(name: str) -> str:
+    return urllib.parse.quote(name, safe="")
+
+
+@contextlib.contextmanager
+def _on_terminal_resize(callback: "Callable[[], None]") -> "Iterator[None]":
+    """Call callback in a new thread whenever the terminal is resized, so that
+    it does not run inside the signal handler."""
+    if threading.current_thread() is not threading.main_thread():
+        # Signal handlers can only be set from the main thread.
+        yield
+        return
+
+    def handle_resize(signum: int, frame: Any) -> None:
+        threading.Thread(target=callback, daemon=True).start()
+
+    previous_handler = signal.signal(signal.SIGWINCH, handle_resize)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGWINCH, previous_handler)
+
+
+def _copy_raw_stream(response: http.client.HTTPResponse, output: BinaryIO) -> None:
+    while True:
+        chunk = response.read1(64 * 1024)
+        if not chunk:
+            break
+        output.write(chunk)
+        output.flush()
+
+
+def _copy_multiplexed_stream(
+    response: http.client.HTTPResponse, stdout: BinaryIO, stderr: BinaryIO
+) -> None:
+    while True:
+        header = response.read(_FRAME_HEADER.size)
+        if len(header) < _FRAME_HEADER.size:
+            break
+        stream_type, size = _FRAME_HEADER.unpack(header)
+        output = stderr if stream_type == 2 else stdout
+        output.write(response.read(size))
+        output.flush()
+
+
+def _get_socket_path() -> Optional[str]:
+    """Return the local daemon's socket, or None if the docker CLI may be
+    configured to talk to another daemon."""
+    if os.environ.get("DOCKER_CONTEXT", "default") != "default":
+        return None
+
+    docker_host = os.environ.get("DOCKER_HOST", f"unix://{DEFAULT_SOCKET_PATH}")
+    if not docker_host.startswith("unix://"):
+        return None
+
+    docker_config_dir = os.environ.get("DOCKER_CONFIG") or Path.home() / ".docker"
+    try:
+        with open(Path(docker_config_dir) / "config.json") as f:
+            docker_config = json.load(f)
+        if docker_config.get("currentContext", "default") != "default":
+            return None
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    return docker_host[len("unix://") :]
+
+
+def get_client() -> Optional[DockerClient]:
+    """Return a client for the local Docker daemon, or None if the docker CLI
+    should be used instead."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            return _client
+
+        socket_path = _get_socket_path()
+        if socket_path is None:
+            return None
+
+        client = DockerClient(socket_path)
+        try:
+            client.ping()
+        except (OSError, http.client.HTTPException, DockerAPIError):
+            client.close()
+            return None
+
+        _client = client
+        return _client
+
+
+def info() -> "dict[str, Any]":
+    client = get_client()
+    if client is not None:
+        return client.info()
+
+    # https://docs.docker.com/engine/reference/commandline/info/#format-the-output
+    result = subprocess.run(
+        ["docker", "info", "--format={{json .}}"], stdout=subprocess.PIPE, text=True
+    )
+    return json.loads(result.stdout)  # type: ignore
+
+
+def inspect(
+    names: "list[str]", object_type: Optional[str] = None
+) -> "list[dict[str, Any]]":
+    """Return the details of each container or image in names that exists,
+    like docker inspect. object_type is "container", "image", or None for
+    either."""
+    client = get_client()
+    if client is not None:
+        objects = []
+        for name in names:
+            obj = None
+            if object_type in [None, "container"]:
+                obj = client.inspect_container(name)
+            if obj is None and object_type in [None, "image"]:
+                obj = client.inspect_image(name)
+            if obj is not None:
+                objects.append(obj)
+        return objects
+
+    type_args = [f"--type={object_type}"] if object_type is not None else []
+    # docker inspect still prints the objects it finds if some are missing,
+    # but exits with an error.
+    result = subprocess.run(
+        ["docker", "inspect", *type_args, *names], capture_output=True, text=True
+    )
+    try:
+        return json.loads(result.stdout)  # type: ignore
+    except ValueError:
+        return []
+
+
+def exec_in_container(
+    container: str,
+    command: "list[str]",
+    env: "Optional[Mapping[str, str]]" = None,
+    workdir: Optional[str] = None,
+    tty: bool = False,
+) -> int:
+    client = get_client()
+    if client is not None:
+        return client.exec(container, command, env=env, workdir=workdir, tty=tty)
+
+    args = ["docker", "exec"]
+    if tty:
+        args.append("--tty")
+    for name, value in (env or {}).items():
+        args += ["--env", f"{name}={value}"]
+    if workdir is not None:
+        args += ["--workdir", workdir]
+    return subprocess.run([*args, container, *command]).returncode
+
+
+def list_containers(label: str) -> "list[str]":
+    client = get_client()
+    if client is not None:
+        return client.list_containers(label)
+
+    result = subprocess.run(
+        ["docker", "ps", "--all", "--filter", f"label={label}", "--format={{.Names}}"],
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.split()
+
+
+def list_images() -> "list[str]":
+    client = get_client()
+    if client is not None:
+        return client.list_images()
+
+    result = subprocess.run(
+        ["docker", "image", "ls", "--quiet", "--no-trunc"],
+        capture_output=True,
+        text=True,
+    )
+    # Images with several tags are listed once for each tag.
+    return list(dict.fromkeys(result.stdout.split()))
+
+
+def start(container: str) -> None:
+    client = get_client()
+    if client is not None:
+        client.start(container)
+        return
+
+    result = subprocess.run(
+        ["docker", "start", container], capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip())
+
+
+def stop(container: str, timeout: int = 10) -> None:
+    client = get_client()
+    if client is not None:
+        try:
+            client.stop(container, timeout=timeout)
+        except DockerAPIError as e:
+            if e.status != 404:
+                raise
+        return
+
+    subprocess.run(
+        ["docker", "stop", "--time", str(timeout), container],
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def wait(container: str) -> int:
+    client = get_client()
+    if client is not None:
+        return client.wait(container)
+
+    result = subprocess.run(
+        ["docker", "wait", container], capture_output=True, text=True
+    )
+    try:
+        return int(result.stdout.strip())
+    except ValueError:
+        return result.returncode
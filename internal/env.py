@@ -1,17 +1,35 @@
 #! /usr/bin/env python3
 
+import asyncio
 import getpass
-import json
 import os
 import platform
 import shutil
 import subprocess
+import time
 from pathlib import Path
-from typing import Any
+from typing import Any, Optional
 
 import internal.ansi as ansi
+import internal.docker_api
+import internal.tasks
 from internal import logger
+from internal.cache import cache_dir, load_json, save_json
 from internal.config import Config
+from internal.log_utils import flush_logs
+
+# Maps each host name to the X display device found on the last launch. The
+# cache lives in the user's home directory, so it is also per user.
+X_DISPLAY_CACHE_FILE = "x_display.json"
+MAX_X_DISPLAY_PROBES = 16
+
+SKIP_INDICATOR_FILE = Path("internal/.skip_get_x_display_device")
+
+# Maps each host name to facts that are expensive to query on every call, such
+# as the output of "docker info".
+HOST_FACTS_CACHE_FILE = "host_facts.json"
+HOST_FACTS_TTL_SECONDS = 24 * 60 * 60
+_host_facts: "Optional[dict[str, Any]]" = None
 
 
 def _get_container_user() -> str:
@@ -26,20 +44,152 @@ def _get_container_host() -> str:
     return platform.node()
 
 
-def _get_container_runtime() -> str:
-    # https://docs.docker.com/engine/reference/commandline/info/#format-the-output
-    subprocess_args = ["docker", "info", "--format={{json .}}"]
+def _get_docker_daemon_id() -> str:
+    """Return a value that changes whenever the Docker daemon restarts.
+
+    The daemon recreates its unix socket on startup, so the socket's inode and
+    change time identify the running daemon without talking to it.
+    """
+    docker_host = os.environ.get("DOCKER_HOST", "unix:///var/run/docker.sock")
+    if not docker_host.startswith("unix://"):
+        return ""
+
+    try:
+        stat = os.stat(docker_host[len("unix://") :])
+    except OSError:
+        return ""
+
+    return f"{stat.st_ino}-{stat.st_ctime_ns}"
+
+
+def _query_host_facts() -> "dict[str, Any]":
+    info = internal.docker_api.info()
+
+    return {
+        "runtimes": sorted(info["Runtimes"].keys()),
+        "default_runtime": info["DefaultRuntime"],
+        "host": _get_container_host(),
+        "uid": _get_container_uid(),
+    }
+
+
+def _get_host_facts(refresh: bool = False) -> "dict[str, Any]":
+    """Return host facts that rarely change, such as the Docker runtimes.
+
+    Facts are cached per host for HOST_FACTS_TTL_SECONDS, or until the Docker
+    daemon restarts, and are only read once per process.
+    """
+    global _host_facts
+    if _host_facts is not None:
+        return _host_facts
+
+    cache_file = cache_dir() / HOST_FACTS_CACHE_FILE
+    cached_facts: "dict[str, Any]" = load_json(cache_file, default={})
+    host = _get_container_host()
+    daemon_id = _get_docker_daemon_id()
+
+    entry = cached_facts.get(host)
+    if (
+        not refresh
+        and entry is not None
+        and entry.get("daemon_id") == daemon_id
+        and time.time() - entry.get("timestamp", 0) < HOST_FACTS_TTL_SECONDS
+    ):
+        _host_facts = entry["facts"]
+        return _host_facts  # type: ignore
+
+    _host_facts = _query_host_facts()
+    cached_facts[host] = {
+        "daemon_id": daemon_id,
+        "facts": _host_facts,
+        "timestamp": time.time(),
+    }
+    save_json(cache_file, cached_facts)
 
-    result = subprocess.run(subprocess_args, stdout=subprocess.PIPE, text=True)
-    info: "dict[str, Any]" = json.loads(result.stdout)
+    return _host_facts
 
-    if "nvidia" in info["Runtimes"].keys():
+
+def _get_container_runtime(host_facts: "dict[str, Any]") -> str:
+    if "nvidia" in host_facts["runtimes"]:
         return "nvidia"
     else:
-        return info["DefaultRuntime"]  # type: ignore
+        return host_facts["default_runtime"]  # type: ignore
+
+
+async def _probe_x_display_device(display_device: str) -> bool:
+    try:
+        returncode, _, _ = await internal.tasks.run_subprocess(
+            ["glxinfo", "-display", display_device],
+            timeout=0.5,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return returncode == 0
+    except asyncio.TimeoutError:
+        return False
+
 
+async def _probe_x_display_devices(candidates: "list[str]") -> str:
+    """Return the earliest candidate in the list that passes a probe, or "" if
+    none do. Later candidates are probed at the same time, but a result is only
+    returned once every earlier candidate has failed."""
+    semaphore = asyncio.Semaphore(MAX_X_DISPLAY_PROBES)
 
-def _get_x_display_device() -> str:
+    async def probe(candidate: str) -> str:
+        async with semaphore:
+            return candidate if await _probe_x_display_device(candidate) else ""
+
+    probes = [asyncio.ensure_future(probe(candidate)) for candidate in candidates]
+    try:
+        for next_probe in probes:
+            display_device = await next_probe
+            if display_device:
+                return display_device
+        return ""
+    finally:
+        # Kills the glxinfo processes that are still running.
+        for future in probes:
+            future.cancel()
+        await asyncio.gather(*probes, return_exceptions=True)
+
+
+def _find_x_display_device() -> str:
+    """Return the first usable X display device, or "" if there isn't one.
+
+    The display device found on the previous launch is checked first, so a
+    typical launch costs a single glxinfo call. Otherwise, displays :0 through
+    :99 are probed concurrently since each unusable display can take up to the
+    full glxinfo timeout.
+    """
+    cache_file = cache_dir() / X_DISPLAY_CACHE_FILE
+    cached_displays: "dict[str, str]" = load_json(cache_file, default={})
+    host = _get_container_host()
+
+    cached_display = cached_displays.get(host, "")
+    if cached_display and asyncio.run(_probe_x_display_device(cached_display)):
+        return cached_display
+
+    candidates = [f":{n}" for n in range(100) if f":{n}" != cached_display]
+    display_device = asyncio.run(_probe_x_display_devices(candidates))
+
+    if display_device != cached_display:
+        if display_device:
+            cached_displays[host] = display_device
+        else:
+            cached_displays.pop(host, None)
+        save_json(cache_file, cached_displays)
+
+    return display_device
+
+
+def _can_probe_x_display_devices() -> bool:
+    return not SKIP_INDICATOR_FILE.exists() and shutil.which("glxinfo") is not None
+
+
+def _get_x_display_device(display_device: Optional[str] = None) -> str:
+    """Return the X display device to use, asking the user what to do if there
+    is none. display_device is the result of _find_x_display_device, if it
+    already ran."""
     # Sometimes an X display device can be opened, but applications cannot use
     # it. If this display device is used inside the Docker container, k4a_ros
     # will launch without printing any errors, but no messages will be
@@ -52,12 +202,9 @@ def _get_x_display_device() -> str:
     # "xdpyinfo" is an alternative command from the x11-utils package that is
     # generally already installed with the system, but it is unable to detect
     # this case.
-    display_device = ""
-
-    SKIP_INDICATOR_FILE = Path("internal/.skip_get_x_display_device")
     if SKIP_INDICATOR_FILE.exists():
         logger.info("Skipping DISPLAY check.")
-        return display_device
+        return ""
 
     if shutil.which("glxinfo") is None:
         logger.warning(
@@ -81,30 +228,17 @@ def _get_x_display_device() -> str:
 """
         )
 
+        flush_logs()
         ignore_warning = input("Ignore this warning? [YES/ALWAYS/NO]: ").strip().lower()
         if ignore_warning.startswith("a"):
             SKIP_INDICATOR_FILE.touch(exist_ok=True)
-            return display_device
+            return ""
         elif ignore_warning.startswith("y"):
-            return display_device
+            return ""
         else:
             raise FileNotFoundError("glxinfo")
-    else:
-        for display_num in range(100):
-            subprocess_args = ["glxinfo", "-display", f":{display_num}"]
-
-            try:
-                result = subprocess.run(
-                    subprocess_args,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    timeout=0.5,
-                )
-                if result.returncode == 0:
-                    display_device = subprocess_args[2]
-                    break
-            except subprocess.TimeoutExpired:
-                pass
+    elif display_device is None:
+        display_device = _find_x_display_device()
 
     if display_device == "":
         logger.warn(
@@ -132,6 +266,7 @@ def _get_x_display_device() -> str:
 """
         )
 
+        flush_logs()
         ignore_warning = input("Ignore this warning? [YES/ALWAYS/NO]: ").strip().lower()
         if ignore_warning.startswith("a"):
             SKIP_INDICATOR_FILE.touch(exist_ok=True)
@@ -145,20 +280,34 @@ def _get_x_display_device() -> str:
 
 
 def get_env(config: Config) -> "dict[str, str]":
+    # Querying Docker and probing X displays are independent and both can take
+    # a while, so they run concurrently. Asking the user what to do without an
+    # X display happens afterwards, on the main thread.
+    tasks = [
+        internal.tasks.Task(
+            "host facts", lambda: _get_host_facts(refresh=config.refresh_host_facts)
+        )
+    ]
+    if config._require_x_display and _can_probe_x_display_devices():
+        tasks.append(internal.tasks.Task("X display", _find_x_display_device))
+    results = internal.tasks.run_tasks(tasks)
+    host_facts = results["host facts"]
+
     env = {
-        "CONTAINER_HOST": _get_container_host(),
-        "CONTAINER_RUNTIME": _get_container_runtime(),
-        "CONTAINER_UID": _get_container_uid(),
+        "CONTAINER_HOST": host_facts["host"],
+        "CONTAINER_RUNTIME": _get_container_runtime(host_facts),
+        "CONTAINER_UID": host_facts["uid"],
         "CONTAINER_USER": _get_container_user(),
         "DOCKER_SCAN_SUGGEST": "false",
-        # "IMAGE_TAG" must be overridden in each Makefile for hierarchical builds
+        # "IMAGE_TAG" must be overridden for each image in hierarchical builds
         "IMAGE_TAG": config.tag,
     }
 
-    if config._require_x_display:
-        env["DISPLAY"] = _get_x_display_device()
-    else:
-        env["DISPLAY"] = ""
+    env["DISPLAY"] = (
+        _get_x_display_device(results.get("X display"))
+        if config._require_x_display
+        else ""
+    )
 
     return env
 
@@ -1,13 +1,19 @@
+import contextlib
+import dataclasses
 import enum
+import fcntl
 import os
+import shutil
 import subprocess
 import sys
+import threading
 import time
 from pathlib import Path
-from typing import NoReturn, Union
+from typing import Iterator, NoReturn, Optional, Union
 
 import internal.ansi as ansi
 from internal import logger
+from internal.log_utils import flush_logs
 
 
 class GitHubProtocol(enum.Enum):
@@ -56,11 +62,14 @@ def check_github_ssh_auth() -> Union[bool, NoReturn]:
         sys.exit(1)
 
 
-def get_user_protocol_preference() -> GitHubProtocol:
+def ask_user_protocol_preference() -> GitHubProtocol:
+    """Ask the user which protocol to clone with, without checking that it
+    works."""
     # If the user has a Personal Access Token set up then they'll have
     # [public+private] and [pull+push] via HTTPS as well, but this is too much
     # information to put in a simple prompt. If the user has a PAT set up,
     # they'll probably know this information anyway.
+    flush_logs()
     print(
         f"""How would you like to clone repositories from GitHub?
 
@@ -84,6 +93,11 @@ def get_user_protocol_preference() -> GitHubProtocol:
         logger.warning(f"Unrecognized input '{user_input}'. Falling back to HTTPS.")
         protocol = GitHubProtocol.HTTPS
 
+    return protocol
+
+
+def get_user_protocol_preference() -> GitHubProtocol:
+    protocol = ask_user_protocol_preference()
     if protocol == GitHubProtocol.SSH:
         check_github_ssh_auth()
 
@@ -111,26 +125,209 @@ def _critical_git_failure() -> NoReturn:
     sys.exit(1)
 
 
-def clone_repository(url: str, dest: Path, protocol: GitHubProtocol) -> None:
+def has_ssh_agent() -> bool:
+    """Return whether an ssh-agent with at least one key is available, in which
+    case git will not prompt for an SSH key password."""
+    if not os.environ.get("SSH_AUTH_SOCK"):
+        return False
+
+    result = subprocess.run(
+        ["ssh-add", "-l"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return result.returncode == 0
+
+
+def can_clone_in_parallel(protocol: GitHubProtocol) -> bool:
+    # Concurrent clones would interleave SSH key password prompts.
+    return protocol == GitHubProtocol.HTTPS or has_ssh_agent()
+
+
+def _run_git(subprocess_args: "list[str]", quiet: bool, **kwargs) -> None:
+    """Run a git command, raising CalledProcessError on failure.
+
+    If quiet is True, the output is only printed if the command fails so that
+    concurrent git commands do not interleave their output.
+    """
+    if not quiet:
+        subprocess.run(subprocess_args, check=True, **kwargs)
+        return
+
+    result = subprocess.run(
+        subprocess_args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        **kwargs,
+    )
+    if result.returncode != 0:
+        print(result.stdout, end="")
+        result.check_returncode()
+
+
+def _get_mirror_path(url: str, mirror_dir: Path) -> Path:
+    # Mirrors are keyed on the repository path so that users who clone with
+    # SSH and users who clone with HTTPS share the same mirror.
+    path = url[url.index("github.com") + len("github.com") + 1 :]
+    if path.endswith(".git"):
+        path = path[: -len(".git")]
+    return mirror_dir / "github.com" / f"{path}.git"
+
+
+def _make_shared_dirs(path: Path) -> None:
+    """Create path so that every member of its group can add mirrors to it."""
+    for parent in reversed([path, *path.parents]):
+        if parent.exists():
+            continue
+        parent.mkdir()
+        try:
+            # setgid makes new entries inherit the directory's group.
+            os.chmod(parent, 0o2775)
+        except OSError:
+            pass
+
+
+@contextlib.contextmanager
+def _lock_mirror(mirror_path: Path) -> Iterator[None]:
+    # Other users may own the lock file, and flock works on read-only file
+    # descriptors.
+    lock_path = mirror_path.with_name(mirror_path.name + ".lock")
+    fd = os.open(lock_path, os.O_RDONLY | os.O_CREAT, 0o664)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def update_mirror(
+    url: str, mirror_dir: Path, protocol: GitHubProtocol, quiet: bool = False
+) -> Optional[Path]:
+    """Create or incrementally refresh a host-wide bare mirror of url.
+
+    Returns the mirror path, or None if no mirror is available. A stale mirror
+    is still returned if it cannot be refreshed, e.g. when offline.
+    """
     url = convert_url_protocol(url, protocol)
+    mirror_path = _get_mirror_path(url, mirror_dir)
+    _make_shared_dirs(mirror_path.parent)
 
-    subprocess_args = [
+    # Only mirror branches and tags, since GitHub also advertises every pull
+    # request under refs/pull.
+    fetch_args = [
         "git",
-        "clone",
+        "--git-dir",
+        str(mirror_path),
+        "fetch",
+        "--prune",
         url,
-        str(dest.absolute()),
+        "+refs/heads/*:refs/heads/*",
+        "+refs/tags/*:refs/tags/*",
     ]
 
+    with _lock_mirror(mirror_path):
+        if (mirror_path / "HEAD").exists():
+            try:
+                _run_git(fetch_args, quiet)
+            except subprocess.CalledProcessError:
+                logger.warning(
+                    f"Unable to refresh the mirror of {url}. Using it as is."
+                )
+            return mirror_path
+
+        try:
+            _run_git(
+                ["git", "init", "--bare", "--shared=group", str(mirror_path)], quiet
+            )
+            # User clones borrow objects from the mirror through alternates, so
+            # the mirror must never delete objects.
+            for key, value in [("gc.auto", "0"), ("gc.pruneExpire", "never")]:
+                _run_git(
+                    ["git", "--git-dir", str(mirror_path), "config", key, value],
+                    quiet,
+                )
+            _run_git(fetch_args, quiet)
+
+            result = subprocess.run(
+                ["git", "ls-remote", "--symref", url, "HEAD"],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            for line in result.stdout.splitlines():
+                if line.startswith("ref: "):
+                    default_ref = line[len("ref: ") :].split()[0]
+                    _run_git(
+                        [
+                            "git",
+                            "--git-dir",
+                            str(mirror_path),
+                            "symbolic-ref",
+                            "HEAD",
+                            default_ref,
+                        ],
+                        quiet,
+                    )
+        except subprocess.CalledProcessError:
+            logger.warning(f"Unable to mirror {url}. Cloning without the mirror.")
+            shutil.rmtree(mirror_path, ignore_errors=True)
+            return None
+
+    return mirror_path
+
+
+def clone_repository(
+    url: str,
+    dest: Path,
+    protocol: GitHubProtocol,
+    quiet: bool = False,
+    mirror_dir: Optional[Path] = None,
+) -> None:
+    mirror_path = None
+    if mirror_dir is not None:
+        mirror_path = update_mirror(url, mirror_dir, protocol, quiet=quiet)
+
+    url = convert_url_protocol(url, protocol)
+
+    if mirror_path is None:
+        subprocess_args = [
+            "git",
+            "clone",
+            url,
+            str(dest.absolute()),
+        ]
+    else:
+        # Cloning from the local mirror works offline, and git hardlinks the
+        # mirror's objects where it can instead of copying them. The clone
+        # must not borrow objects through alternates (--shared or
+        # --reference), since the mirror is not mounted in the container. The
+        # mirror was just refreshed, so origin only needs to point back at
+        # GitHub.
+        subprocess_args = [
+            "git",
+            "clone",
+            str(mirror_path),
+            str(dest.absolute()),
+        ]
+
     try:
-        subprocess.run(subprocess_args, check=True)
+        _run_git(subprocess_args, quiet)
+        if mirror_path is not None:
+            _run_git(["git", "remote", "set-url", "origin", url], quiet, cwd=dest)
     except subprocess.CalledProcessError:
         logger.error(f"Unable to clone {url} to {dest}")
         _critical_git_failure()
 
 
-def update_submodules(repo_dir: Path) -> None:
-    # Do not parallelize with --jobs since the user may need to enter an ssh key password
-    # TODO: if the user has an ssh-agent, then go ahead and parallelize
+# Held while updating submodules without --jobs so that at most one git process
+# can prompt for an ssh key password at a time.
+_serial_submodule_lock = threading.Lock()
+
+
+def update_submodules(repo_dir: Path, jobs: int = 1, quiet: bool = False) -> None:
+    # Only parallelize with --jobs if the user has an ssh-agent, since the user
+    # may otherwise need to enter an ssh key password for each submodule.
     subprocess_args = [
         "git",
         "submodule",
@@ -139,9 +336,15 @@ def update_submodules(repo_dir: Path) -> None:
         "--recursive",
         "--progress",
     ]
+    if jobs > 1:
+        subprocess_args += ["--jobs", str(jobs)]
 
     try:
-        subprocess.run(subprocess_args, cwd=repo_dir, check=True)
+        if jobs > 1:
+            _run_git(subprocess_args, quiet, cwd=repo_dir)
+        else:
+            with _serial_submodule_lock:
+                _run_git(subprocess_args, quiet, cwd=repo_dir)
     except subprocess.CalledProcessError:
         logger.error(f"Unable to update submodules for {repo_dir}")
         _critical_git_failure()
@@ -185,3 +388,121 @@ def get_repository_root(repo_dir_or_file: Union[str, Path]) -> str:
     )
 
     return result.stdout.strip()
+
+
+def get_remote_url(repo_dir: Path) -> str:
+    result = subprocess.run(
+        ["git", "remote", "get-url", "origin"],
+        capture_output=True,
+        text=True,
+        cwd=repo_dir,
+    )
+    return result.stdout.strip()
+
+
+@dataclasses.dataclass
+class RepositoryStatus:
+    path: Path
+    branch: str = ""
+    ahead: int = 0
+    behind: int = 0
+    dirty: bool = False
+    # What sync_repository did, e.g. "fast-forwarded" or "fetch failed"
+    result: str = ""
+    failed: bool = False
+
+
+def _get_upstream_counts(repo_dir: Path) -> "Optional[tuple[int, int]]":
+    """Return how many commits HEAD is ahead of and behind its upstream
+    branch, or None if it has no upstream branch."""
+    result = subprocess.run(
+        ["git", "rev-list", "--left-right", "--count", "HEAD...@{upstream}"],
+        capture_output=True,
+        text=True,
+        cwd=repo_dir,
+    )
+    if result.returncode != 0:
+        return None
+    ahead, behind = result.stdout.split()
+    return int(ahead), int(behind)
+
+
+def sync_repository(repo_dir: Path, submodule_jobs: int = 1) -> RepositoryStatus:
+    """Fetch a cloned repository, fast-forward its branch if it has no local
+    commits, and update its submodules.
+
+    Failures are recorded in the returned status instead of exiting, so that
+    one repository does not stop the others.
+    """
+    status = RepositoryStatus(repo_dir)
+    if not (repo_dir / ".git").exists():
+        status.result = "not cloned"
+        return status
+
+    result = subprocess.run(
+        ["git", "rev-parse", "--abbrev-ref", "HEAD"],
+        capture_output=True,
+        text=True,
+        cwd=repo_dir,
+    )
+    status.branch = result.stdout.strip()
+
+    try:
+        _run_git(["git", "fetch", "--quiet", "--prune", "origin"], True, cwd=repo_dir)
+    except subprocess.CalledProcessError:
+        status.result = "fetch failed"
+        status.failed = True
+
+    counts = _get_upstream_counts(repo_dir)
+    if status.failed:
+        pass
+    elif counts is None:
+        status.result = "no upstream branch"
+    elif counts[1] == 0:
+        status.result = "up to date"
+    elif counts[0] > 0:
+        status.result = "diverged"
+    else:
+        try:
+            # git refuses to fast-forward over conflicting local changes.
+            _run_git(
+                ["git", "merge", "--ff-only", "--quiet", "@{upstream}"],
+                True,
+                cwd=repo_dir,
+            )
+            status.result = "fast-forwarded"
+        except subprocess.CalledProcessError:
+            status.result = "update failed"
+            status.failed = True
+        counts = _get_upstream_counts(repo_dir)
+
+    # Also repairs missing or stale submodules in repositories that did not
+    # move.
+    if not status.failed and (repo_dir / ".gitmodules").exists():
+        submodule_args = ["git", "submodule", "update", "--init", "--recursive"]
+        try:
+            if submodule_jobs > 1:
+                _run_git(
+                    [*submodule_args, "--jobs", str(submodule_jobs)],
+                    True,
+                    cwd=repo_dir,
+                )
+            else:
+                with _serial_submodule_lock:
+                    _run_git(submodule_args, True, cwd=repo_dir)
+        except subprocess.CalledProcessError:
+            status.result = "submodule update failed"
+            status.failed = True
+
+    if counts is not None:
+        status.ahead, status.behind = counts
+
+    result = subprocess.run(
+        ["git", "status", "--porcelain"],
+        capture_output=True,
+        text=True,
+        cwd=repo_dir,
+    )
+    status.dirty = result.stdout.strip() != ""
+
+    return status
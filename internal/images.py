@@ -0,0 +1,314 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import shlex
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import internal.capture
+import internal.docker_api
+import internal.package_cache
+import internal.trace
+from internal import logger
+from internal.config import Config, available_tags, get_parent_tag
+from internal.env import get_env
+from internal.profile import BuildProfiler
+
+NOETIC_DIR = Path(__file__).parent.parent / "noetic"
+
+# Set on each image through the build labels in compose.shared.yaml.
+FINGERPRINT_LABEL = "com.github.ut-amrl.ros-noetic-docker.build-fingerprint"
+
+# Must match the build args in compose.shared.yaml, except for the package
+# cache's, which do not change what is built.
+IMAGE_BUILD_ARGS = ["CONTAINER_UID", "CONTAINER_USER"]
+
+# Held while dumping output so that concurrent failures do not interleave.
+_dump_lock = threading.Lock()
+
+
+def get_image_graph(tags: "list[str]") -> "dict[str, Optional[str]]":
+    """Map tags and all of their ancestors to their parent tags."""
+    parents: "dict[str, Optional[str]]" = {}
+
+    to_visit = list(tags)
+    while to_visit:
+        tag = to_visit.pop()
+        if tag in parents:
+            continue
+
+        parent = get_parent_tag(tag)
+        if parent is not None and parent not in available_tags():
+            # Maybe built elsewhere, so treat it like an external base image.
+            parent = None
+        parents[tag] = parent
+
+        if parent is not None:
+            to_visit.append(parent)
+
+    return parents
+
+
+def _get_copied_paths(dockerfile: Path) -> "list[str]":
+    """Return the build context paths that a Dockerfile's COPY and ADD
+    instructions read."""
+    # Join continuation lines so that each instruction is on one line.
+    text = re.sub(r"\\\n", " ", dockerfile.read_text())
+
+    paths = []
+    for line in text.splitlines():
+        instruction, _, arguments = line.strip().partition(" ")
+        if instruction.upper() not in ["ADD", "COPY"]:
+            continue
+
+        arguments = arguments.strip()
+        if arguments.startswith("["):
+            args = json.loads(arguments)
+        else:
+            args = shlex.split(arguments)
+
+        flags = [arg for arg in args if arg.startswith("--")]
+        if any(flag.startswith("--from") for flag in flags):
+            # Copied from another image, not the build context
+            continue
+
+        sources = [arg for arg in args if not arg.startswith("--")][:-1]
+        paths += [src for src in sources if "://" not in src]
+
+    return paths
+
+
+def _hash_build_context_path(digest: "hashlib._Hash", path: str) -> None:
+    # Docker resolves sources inside the build context, even with "..".
+    path = os.path.normpath(path)
+    while path.startswith("../"):
+        path = path[len("../") :]
+
+    for match in sorted(NOETIC_DIR.glob(path)):
+        files = [match] if match.is_file() else sorted(match.rglob("*"))
+        for file in files:
+            if file.is_file():
+                digest.update(f"{file.relative_to(NOETIC_DIR)}\0".encode())
+                digest.update(f"{file.stat().st_mode}\0".encode())
+                digest.update(file.read_bytes())
+
+
+def get_image_fingerprint(tag: str, env: "dict[str, str]", parent_id: str) -> str:
+    """Hash everything that goes into building tag's image: its Dockerfile,
+    the files it copies, its build args, and its parent image."""
+    dockerfile = NOETIC_DIR / tag / "Dockerfile"
+
+    digest = hashlib.sha256(dockerfile.read_bytes())
+    for path in _get_copied_paths(dockerfile):
+        _hash_build_context_path(digest, path)
+    for build_arg in IMAGE_BUILD_ARGS:
+        digest.update(f"{build_arg}={env.get(build_arg, '')}\0".encode())
+    digest.update(parent_id.encode())
+
+    return digest.hexdigest()
+
+
+def _inspect_images(
+    tags: "list[str]", env: "dict[str, str]"
+) -> "dict[str, dict[str, str]]":
+    """Return the ID and build fingerprint of each tag's image that exists."""
+    image_names = [f"{env['CONTAINER_USER']}-noetic:{tag}" for tag in tags]
+
+    images = internal.docker_api.inspect(image_names, object_type="image")
+
+    image_info = {}
+    for image in images:
+        labels = (image.get("Config") or {}).get("Labels") or {}
+        for tag, image_name in zip(tags, image_names):
+            if image_name in (image.get("RepoTags") or []):
+                image_info[tag] = {
+                    "id": image["Id"],
+                    "fingerprint": labels.get(FINGERPRINT_LABEL, ""),
+                }
+
+    return image_info
+
+
+def _build_image(
+    tag: str,
+    env: "dict[str, str]",
+    fingerprint: str,
+    quiet: bool,
+    profiler: Optional[BuildProfiler] = None,
+) -> bool:
+    logger.info(f"Building image {tag}")
+    t_start = time.time()
+
+    env = {
+        # The package cache's build args must not come from the user's own
+        # proxy settings.
+        **{
+            name: value
+            for name, value in os.environ.items()
+            if name not in internal.package_cache.BUILD_ARGS
+        },
+        **env,
+        "BUILD_FINGERPRINT": fingerprint,
+        "DOCKER_BUILDKIT": "1",
+        "IMAGE_TAG": tag,
+    }
+
+    if quiet or profiler is not None:
+        command = ["docker", "compose", "build"]
+        if profiler is not None:
+            # Step timings are only printed in plain progress output, and
+            # steps taken from the build cache take no time.
+            command = [
+                "docker",
+                "compose",
+                "--progress",
+                "plain",
+                "build",
+                "--no-cache",
+            ]
+
+        process = subprocess.Popen(
+            command,
+            cwd=NOETIC_DIR / tag,
+            env=env,
+            stderr=subprocess.STDOUT,
+            stdout=subprocess.PIPE,
+        )
+        # Builds for several users can run at once, e.g. from admin.py, and
+        # each needs its own log file.
+        capture = internal.capture.OutputCapture(
+            f"image-{env['CONTAINER_USER']}-{tag}", live_tail=not quiet
+        )
+        if profiler is not None:
+            capture.add_line_handler(profiler.get_line_handler(tag))
+        if capture.capture(process) != 0:
+            with _dump_lock:
+                capture.dump()
+                logger.error(f"Failed to build image {tag}")
+                logger.error(f"Full output saved to {capture.log_path}")
+            return False
+    else:
+        result = subprocess.run(
+            ["docker", "compose", "build"], cwd=NOETIC_DIR / tag, env=env
+        )
+        if result.returncode != 0:
+            logger.error(f"Failed to build image {tag}")
+            return False
+
+    logger.success(f"Built image {tag} in {time.time() - t_start:.1f} s")
+    return True
+
+
+@internal.trace.traced
+def build_images(
+    config: Config,
+    tags: "list[str]",
+    env: "Optional[dict[str, str]]" = None,
+    quiet: Optional[bool] = None,
+) -> bool:
+    """Build tags and the images they build on, in dependency order.
+
+    Each image is built once, and images that share a parent are built
+    concurrently. An image is skipped if the fingerprint label on the existing
+    image matches its build context, unless config.force or config.profile is
+    set. Returns whether every image is up to date.
+
+    env defaults to the calling user's environment. Build output is shown
+    unless quiet is set, or by default, unless images build concurrently.
+    """
+    parents = get_image_graph(tags)
+
+    if quiet is None:
+        # Concurrent builds cannot share the terminal, so only show build
+        # output if at most one image can build at a time.
+        sibling_counts: "dict[Optional[str], int]" = {}
+        for parent in parents.values():
+            sibling_counts[parent] = sibling_counts.get(parent, 0) + 1
+        quiet = max(sibling_counts.values()) > 1
+
+    if env is None:
+        env = get_env(config)
+    image_info = _inspect_images(list(parents), env)
+    profiler = BuildProfiler() if config.profile else None
+
+    package_cache_port = None
+    if config.package_cache:
+        package_cache_port = internal.package_cache.start(config.package_cache_size)
+    if package_cache_port is not None:
+        env = {**env, **internal.package_cache.get_build_env(package_cache_port)}
+        package_cache_status = internal.package_cache.get_status(package_cache_port)
+
+    pending = sorted(parents)
+    built: "set[str]" = set()
+    failed = False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(parents)) as executor:
+        running: "dict[concurrent.futures.Future[bool], str]" = {}
+
+        while pending or running:
+            # Skipped images may make more images ready, so keep looking until
+            # no more images can start.
+            while not failed:
+                ready = [
+                    tag
+                    for tag in pending
+                    if parents[tag] is None or parents[tag] in built
+                ]
+                if not ready:
+                    break
+
+                for tag in ready:
+                    pending.remove(tag)
+
+                    parent = parents[tag]
+                    parent_id = image_info[parent]["id"] if parent is not None else ""
+                    fingerprint = get_image_fingerprint(tag, env, parent_id)
+
+                    if (
+                        not config.force
+                        and profiler is None
+                        and image_info.get(tag, {}).get("fingerprint") == fingerprint
+                    ):
+                        logger.info(f"Image {tag} is up to date")
+                        built.add(tag)
+                        continue
+
+                    future = executor.submit(
+                        _build_image, tag, env, fingerprint, quiet, profiler
+                    )
+                    running[future] = tag
+
+            if not running:
+                break
+
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                tag = running.pop(future)
+                if future.result():
+                    built.add(tag)
+                    # Child images are fingerprinted with the new image ID.
+                    image_info.update(_inspect_images([tag], env))
+                else:
+                    # Let running builds finish, but do not start new ones.
+                    failed = True
+
+    if package_cache_port is not None:
+        internal.package_cache.log_stats(package_cache_port, package_cache_status)
+
+    if profiler is not None and not failed and not pending:
+        image_names = {
+            tag: f"{env['CONTAINER_USER']}-noetic:{tag}" for tag in parents
+        }
+        profiler.add_layer_sizes(parents, image_names)
+        report_path = profiler.write_report(parents)
+        print(report_path.read_text(), end="")
+        logger.info(f"Build profile saved to {report_path}")
+
+    return not failed and not pending
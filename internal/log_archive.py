@@ -0,0 +1,302 @@
+"""Keeps a compressed archive of every run's log messages and captured
+command output, so that old failures can be looked up without rerunning them.
+
+Each run is written to its own zip file in the archive directory when it
+exits, and is listed in an index by run, tag, and phase, where a phase is a
+captured command such as an image build or a package build. The oldest runs
+are removed once the archive is larger than MAX_ARCHIVE_BYTES.
+"""
+
+import contextlib
+import fcntl
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+import zipfile
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+import internal.log_utils
+from internal.cache import load_json, log_dir, save_json
+from internal.config import LogsConfig
+
+LOGGER_NAME = "ros-noetic-docker"
+
+ARCHIVE_DIR = "archive"
+INDEX_FILE = "index.json"
+MESSAGES_FILE = "messages.log"
+
+MAX_ARCHIVE_BYTES = 512 * 1024 * 1024
+
+# The host passes its run ID to the build in the container, so that the
+# container's run is listed under it.
+PARENT_RUN_ENV_VAR = "LOG_ARCHIVE_PARENT_RUN"
+
+# Not `from internal import logger`, since the logger is set up with this
+# module.
+logger = logging.getLogger(LOGGER_NAME)
+
+_handler: "Optional[ArchiveHandler]" = None
+_handler_lock = threading.Lock()
+
+
+def archive_dir() -> Path:
+    path = log_dir() / ARCHIVE_DIR
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+@contextlib.contextmanager
+def _locked_index() -> "Iterator[list[dict[str, Any]]]":
+    """Load the index, and save it when the block exits, while holding a lock
+    against other runs, e.g. in the container."""
+    with open(archive_dir() / f".{INDEX_FILE}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        index = load_json(archive_dir() / INDEX_FILE, default=[])
+        yield index
+        save_json(archive_dir() / INDEX_FILE, index)
+
+
+def load_index() -> "list[dict[str, Any]]":
+    return load_json(archive_dir() / INDEX_FILE, default=[])  # type: ignore
+
+
+class ArchiveHandler(logging.Handler):
+    """Collects a run's log messages and captured output, and writes them to
+    the archive when closed.
+
+    Captured output is compressed into the archive as soon as the command
+    finishes, on the logging thread.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+        self.start_time = time.time()
+        self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.parent_run_id = os.environ.get(PARENT_RUN_ENV_VAR)
+        self.command = " ".join([Path(sys.argv[0]).name, *sys.argv[1:]])
+        self.tags: "list[str]" = []
+        self.phases: "list[str]" = []
+        self.messages: "list[str]" = []
+        self.failed = False
+        # Only runs that build something are archived, see enable.
+        self.enabled = False
+        self._zip: Optional[zipfile.ZipFile] = None
+
+    @property
+    def path(self) -> Path:
+        return archive_dir() / f"{self.run_id}.zip"
+
+    def _get_zip(self) -> zipfile.ZipFile:
+        if self._zip is None:
+            self._zip = zipfile.ZipFile(self.path, "w", zipfile.ZIP_DEFLATED)
+        return self._zip
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if not self.enabled:
+            return
+        capture_path = getattr(record, "capture_path", None)
+        if capture_path is not None:
+            name = record.capture_name  # type: ignore
+            # e.g. a command that is retried
+            count = self.phases.count(name)
+            arcname = f"{name}.log" if count == 0 else f"{name}-{count + 1}.log"
+            try:
+                self._get_zip().write(capture_path, arcname)
+            except OSError:
+                self.handleError(record)
+                return
+            self.phases.append(name)
+            return
+
+        if record.levelno >= logging.ERROR:
+            self.failed = True
+        self.messages.append(self.format(record))
+
+    def close(self) -> None:
+        """Write the messages and add the run to the index."""
+        with self.lock:
+            if self.messages or self._zip is not None:
+                try:
+                    self._write_run()
+                except OSError:
+                    # The archive is a convenience, so never fail a run over it.
+                    pass
+            self.messages = []
+        super().close()
+
+    def _write_run(self) -> None:
+        archive = self._get_zip()
+        archive.writestr(MESSAGES_FILE, "\n".join(self.messages) + "\n")
+        archive.close()
+        self._zip = None
+
+        entry = {
+            "run": self.run_id,
+            "parent": self.parent_run_id,
+            "start": self.start_time,
+            "seconds": time.time() - self.start_time,
+            "command": self.command,
+            "tags": self.tags,
+            "phases": self.phases,
+            "status": "failed" if self.failed else "ok",
+            "file": self.path.name,
+            "size": self.path.stat().st_size,
+        }
+        with _locked_index() as index:
+            index.append(entry)
+            _rotate(index)
+
+
+def _rotate(index: "list[dict[str, Any]]") -> None:
+    """Remove the oldest runs from index until the archive fits in
+    MAX_ARCHIVE_BYTES."""
+    index.sort(key=lambda entry: entry["start"])
+    total_size = sum(entry["size"] for entry in index)
+    while index and total_size > MAX_ARCHIVE_BYTES:
+        entry = index.pop(0)
+        total_size -= entry["size"]
+        with contextlib.suppress(OSError):
+            (archive_dir() / entry["file"]).unlink()
+
+
+def get_handler() -> ArchiveHandler:
+    global _handler
+    with _handler_lock:
+        if _handler is None:
+            _handler = ArchiveHandler()
+        return _handler
+
+
+def enable() -> None:
+    """Archive this run. Only builds call this, so that quick commands such as
+    launch.py do not fill the archive."""
+    get_handler().enabled = True
+
+
+def get_run_id() -> str:
+    return get_handler().run_id
+
+
+def add_tags(tags: "list[str]") -> None:
+    """Record that this run is for tags, for finding it in the index."""
+    handler = get_handler()
+    handler.tags += [tag for tag in tags if tag not in handler.tags]
+
+
+def add_capture(name: str, path: Path) -> None:
+    """Add a command's captured output to this run's archive as a phase."""
+    # Sent through the logging queue, so that it is compressed on the logging
+    # thread. The terminal handler ignores it.
+    logging.getLogger(LOGGER_NAME).info(
+        "Captured output of %s",
+        name,
+        extra={"capture_name": name, "capture_path": str(path)},
+    )
+
+
+def is_capture_record(record: logging.LogRecord) -> bool:
+    return hasattr(record, "capture_path")
+
+
+def find_run(run: str) -> "Optional[dict[str, Any]]":
+    """Return the index entry for run, which may be a prefix of a run ID or
+    "last", or None if it matches no run or several runs."""
+    index = load_index()
+    if run == "last":
+        return max(index, key=lambda entry: entry["start"], default=None)
+    matches = [entry for entry in index if entry["run"].startswith(run)]
+    return matches[0] if len(matches) == 1 else None
+
+
+def _get_tags(entry: "dict[str, Any]", index: "list[dict[str, Any]]") -> "list[str]":
+    """Return the tags of a run, or of the run that started it, e.g. for a
+    package build in the container."""
+    if entry["tags"] or entry["parent"] is None:
+        return entry["tags"]
+    parents = [parent for parent in index if parent["run"] == entry["parent"]]
+    return parents[0]["tags"] if parents else []
+
+
+def _format_seconds(seconds: float) -> str:
+    minutes, seconds = divmod(round(seconds), 60)
+    return f"{minutes}m {seconds:02}s" if minutes else f"{seconds}s"
+
+
+def _list_runs(config: LogsConfig) -> None:
+    index = load_index()
+    entries = sorted(index, key=lambda entry: -entry["start"])
+    if config.tag is not None:
+        entries = [entry for entry in entries if config.tag in _get_tags(entry, index)]
+    if config.failed:
+        entries = [entry for entry in entries if entry["status"] == "failed"]
+    if not entries:
+        print("No archived runs")
+        return
+
+    rows = [["RUN", "STARTED", "TIME", "STATUS", "TAGS", "PHASES", "COMMAND"]]
+    for entry in entries[: config.limit]:
+        rows.append(
+            [
+                entry["run"],
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["start"])),
+                _format_seconds(entry["seconds"]),
+                entry["status"],
+                ",".join(_get_tags(entry, index)) or "-",
+                str(len(entry["phases"])),
+                entry["command"],
+            ]
+        )
+    internal.log_utils.print_table(rows)
+
+
+def _show_run(entry: "dict[str, Any]", phase: Optional[str]) -> None:
+    with zipfile.ZipFile(archive_dir() / entry["file"]) as archive:
+        if phase is None:
+            print(f"{entry['command']} ({entry['status']})")
+            sys.stdout.flush()
+            with archive.open(MESSAGES_FILE) as messages:
+                shutil.copyfileobj(messages, sys.stdout.buffer)
+        elif f"{phase}.log" in archive.namelist():
+            sys.stdout.flush()
+            with archive.open(f"{phase}.log") as output:
+                shutil.copyfileobj(output, sys.stdout.buffer)
+            return
+        else:
+            logger.error(f"Run {entry['run']} has no phase {phase}")
+
+    internal.log_utils.flush_logs()
+    names = sorted(Path(name).stem for name in archive.namelist())
+    phases = [name for name in names if name != Path(MESSAGES_FILE).stem]
+    if phases:
+        print(f"\nPhases, for logs.py {entry['run']} PHASE:")
+        print("\n".join(f"    {name}" for name in phases))
+
+    children = [child for child in load_index() if child["parent"] == entry["run"]]
+    if children:
+        print("\nRuns in the container:")
+        print("\n".join(f"    {child['run']} {child['command']}" for child in children))
+    if phase is not None:
+        sys.exit(1)
+
+
+def show_logs(config: LogsConfig) -> None:
+    """List the archived runs, or print the messages or a phase's captured
+    output of one run."""
+    if config.run is None:
+        _list_runs(config)
+        return
+
+    entry = find_run(config.run)
+    if entry is None:
+        logger.error(f"No single run matches {config.run}. Run logs.py to list them.")
+        sys.exit(1)
+    try:
+        _show_run(entry, config.phase)
+    except (OSError, KeyError, zipfile.BadZipFile):
+        logger.error(f"The archive of run {entry['run']} is missing or damaged")
+        sys.exit(1)
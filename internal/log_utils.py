@@ -1,6 +1,11 @@
+import atexit
 import logging
+import logging.handlers
+import queue
+from typing import Optional
 
 import internal.ansi as ansi
+import internal.log_archive
 
 """Because people tend to ignore log messages when they don't have color,
 but we can't use an external package."""
@@ -54,11 +59,17 @@ class ColorFormatter(logging.Formatter):
         logging.INFO: f"{ansi.CYAN}{BASE_FORMAT}{ansi.RESET}",
     }
 
+    def __init__(self) -> None:
+        super().__init__(self.BASE_FORMAT)
+        self.formatters = {
+            level: logging.Formatter(fmt) for level, fmt in self.COLOR_FORMATS.items()
+        }
+
     def format(self, record: logging.LogRecord) -> str:
-        fmt = self.BASE_FORMAT
-        if record.levelno in self.COLOR_FORMATS:
-            fmt = self.COLOR_FORMATS[record.levelno]
-        return logging.Formatter(fmt).format(record)
+        formatter = self.formatters.get(record.levelno)
+        if formatter is None:
+            return super().format(record)
+        return formatter.format(record)
 
 
 def add_log_level(level: int, level_name: str) -> None:
@@ -85,16 +96,58 @@ def add_log_level(level: int, level_name: str) -> None:
     setattr(logging, method_name, log_to_root)
 
 
+# Log records are handled on a background thread, so that logging never waits
+# on the terminal or the archive.
+_queue: "queue.Queue[logging.LogRecord]" = queue.Queue()
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
 def get_logger() -> CustomLogger:
+    global _listener
+
     add_log_level(CustomLogger.SUCCESS, "SUCCESS")
     add_log_level(CustomLogger.ATTENTION, "ATTENTION")
 
     handler = logging.StreamHandler()
     handler.setLevel(logging.INFO)
     handler.setFormatter(ColorFormatter())
+    handler.addFilter(lambda record: not internal.log_archive.is_capture_record(record))
+
+    if _listener is None:
+        _listener = logging.handlers.QueueListener(
+            _queue,
+            handler,
+            internal.log_archive.get_handler(),
+            respect_handler_level=True,
+        )
+        _listener.start()
+        atexit.register(_stop_listener)
 
-    logger = logging.getLogger("ros-noetic-docker")
+    logger = logging.getLogger(internal.log_archive.LOGGER_NAME)
     logger.setLevel(handler.level)
-    logger.addHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(_queue))
 
     return logger  # type: ignore
+
+
+def flush_logs() -> None:
+    """Wait until every log record so far has been written. Call this before
+    writing to the terminal directly, so that the output stays in order."""
+    if _listener is not None:
+        _queue.join()
+
+
+def _stop_listener() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    internal.log_archive.get_handler().close()
+
+
+def print_table(rows: "list[list[str]]") -> None:
+    """Print rows as left-aligned columns. The first row is the header."""
+    flush_logs()
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
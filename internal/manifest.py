@@ -0,0 +1,212 @@
+import hashlib
+import os
+import subprocess
+import threading
+from pathlib import Path
+from typing import Any, Iterable, Mapping, Optional
+
+from internal import logger
+from internal.cache import cache_dir, hash_file, load_json, save_json
+
+# Records what each package was last built from, keyed on the package name.
+BUILD_MANIFEST_FILE = "build_manifest.json"
+
+# Environment variables that change what a package build produces.
+BUILD_ENV_VARS = [
+    "CMAKE_PREFIX_PATH",
+    "LD_LIBRARY_PATH",
+    "PATH",
+    "PKG_CONFIG_PATH",
+    "PYTHONPATH",
+    "ROS_DISTRO",
+    "ROS_PACKAGE_PATH",
+    "ROS_ROOT",
+]
+
+# The host passes the ID of the image the container was started from. It is
+# unset when a build is started from a shell in the container.
+IMAGE_ID_ENV_VAR = "BUILD_IMAGE_ID"
+
+# The catkin workspace is built as a whole, so it has a single entry.
+CATKIN_WORKSPACE = "catkin_ws"
+
+
+def _fingerprint_untracked_tree(path: Path) -> str:
+    # Without git, fall back to file metadata.
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = Path(root) / name
+            try:
+                stat = file_path.stat()
+            except OSError:
+                continue
+            relative_path = file_path.relative_to(path)
+            digest.update(
+                f"{relative_path}:{stat.st_size}:{stat.st_mtime_ns}\0".encode()
+            )
+    return digest.hexdigest()
+
+
+def fingerprint_source_tree(path: Path) -> str:
+    """Return a hash of a package's sources.
+
+    For git repositories, this is the hash of the committed tree, the commits
+    checked out in submodules, and the contents of every modified or untracked
+    file. Ignored files, such as build directories, do not affect it.
+    """
+    result = subprocess.run(
+        ["git", "rev-parse", "HEAD^{tree}"],
+        cwd=path,
+        capture_output=True,
+    )
+    if result.returncode != 0:
+        return _fingerprint_untracked_tree(path)
+
+    digest = hashlib.sha256(result.stdout)
+
+    result = subprocess.run(
+        ["git", "submodule", "status", "--recursive"],
+        cwd=path,
+        capture_output=True,
+    )
+    digest.update(result.stdout)
+
+    result = subprocess.run(
+        [
+            "git",
+            "status",
+            "--porcelain",
+            "-z",
+            "--untracked-files=all",
+            "--ignore-submodules=none",
+        ],
+        cwd=path,
+        capture_output=True,
+    )
+    digest.update(result.stdout)
+
+    entries = iter(result.stdout.split(b"\0"))
+    for entry in entries:
+        if len(entry) < 4:
+            continue
+        if entry[0:1] in (b"R", b"C"):
+            # Renames and copies are followed by the original path.
+            next(entries, None)
+
+        file_path = path / os.fsdecode(entry[3:])
+        if file_path.is_dir():
+            # Submodules with modified contents
+            digest.update(fingerprint_source_tree(file_path).encode())
+        elif file_path.is_file():
+            digest.update(hash_file(file_path))
+
+    return digest.hexdigest()
+
+
+def fingerprint_source_trees(paths: "Iterable[Path]") -> str:
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        digest.update(f"{path.name}\0".encode())
+        if path.is_dir():
+            digest.update(fingerprint_source_tree(path).encode())
+        elif path.is_file():
+            digest.update(hash_file(path))
+    return digest.hexdigest()
+
+
+def fingerprint_env(
+    env: "Mapping[str, str]", *extra: str, ignored_dir: Optional[Path] = None
+) -> str:
+    """Return a hash of the build-relevant environment variables and extra.
+
+    Path list entries inside ignored_dir are left out, e.g. so that a workspace
+    does not depend on its own devel space.
+    """
+    digest = hashlib.sha256()
+    for name in BUILD_ENV_VARS:
+        value = env.get(name, "")
+        if ignored_dir is not None:
+            value = ":".join(
+                entry
+                for entry in value.split(":")
+                if not entry.startswith(str(ignored_dir))
+            )
+        digest.update(f"{name}={value}\0".encode())
+    for value in extra:
+        digest.update(f"{value}\0".encode())
+    return digest.hexdigest()
+
+
+class BuildManifest:
+    """Tracks the sources, image, and environment each package was last built
+    against, so that unchanged packages can skip their build."""
+
+    def __init__(self, force: bool = False) -> None:
+        self.path = cache_dir() / BUILD_MANIFEST_FILE
+        self.image_id = os.environ.get(IMAGE_ID_ENV_VAR, "")
+        self.force = force
+        self.entries: "dict[str, dict[str, Any]]" = load_json(self.path, default={})
+        self.rebuilt: "dict[str, str]" = {}
+        self.skipped: "list[str]" = []
+        self._lock = threading.Lock()
+
+    def get_rebuild_reason(
+        self,
+        package: str,
+        source: str,
+        env: str,
+        dependencies: "Iterable[str]" = (),
+        outputs: "Iterable[Path]" = (),
+    ) -> Optional[str]:
+        """Return why package must be rebuilt, or None if it is up to date.
+
+        outputs are files or directories that the build creates, which must
+        still exist for the package to be up to date.
+        """
+        rebuilt_dependencies = [dep for dep in dependencies if dep in self.rebuilt]
+        missing_outputs = [output for output in outputs if not output.exists()]
+
+        entry = self.entries.get(package)
+        if self.force:
+            return "--force"
+        elif entry is None:
+            return "never built"
+        elif missing_outputs:
+            return f"{missing_outputs[0]} is missing"
+        elif rebuilt_dependencies:
+            return f"{', '.join(rebuilt_dependencies)} rebuilt"
+        elif entry["source"] != source:
+            return "source changed"
+        elif self.image_id and entry["image"] != self.image_id:
+            return "image changed"
+        elif entry["env"] != env:
+            return "environment changed"
+        else:
+            return None
+
+    def record_built(self, package: str, source: str, env: str, reason: str) -> None:
+        with self._lock:
+            # Without an image ID, the image is assumed to be the one the
+            # package was last built in.
+            image_id = self.image_id or self.entries.get(package, {}).get("image", "")
+            self.entries[package] = {
+                "env": env,
+                "image": image_id,
+                "source": source,
+            }
+            self.rebuilt[package] = reason
+            save_json(self.path, self.entries)
+
+    def record_skipped(self, package: str) -> None:
+        with self._lock:
+            self.skipped.append(package)
+
+    def log_report(self) -> None:
+        lines = [
+            f"    rebuilt  {package}: {reason}"
+            for package, reason in self.rebuilt.items()
+        ] + [f"    skipped  {package}: unchanged" for package in self.skipped]
+        if lines:
+            logger.info("Package build summary:\n" + "\n".join(lines))
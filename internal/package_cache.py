@@ -0,0 +1,574 @@
+"""A caching HTTP proxy for the packages that image builds download.
+
+build.py --package-cache starts it in the background, or attaches to the one
+already running for the user, and points apt and pip in the image builds at
+it. apt uses it as a forward proxy for its plain HTTP mirrors, and pip uses it
+as its package index, which it serves from PyPI.
+
+Package files never change, so they are served from the cache without asking
+upstream. Index files are fetched again on every request and only served from
+the cache when upstream cannot be reached, so builds also work offline once
+the cache is warm.
+"""
+
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+from typing import Any, BinaryIO, Optional
+
+from internal import logger
+from internal.cache import cache_dir, load_json, log_dir, save_json
+
+# Where cached files are kept, in the cache directory.
+PACKAGE_CACHE_DIR = "package-cache"
+
+# The running proxy's process ID and port, in the cache directory.
+STATE_FILE = "package_cache.json"
+
+DEFAULT_MAX_SIZE_GB = 20
+
+# The proxy exits after this long without a request.
+IDLE_TIMEOUT_SECONDS = 6 * 60 * 60
+
+PYPI_URL = "https://pypi.org"
+PYPI_FILES_URL = "https://files.pythonhosted.org"
+
+# The only hosts that apt may download from through the proxy, so that it
+# cannot be used to reach anything else. A host starting with "." also matches
+# its subdomains, like the country mirrors of archive.ubuntu.com.
+APT_HOSTS = [
+    "archive.ubuntu.com",
+    ".archive.ubuntu.com",
+    "security.ubuntu.com",
+    "packages.ros.org",
+]
+
+# Files with these suffixes are never changed once published.
+_IMMUTABLE_SUFFIXES = (".deb", ".udeb", ".whl", ".tar.gz", ".tar.bz2", ".zip")
+
+# The proxy only listens on the loopback interface. Image builds that use it
+# run on the host network, so containers on the docker bridge cannot reach it.
+_BIND_ADDRESS = "127.0.0.1"
+
+# Each user gets their own port, so that users on a shared machine do not
+# attach to each other's proxy.
+_PORT_BASE = 20000
+_PORT_RANGE = 10000
+
+_UPSTREAM_TIMEOUT_SECONDS = 30
+_CHUNK_SIZE = 1024 * 1024
+
+# The build args in compose.shared.yaml that get_build_env sets.
+BUILD_ARGS = ["http_proxy", "no_proxy", "PIP_INDEX_URL", "PIP_TRUSTED_HOST"]
+
+# Requests to the proxy itself must not go through the user's proxy.
+_direct_opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+class LRUCache:
+    """Files on disk, keyed on a string. The least recently used files are
+    removed once the files take up more than max_bytes."""
+
+    def __init__(self, directory: Path, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+
+        directory.mkdir(parents=True, exist_ok=True)
+        for path in directory.glob(".tmp-*"):
+            # Left behind by a proxy that was killed mid-download
+            path.unlink()
+        for path in self._data_files():
+            self.size += path.stat().st_size
+        self._evict()
+
+    def _data_files(self) -> "list[Path]":
+        return [path for path in self.directory.glob("??/*") if path.suffix != ".json"]
+
+    def _get_path(self, key: str) -> Path:
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return self.directory / digest[:2] / digest
+
+    def get(self, key: str) -> "Optional[tuple[BinaryIO, dict[str, Any]]]":
+        """Return the open file and metadata for key, or None if it is not
+        cached. The caller must close the file."""
+        path = self._get_path(key)
+        meta = load_json(path.with_suffix(".json"))
+        if meta is None:
+            return None
+        try:
+            f = open(path, "rb")
+            # The modification time records when the file was last used.
+            os.utime(path)
+        except OSError:
+            return None
+        return f, meta
+
+    def new_file(self) -> "tempfile._TemporaryFileWrapper[bytes]":
+        """Return a temporary file to download into and then pass to put."""
+        return tempfile.NamedTemporaryFile(
+            dir=self.directory, prefix=".tmp-", delete=False
+        )
+
+    def put(self, key: str, tmp_path: str, meta: "dict[str, Any]") -> None:
+        path = self._get_path(key)
+        path.parent.mkdir(exist_ok=True)
+        size = os.stat(tmp_path).st_size
+
+        with self._lock:
+            try:
+                self.size -= path.stat().st_size
+            except OSError:
+                pass
+            save_json(path.with_suffix(".json"), meta)
+            os.replace(tmp_path, path)
+            self.size += size
+            self._evict()
+
+    def _evict(self) -> None:
+        if self.size <= self.max_bytes:
+            return
+
+        # Files that are being served stay readable until they are closed.
+        for path in sorted(self._data_files(), key=lambda path: path.stat().st_mtime):
+            if self.size <= self.max_bytes:
+                break
+            self.size -= path.stat().st_size
+            path.unlink()
+            path.with_suffix(".json").unlink(missing_ok=True)
+
+
+class _ProxyHandler(http.server.BaseHTTPRequestHandler):
+    server: "PackageCacheProxy"
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        self._handle(send_body=True)
+
+    def do_HEAD(self) -> None:
+        self._handle(send_body=False)
+
+    def _handle(self, send_body: bool) -> None:
+        self.server.last_request_time = time.monotonic()
+
+        url = self.path
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme != "http" or self._is_own_address(parsed.netloc):
+            path = urllib.parse.urlunsplit(("", "", parsed.path, parsed.query, ""))
+            if path == "/_status":
+                self._send_bytes(
+                    json.dumps(self.server.get_status()).encode(),
+                    "application/json",
+                    send_body,
+                )
+                return
+            elif path.startswith("/pypi-files/"):
+                url = self.server.pypi_files_url + path[len("/pypi-files") :]
+            elif path.startswith("/pypi/"):
+                url = self.server.pypi_url + path[len("/pypi") :]
+            else:
+                self.send_error(404)
+                return
+        elif not self.server.is_allowed_host(parsed.netloc):
+            self.send_error(403, f"{parsed.hostname} is not a package mirror")
+            return
+
+        if urllib.parse.urlsplit(url).path.endswith(_IMMUTABLE_SUFFIXES):
+            self._handle_package_file(url, send_body)
+        else:
+            self._handle_index_file(url, send_body)
+
+    def _is_own_address(self, netloc: str) -> bool:
+        host, _, port = netloc.rpartition(":")
+        return host in ["127.0.0.1", "localhost"] and port == str(
+            self.server.server_address[1]
+        )
+
+    def _handle_package_file(self, url: str, send_body: bool) -> None:
+        cached = self.server.cache.get(url)
+        if cached is not None:
+            f, meta = cached
+            with f:
+                size = self._send_file(f, meta, send_body)
+            self.server.count("hits", size)
+            return
+
+        try:
+            response = self._open_upstream(url)
+        except urllib.error.HTTPError as e:
+            self.send_error(e.code)
+            return
+        except OSError:
+            self.send_error(502)
+            return
+
+        with response:
+            size = self._send_and_store(response, url, send_body)
+        self.server.count("misses", size)
+
+    def _handle_index_file(self, url: str, send_body: bool) -> None:
+        # pip asks for either HTML or JSON index pages.
+        key = f"{url}\0{self.headers.get('Accept', '')}"
+        try:
+            response = self._open_upstream(url)
+        except urllib.error.HTTPError as e:
+            self.send_error(e.code)
+            return
+        except OSError:
+            cached = self.server.cache.get(key)
+            if cached is None:
+                self.send_error(502)
+                return
+            f, meta = cached
+            with f:
+                size = self._send_file(f, meta, send_body)
+            self.server.count("stale", size)
+            return
+
+        with response:
+            size = self._send_and_store(response, key, send_body)
+        self.server.count("misses", size)
+
+    def _open_upstream(self, url: str) -> Any:
+        headers = {}
+        if "Accept" in self.headers:
+            headers["Accept"] = self.headers["Accept"]
+        request = urllib.request.Request(url, headers=headers)
+        return urllib.request.urlopen(request, timeout=_UPSTREAM_TIMEOUT_SECONDS)
+
+    def _send_and_store(self, response: Any, key: str, send_body: bool) -> int:
+        """Send response to the client while writing it to the cache, and
+        return its size."""
+        meta = {"content_type": response.headers.get("Content-Type", "")}
+        if self._needs_rewrite(meta):
+            # The links in PyPI's index pages must be rewritten, which needs the
+            # whole page.
+            body = response.read()
+            with self.server.cache.new_file() as tmp:
+                tmp.write(body)
+            self.server.cache.put(key, tmp.name, meta)
+            self._send_index_page(body, meta, send_body)
+            return len(body)
+
+        length = response.headers.get("Content-Length")
+        self.send_response(200)
+        self.send_header("Content-Type", meta["content_type"])
+        if length is not None:
+            self.send_header("Content-Length", length)
+        else:
+            # Without a length, the end of the body is marked by closing the
+            # connection.
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+
+        size = 0
+        client_connected = send_body
+        with self.server.cache.new_file() as tmp:
+            while True:
+                chunk = response.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                tmp.write(chunk)
+                size += len(chunk)
+                if client_connected:
+                    try:
+                        self.wfile.write(chunk)
+                    except OSError:
+                        # Finish the download anyway so it is cached.
+                        client_connected = False
+
+        if length is None or size == int(length):
+            self.server.cache.put(key, tmp.name, meta)
+        else:
+            os.unlink(tmp.name)
+            self.close_connection = True
+        return size
+
+    def _needs_rewrite(self, meta: "dict[str, Any]") -> bool:
+        return self.path.startswith("/pypi/") and (
+            "html" in meta["content_type"] or "json" in meta["content_type"]
+        )
+
+    def _send_file(self, f: BinaryIO, meta: "dict[str, Any]", send_body: bool) -> int:
+        """Send a cached file and return its size."""
+        if self._needs_rewrite(meta):
+            body = f.read()
+            self._send_index_page(body, meta, send_body)
+            return len(body)
+
+        size = os.fstat(f.fileno()).st_size
+        self.send_response(200)
+        self.send_header("Content-Type", meta["content_type"])
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        if send_body:
+            while True:
+                chunk = f.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+        return size
+
+    def _send_index_page(
+        self, body: bytes, meta: "dict[str, Any]", send_body: bool
+    ) -> None:
+        # Point the package file links at the proxy.
+        host = self.headers.get("Host") or f"127.0.0.1:{self.server.port}"
+        body = body.replace(
+            self.server.pypi_files_url.encode() + b"/",
+            f"http://{host}/pypi-files/".encode(),
+        )
+        self._send_bytes(body, meta["content_type"], send_body)
+
+    def _send_bytes(self, body: bytes, content_type: str, send_body: bool) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+
+class PackageCacheProxy(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        port: int,
+        cache: LRUCache,
+        pypi_url: str = PYPI_URL,
+        pypi_files_url: str = PYPI_FILES_URL,
+        allowed_hosts: "Optional[list[str]]" = None,
+    ) -> None:
+        try:
+            super().__init__((_BIND_ADDRESS, port), _ProxyHandler)
+        except OSError:
+            # Another process has the port, so take any free port.
+            super().__init__((_BIND_ADDRESS, 0), _ProxyHandler)
+        self.port = self.server_address[1]
+        self.cache = cache
+        self.pypi_url = pypi_url.rstrip("/")
+        self.pypi_files_url = pypi_files_url.rstrip("/")
+        self.allowed_hosts = APT_HOSTS + (allowed_hosts or [])
+        self.last_request_time = time.monotonic()
+        self.counts = {"hits": 0, "misses": 0, "stale": 0}
+        self.byte_counts = {"hits": 0, "misses": 0, "stale": 0}
+        self._lock = threading.Lock()
+
+    def count(self, result: str, size: int) -> None:
+        with self._lock:
+            self.counts[result] += 1
+            self.byte_counts[result] += size
+
+    def is_allowed_host(self, netloc: str) -> bool:
+        """Return whether apt may download from netloc, a host and optional
+        port, through the proxy."""
+        if netloc.endswith(":80"):
+            netloc = netloc[: -len(":80")]
+        netloc = netloc.lower()
+        return any(
+            netloc == host or (host.startswith(".") and netloc.endswith(host))
+            for host in self.allowed_hosts
+        )
+
+    def get_status(self) -> "dict[str, Any]":
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "cache_dir": str(self.cache.directory),
+                "max_bytes": self.cache.max_bytes,
+                "size": self.cache.size,
+                "counts": dict(self.counts),
+                "byte_counts": dict(self.byte_counts),
+            }
+
+
+def _get_default_port() -> int:
+    return _PORT_BASE + os.getuid() % _PORT_RANGE
+
+
+def get_status(port: int) -> "Optional[dict[str, Any]]":
+    """Return the status of the proxy on port, or None if none is running."""
+    try:
+        with _direct_opener.open(f"http://127.0.0.1:{port}/_status", timeout=1) as f:
+            return json.load(f)  # type: ignore
+    except (OSError, ValueError):
+        return None
+
+
+# TCP sockets in the LISTEN state in /proc/net/tcp
+_TCP_LISTEN = "0A"
+
+
+def _get_listener_uid(port: int) -> Optional[int]:
+    """Return the user ID that owns the socket listening on 127.0.0.1:port,
+    or None if nothing listens on it."""
+    try:
+        with open("/proc/net/tcp") as f:
+            lines = f.readlines()[1:]
+    except OSError:
+        return None
+
+    for line in lines:
+        fields = line.split()
+        address, _, port_hex = fields[1].partition(":")
+        # The address is in host byte order.
+        host = socket.inet_ntoa(struct.pack("=I", int(address, 16)))
+        if (
+            fields[3] == _TCP_LISTEN
+            and int(port_hex, 16) == port
+            and host in ["127.0.0.1", "0.0.0.0"]
+        ):
+            return int(fields[7])
+    return None
+
+
+def _get_running_port() -> Optional[int]:
+    """Return the port of this user's running proxy, if any."""
+    state = load_json(cache_dir() / STATE_FILE, default={})
+    if "port" not in state:
+        return None
+    # Once the proxy exits, any user on this machine can listen on its port
+    # and serve packages to the build, so only trust a proxy that this user
+    # runs.
+    if _get_listener_uid(state["port"]) != os.getuid():
+        return None
+    status = get_status(state["port"])
+    if status is None or status["cache_dir"] != str(cache_dir() / PACKAGE_CACHE_DIR):
+        return None
+    return state["port"]  # type: ignore
+
+
+def start(max_size_gb: int = DEFAULT_MAX_SIZE_GB) -> Optional[int]:
+    """Start this user's proxy in the background, or attach to it if it is
+    already running, and return its port. Returns None if it fails to start."""
+    port = _get_running_port()
+    if port is not None:
+        logger.info(f"Using the package cache on port {port}")
+        return port
+
+    log_path = log_dir() / "package-cache.log"
+    with open(log_path, "ab") as log_file:
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "internal.package_cache",
+                "--port",
+                str(_get_default_port()),
+                "--max-size-gb",
+                str(max_size_gb),
+            ],
+            cwd=Path(__file__).parent.parent,
+            stdin=subprocess.DEVNULL,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            # Keep running after build.py exits or is interrupted.
+            start_new_session=True,
+        )
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and process.poll() is None:
+        port = _get_running_port()
+        if port is not None:
+            logger.info(f"Started the package cache on port {port}")
+            return port
+        time.sleep(0.1)
+
+    logger.warning(
+        f"Failed to start the package cache, so downloading packages directly. "
+        f"See {log_path}"
+    )
+    return None
+
+
+def get_build_env(port: int) -> "dict[str, str]":
+    """Return the compose environment that points image builds at the proxy.
+
+    The build runs on the host network so that it can reach the proxy.
+    """
+    address = f"127.0.0.1:{port}"
+    return {
+        "BUILD_NETWORK": "host",
+        "http_proxy": f"http://{address}",
+        "no_proxy": "localhost,127.0.0.1",
+        "PIP_INDEX_URL": f"http://{address}/pypi/simple",
+        "PIP_TRUSTED_HOST": address,
+    }
+
+
+def log_stats(port: int, before: "Optional[dict[str, Any]]") -> None:
+    """Log how many downloads the proxy served from its cache since before."""
+    after = get_status(port)
+    if after is None or before is None:
+        return
+
+    def diff(counts: str, result: str) -> int:
+        return after[counts][result] - before[counts][result]  # type: ignore
+
+    hits = diff("counts", "hits") + diff("counts", "stale")
+    total = hits + diff("counts", "misses")
+    if total == 0:
+        return
+    cached_mb = (diff("byte_counts", "hits") + diff("byte_counts", "stale")) / 1e6
+    downloaded_mb = diff("byte_counts", "misses") / 1e6
+    logger.info(
+        f"Package cache served {hits} of {total} downloads ({cached_mb:.0f} MB) "
+        f"from the cache and downloaded {downloaded_mb:.0f} MB"
+    )
+
+
+def _serve() -> None:
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--port", type=int, default=_get_default_port())
+    argparser.add_argument("--max-size-gb", type=float, default=DEFAULT_MAX_SIZE_GB)
+    argparser.add_argument("--cache-dir", type=Path)
+    argparser.add_argument("--pypi-url", default=PYPI_URL)
+    argparser.add_argument("--pypi-files-url", default=PYPI_FILES_URL)
+    argparser.add_argument(
+        "--allow-host",
+        action="append",
+        default=[],
+        help="Also let apt download from this host (and port) through the proxy",
+    )
+    args = argparser.parse_args()
+
+    cache = LRUCache(
+        args.cache_dir or cache_dir() / PACKAGE_CACHE_DIR,
+        int(args.max_size_gb * 1024**3),
+    )
+    server = PackageCacheProxy(
+        args.port,
+        cache,
+        pypi_url=args.pypi_url,
+        pypi_files_url=args.pypi_files_url,
+        allowed_hosts=args.allow_host,
+    )
+    if args.cache_dir is None:
+        save_json(cache_dir() / STATE_FILE, {"pid": os.getpid(), "port": server.port})
+    print(f"Serving {cache.directory} on port {server.port}", flush=True)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    while time.monotonic() - server.last_request_time < IDLE_TIMEOUT_SECONDS:
+        time.sleep(60)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    _serve()
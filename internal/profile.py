@@ -0,0 +1,182 @@
+import dataclasses
+import json
+import re
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+from internal.cache import log_dir
+
+# e.g. "#7 [app 3/9] RUN apt-get update && apt-get install -y ..."
+_STEP_PATTERN = re.compile(r"^#(?P<id>\d+) \[[^\]]*?\d+/\d+\] (?P<name>.+)$")
+# e.g. "#7 DONE 45.2s"
+_DONE_PATTERN = re.compile(r"^#(?P<id>\d+) DONE (?P<seconds>[\d.]+)s$")
+# e.g. "#7 CACHED"
+_CACHED_PATTERN = re.compile(r"^#(?P<id>\d+) CACHED$")
+
+TOP_STEP_COUNT = 10
+
+
+@dataclasses.dataclass
+class BuildStep:
+    tag: str
+    name: str
+    seconds: float = 0.0
+    cached: bool = False
+    size: Optional[int] = None
+
+
+def _normalize_step_name(name: str) -> str:
+    """Make a step from the build progress comparable to a layer's CreatedBy
+    from the image history."""
+    name = " ".join(name.split())
+    name = name.replace("RUN /bin/sh -c ", "RUN ", 1)
+    if name.endswith(" # buildkit"):
+        name = name[: -len(" # buildkit")]
+    return name
+
+
+def _format_size(size: Optional[int]) -> str:
+    if size is None:
+        return "?"
+    for unit in ["B", "KB", "MB"]:
+        if size < 1000:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1000  # type: ignore
+    return f"{size:.1f} GB"
+
+
+class BuildProfiler:
+    """Collects Dockerfile step durations from BuildKit's plain progress output
+    and layer sizes from the image history."""
+
+    def __init__(self) -> None:
+        self.steps: "dict[str, list[BuildStep]]" = {}
+        self._lock = threading.Lock()
+
+    def get_line_handler(self, tag: str) -> Callable[[str], None]:
+        steps_by_id: "dict[str, BuildStep]" = {}
+        with self._lock:
+            self.steps[tag] = []
+
+        def handle_line(line: str) -> None:
+            match = _STEP_PATTERN.match(line)
+            if match is not None:
+                if match["id"] not in steps_by_id:
+                    step = BuildStep(tag, _normalize_step_name(match["name"]))
+                    steps_by_id[match["id"]] = step
+                    self.steps[tag].append(step)
+                return
+
+            match = _DONE_PATTERN.match(line)
+            if match is not None and match["id"] in steps_by_id:
+                steps_by_id[match["id"]].seconds = float(match["seconds"])
+                return
+
+            match = _CACHED_PATTERN.match(line)
+            if match is not None and match["id"] in steps_by_id:
+                steps_by_id[match["id"]].cached = True
+
+        return handle_line
+
+    def add_layer_sizes(
+        self, parents: "dict[str, Optional[str]]", image_names: "dict[str, str]"
+    ) -> None:
+        """Match each step to the layer it created in its tag's image."""
+        histories = {tag: _get_image_history(image_names[tag]) for tag in parents}
+
+        for tag, steps in self.steps.items():
+            # The history lists the newest layer first, and ends with the
+            # parent image's layers.
+            history = histories[tag]
+            parent = parents[tag]
+            if parent is not None:
+                history = history[: len(history) - len(histories[parent])]
+
+            sizes: "dict[str, list[int]]" = {}
+            for created_by, size in reversed(history):
+                sizes.setdefault(_normalize_step_name(created_by), []).append(size)
+            for step in steps:
+                if sizes.get(step.name):
+                    step.size = sizes[step.name].pop(0)
+
+            if parent is None:
+                # Attribute the rest of the image, i.e. the external base
+                # image, to its FROM step.
+                base_size = sum(size for _, size in history) - sum(
+                    step.size or 0 for step in steps
+                )
+                for step in steps:
+                    if step.name.startswith("FROM "):
+                        step.size = base_size
+                        break
+
+    def write_report(self, parents: "dict[str, Optional[str]]") -> Path:
+        sections = []
+        for tag in sorted(self.steps):
+            sections.append(self._format_section(tag, self.steps[tag]))
+
+            chain = [tag]
+            while parents[chain[-1]] is not None:
+                chain.append(parents[chain[-1]])  # type: ignore
+            if len(chain) > 1:
+                chain.reverse()
+                steps = [
+                    step for chain_tag in chain for step in self.steps.get(chain_tag, [])
+                ]
+                sections.append(self._format_section(" -> ".join(chain), steps))
+
+        report_path = log_dir() / f"build-profile-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+        report_path.write_text("\n\n".join(sections) + "\n")
+        return report_path
+
+    @staticmethod
+    def _format_section(title: str, steps: "list[BuildStep]") -> str:
+        def format_step(step: BuildStep) -> str:
+            seconds = "cached" if step.cached else f"{step.seconds:.1f} s"
+            name = step.name if len(step.name) <= 80 else step.name[:77] + "..."
+            return (
+                f"  {seconds:>9}  {_format_size(step.size):>9}  {step.tag:<14}  {name}"
+            )
+
+        total_seconds = sum(step.seconds for step in steps)
+        total_size = sum(step.size or 0 for step in steps)
+        slowest = sorted(steps, key=lambda step: -step.seconds)[:TOP_STEP_COUNT]
+        largest = sorted(steps, key=lambda step: -(step.size or 0))[:TOP_STEP_COUNT]
+
+        return "\n".join(
+            [
+                f"{title}: {total_seconds:.1f} s, {_format_size(total_size)}",
+                "Slowest steps:",
+                *[format_step(step) for step in slowest],
+                "Largest layers:",
+                *[format_step(step) for step in largest],
+            ]
+        )
+
+
+def _get_image_history(image_name: str) -> "list[tuple[str, int]]":
+    result = subprocess.run(
+        [
+            "docker",
+            "history",
+            "--no-trunc",
+            "--human=false",
+            "--format",
+            "{{json .}}",
+            image_name,
+        ],
+        capture_output=True,
+        text=True,
+    )
+
+    history = []
+    for line in result.stdout.splitlines():
+        try:
+            layer = json.loads(line)
+            history.append((layer["CreatedBy"], int(layer["Size"])))
+        except (KeyError, ValueError):
+            continue
+    return history
@@ -1,106 +1,196 @@
-import io
+import concurrent.futures
 import os
+import re
+import select
 import subprocess
 import sys
+import threading
+import time
 from pathlib import Path
-from typing import NoReturn
+from typing import NoReturn, Optional
+from xml.etree import ElementTree
 
-import internal.ansi as ansi
+import internal.build_errors
+import internal.capture
 import internal.git
+import internal.manifest
+import internal.trace
 from internal import logger
 
+# Debian's ccache package provides compiler wrappers with the compilers' names.
+CCACHE_COMPILER_DIR = Path("/usr/lib/ccache")
 
-def clone_catkin_package(url: str, protocol: internal.git.GitHubProtocol) -> None:
+
+def clone_catkin_package(
+    url: str,
+    protocol: internal.git.GitHubProtocol,
+    quiet: bool = False,
+    mirror_dir: Optional[Path] = None,
+) -> None:
     stem = Path(url).stem
     dest = Path.home() / "catkin_ws/src" / stem
 
     if not dest.exists():
-        logger.info(f"Cloning {url}")
-        internal.git.clone_repository(url, dest, protocol)
+        with internal.trace.span(f"clone_catkin_package {stem}", url=url):
+            logger.info(f"Cloning {url}")
+            internal.git.clone_repository(
+                url, dest, protocol, quiet=quiet, mirror_dir=mirror_dir
+            )
+            logger.success(f"Cloned {stem}")
 
 
-def clone_amrl_package(url: str, protocol: internal.git.GitHubProtocol) -> None:
+def clone_amrl_package(
+    url: str,
+    protocol: internal.git.GitHubProtocol,
+    quiet: bool = False,
+    submodule_jobs: int = 1,
+    mirror_dir: Optional[Path] = None,
+) -> None:
     stem = Path(url).stem
     dest = Path.home() / "ut-amrl" / stem
 
     # TODO: what if the script exits before a clone finishes? git will refuse to
     # clone the repository since the directory already exists.
     if not dest.exists():
-        logger.info(f"Cloning {url}")
-        internal.git.clone_repository(url, dest, protocol)
+        with internal.trace.span(f"clone_amrl_package {stem}", url=url):
+            logger.info(f"Cloning {url}")
+            internal.git.clone_repository(
+                url, dest, protocol, quiet=quiet, mirror_dir=mirror_dir
+            )
+            logger.success(f"Cloned {stem}")
 
     # Always run git submodule update when applicable, just in case the script
     # exited unexpectedly. This is part of the reason we aren't running
     # submodule as part of the git clone command
     if (dest / ".gitmodules").exists():
-        logger.info(f"Updating submodules for {stem}")
-        internal.git.update_submodules(dest)
+        with internal.trace.span(f"update_submodules {stem}"):
+            logger.info(f"Updating submodules for {stem}")
+            internal.git.update_submodules(dest, jobs=submodule_jobs, quiet=quiet)
+            logger.success(f"Updated submodules for {stem}")
 
 
-def _critical_build_failure() -> NoReturn:
+def critical_build_failure() -> NoReturn:
     logger.critical("Build failed. Check build logs.")
     logger.critical("Please include the full build log if you create a GitHub issue.")
     logger.critical("https://github.com/ut-amrl/ros-noetic-docker/issues")
     sys.exit(1)
 
 
-def _capture_process_output(process: subprocess.Popen) -> None:
+# Held while dumping output so that concurrent failures do not interleave.
+_dump_lock = threading.Lock()
+
+
+def _report_failure(
+    capture: internal.capture.OutputCapture,
+    errors: internal.build_errors.ErrorExtractor,
+) -> None:
+    """Show the first errors in a failed command's output, or all of its output
+    if no errors were recognized."""
+    with _dump_lock:
+        if errors.errors:
+            message = f"First errors from {capture.name}:\n{errors.format()}"
+            if errors.omitted_count:
+                message += f"\n\n    ...and {errors.omitted_count} more errors"
+            logger.error(message)
+        else:
+            capture.dump()
+        logger.error(f"Full output saved to {capture.log_path}")
+
+
+def capture_process_output(
+    process: subprocess.Popen, name: str, live_tail: bool = True
+) -> None:
     """The caller should redirect stdout to pipe and stderr to stdout."""
-    if process.stdout is None:
-        # no output to capture
-        return
+    capture = internal.capture.OutputCapture(name, live_tail=live_tail)
+    errors = internal.build_errors.ErrorExtractor()
+    capture.add_line_handler(errors.handle_line)
 
-    # We'll dump all of the output if the build command fails.
-    all_output_lines = []
+    if capture.capture(process) != 0:
+        _report_failure(capture, errors)
 
-    lines_to_clear = 0
-    MAX_LINE_COUNT = min(10, os.get_terminal_size().lines - 2)
-    MAX_LINE_WIDTH = os.get_terminal_size().columns - 4
 
-    sentinel = b""  # bytes mode by default
-    if isinstance(process.stdout, io.TextIOWrapper):
-        sentinel = ""  # type: ignore
+def _is_compiler_cache_enabled() -> bool:
+    # CCACHE_DIR is set in compose.shared.yaml along with the ccache volume.
+    return CCACHE_COMPILER_DIR.is_dir() and "CCACHE_DIR" in os.environ
 
-    for line in iter(process.stdout.readline, sentinel):
-        if isinstance(line, bytes):
-            line = line.decode()
-        all_output_lines.append(line.rstrip())
 
-        if MAX_LINE_COUNT > 0:
-            print(
-                f"{ansi.PREV_LINE}{ansi.CLEAR_LINE}" * lines_to_clear,
-                end="",
-                flush=True,
-            )
-            tail = all_output_lines[-MAX_LINE_COUNT:]
-            tail = [line[:MAX_LINE_WIDTH] for line in tail]
-            print("\n".join(tail))
-            lines_to_clear = len(tail)
+def _get_build_env() -> "dict[str, str]":
+    """Return the environment for compiling packages.
 
-    print(f"{ansi.PREV_LINE}{ansi.CLEAR_LINE}" * lines_to_clear, end="", flush=True)
+    When ccache is available, its compiler wrappers are put first on PATH, which
+    works for catkin and for the CMake projects that rosbuild Makefiles invoke.
+    CMake remembers the compiler path, so existing build directories only use
+    ccache after they are rebuilt from scratch.
+    """
+    env = os.environ.copy()
+    if _is_compiler_cache_enabled():
+        env["PATH"] = f"{CCACHE_COMPILER_DIR}:{env.get('PATH', '')}"
+    return env
 
-    if process.wait() != 0:
-        print("\n".join(all_output_lines))
 
+def reset_compiler_cache_stats() -> None:
+    if _is_compiler_cache_enabled():
+        subprocess.run(["ccache", "--zero-stats"], stdout=subprocess.DEVNULL)
 
-def rosdep_update() -> None:
-    if os.path.exists(Path.home() / ".ros/rosdep"):
+
+def log_compiler_cache_stats() -> None:
+    if not _is_compiler_cache_enabled():
         return
 
-    logger.info("Running rosdep update")
+    result = subprocess.run(["ccache", "--show-stats"], capture_output=True, text=True)
+    if result.returncode == 0:
+        logger.info(
+            "Compiler cache statistics:\n"
+            + "\n".join(f"    {line}" for line in result.stdout.splitlines())
+        )
+
+
+@internal.trace.traced
+def build_catkin_packages(
+    backend: str = "catkin_make",
+    isolate_devel: bool = False,
+    manifest: Optional[internal.manifest.BuildManifest] = None,
+) -> None:
+    workspace = Path.home() / "catkin_ws"
+    if not os.path.exists(workspace / "src"):
+        return
 
-    process = subprocess.Popen(
-        ["rosdep", "update"],
-        stderr=subprocess.STDOUT,
-        stdout=subprocess.PIPE,
+    if manifest is None:
+        _build_catkin_packages(backend, isolate_devel)
+        return
+
+    # The workspace's own devel space is only on the paths after its first
+    # build, and must not count as an environment change.
+    env = internal.manifest.fingerprint_env(
+        os.environ, backend, str(isolate_devel), ignored_dir=workspace
     )
-    _capture_process_output(process)
-    if process.wait() != 0:
-        _critical_build_failure()
+    reason = manifest.get_rebuild_reason(
+        internal.manifest.CATKIN_WORKSPACE,
+        internal.manifest.fingerprint_source_trees((workspace / "src").iterdir()),
+        env,
+        # e.g. after rm -rf build devel
+        outputs=[workspace / "build", workspace / "devel/setup.sh"],
+    )
+    if reason is None:
+        logger.info("Catkin packages are up to date")
+        manifest.record_skipped(internal.manifest.CATKIN_WORKSPACE)
+        return
 
+    _build_catkin_packages(backend, isolate_devel)
 
-def build_catkin_packages() -> None:
-    if not os.path.exists(Path.home() / "catkin_ws/src"):
+    # Fingerprint after the build so files that the build generates in the
+    # source tree do not force the next build.
+    manifest.record_built(
+        internal.manifest.CATKIN_WORKSPACE,
+        internal.manifest.fingerprint_source_trees((workspace / "src").iterdir()),
+        env,
+        reason,
+    )
+
+
+def _build_catkin_packages(backend: str, isolate_devel: bool) -> None:
+    if backend == "catkin_tools":
+        _build_catkin_packages_with_catkin_tools(isolate_devel)
         return
 
     logger.info("Building catkin packages")
@@ -110,25 +200,402 @@ def build_catkin_packages() -> None:
     process = subprocess.Popen(
         ["catkin_make", "-C", str(Path.home() / "catkin_ws"), "-j", "1"],
         cwd=Path.home() / "catkin_ws",
+        env=_get_build_env(),
         stderr=subprocess.STDOUT,
         stdout=subprocess.PIPE,
     )
 
-    _capture_process_output(process)
+    capture_process_output(process, "catkin_make")
     if process.wait() != 0:
-        _critical_build_failure()
+        critical_build_failure()
+
+
+# e.g. "Finished  <<< spot_driver                 [ 12.3 seconds ]"
+_CATKIN_TOOLS_FINISHED_PATTERN = re.compile(
+    r"Finished\s+<<<\s+(?P<package>\S+)\s+\[\s*(?P<seconds>[\d.]+)\s+seconds\s*\]"
+)
+
+# e.g. "Failed     <<< spot_driver                 [ 4.5 seconds ]" or
+# "Abandoned  <<< spot_viz                    [ Depends on failed job ]"
+_CATKIN_TOOLS_NOT_BUILT_PATTERN = re.compile(
+    r"(?:Failed|Abandoned)\s+<<<\s+(?P<package>\S+)"
+)
+
+
+def _build_catkin_packages_with_catkin_tools(isolate_devel: bool) -> None:
+    """Build the catkin workspace with `catkin build`, which schedules packages
+    from their dependencies instead of building one merged CMake project."""
+    workspace = Path.home() / "catkin_ws"
+
+    built_by = workspace / "devel/.built_by"
+    if built_by.exists() and built_by.read_text().strip() == "catkin_make":
+        logger.critical(
+            f"""{workspace} was built with catkin_make.
+    catkin_tools cannot build in the same build and devel spaces. Remove them
+    with `rm -rf {workspace / "build"} {workspace / "devel"}` and try again."""
+        )
+        critical_build_failure()
+
+    result = subprocess.run(
+        [
+            "catkin",
+            "config",
+            "--workspace",
+            str(workspace),
+            "--extend",
+            "/opt/ros/noetic",
+            "--isolate-devel" if isolate_devel else "--merge-devel",
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    if result.returncode != 0:
+        critical_build_failure()
+
+    jobs = str(len(os.sched_getaffinity(0)))
+    package_seconds: "dict[str, float]" = {}
+
+    # Packages that failed, or that were not built because a dependency failed
+    not_built: "set[str]" = set()
+
+    def record_package_result(line: str) -> None:
+        match = _CATKIN_TOOLS_FINISHED_PATTERN.search(line)
+        if match is not None:
+            package_seconds[match["package"]] = float(match["seconds"])
+            not_built.discard(match["package"])
+            return
+
+        match = _CATKIN_TOOLS_NOT_BUILT_PATTERN.search(line)
+        if match is not None:
+            not_built.add(match["package"])
+
+    def catkin_build(name: str, parallel_args: "list[str]") -> bool:
+        process = subprocess.Popen(
+            [
+                "catkin",
+                "build",
+                "--workspace",
+                str(workspace),
+                "--no-status",
+                "--no-notify",
+                *parallel_args,
+            ],
+            cwd=workspace,
+            env=_get_build_env(),
+            stderr=subprocess.STDOUT,
+            stdout=subprocess.PIPE,
+        )
+        capture = internal.capture.OutputCapture(name)
+        errors = internal.build_errors.ErrorExtractor()
+        capture.add_line_handler(record_package_result)
+        capture.add_line_handler(errors.handle_line)
+        if capture.capture(process) == 0:
+            return True
+
+        _report_failure(capture, errors)
+        return False
+
+    logger.info("Building catkin packages with catkin_tools")
+    succeeded = catkin_build(
+        "catkin-build",
+        ["--jobs", jobs, "--parallel-packages", jobs, "--continue-on-failure"],
+    )
+
+    if not succeeded:
+        # Packages that only fail when built in parallel usually succeed when
+        # built alone. Only the packages that did not build are retried. They
+        # are listed alphabetically, and catkin builds them in dependency order
+        # itself. If none were recognized in the output, e.g. because catkin
+        # failed before building anything, the whole workspace is.
+        retry_packages = sorted(not_built)
+        not_built.clear()
+        logger.warning(
+            "Retrying "
+            + (", ".join(retry_packages) or "the catkin workspace")
+            + " one package at a time"
+        )
+        succeeded = catkin_build(
+            "catkin-build-serial",
+            [
+                "--jobs",
+                "1",
+                "--parallel-packages",
+                "1",
+                *(["--no-deps", *retry_packages] if retry_packages else []),
+            ],
+        )
+
+    if package_seconds:
+        logger.info(
+            "Catkin package build times:\n"
+            + "\n".join(
+                f"    {seconds:8.1f} s  {package}"
+                for package, seconds in sorted(
+                    package_seconds.items(), key=lambda item: -item[1]
+                )
+            )
+        )
+
+    if not succeeded:
+        critical_build_failure()
 
 
+@internal.trace.traced
 def build_amrl_package(pkg_dir: Path) -> None:
     logger.info(f"Building {pkg_dir.stem}")
 
     process = subprocess.Popen(
         ["/usr/bin/make", "-j", str(len(os.sched_getaffinity(0)))],
         cwd=pkg_dir.absolute(),
+        env=_get_build_env(),
         stderr=subprocess.STDOUT,
         stdout=subprocess.PIPE,
     )
 
-    _capture_process_output(process)
+    capture_process_output(process, pkg_dir.stem)
     if process.wait() != 0:
-        _critical_build_failure()
+        critical_build_failure()
+
+
+class _MakeJobserver:
+    """A GNU make jobserver shared by concurrent make invocations.
+
+    Each token in the pipe allows one more job to run. A top-level make needs a
+    token to start, and uses it as its implicit job slot.
+    https://www.gnu.org/software/make/manual/html_node/POSIX-Jobserver.html
+    """
+
+    def __init__(self, jobs: int) -> None:
+        self.jobs = jobs
+        self.read_fd, self.write_fd = os.pipe()
+        os.write(self.write_fd, b"+" * jobs)
+
+    def __enter__(self) -> "_MakeJobserver":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    def acquire(self) -> bytes:
+        # make may set the pipe to non-blocking mode, so wait until it is
+        # readable and retry if another process took the token first.
+        while True:
+            select.select([self.read_fd], [], [])
+            try:
+                return os.read(self.read_fd, 1)
+            except BlockingIOError:
+                pass
+
+    def release(self, token: bytes) -> None:
+        os.write(self.write_fd, token)
+
+    def get_env(self) -> "dict[str, str]":
+        env = _get_build_env()
+        env["MAKEFLAGS"] = (
+            f"-j{self.jobs} --jobserver-auth={self.read_fd},{self.write_fd}"
+        )
+        return env
+
+
+# Dependencies that must be built before the package itself.
+_PACKAGE_XML_BUILD_DEPENDENCY_TAGS = [
+    "depend",
+    "build_depend",
+    "build_export_depend",
+    "buildtool_depend",
+]
+
+
+def get_package_dependencies(pkg_dir: Path) -> "tuple[str, Optional[set[str]]]":
+    """Return a package's name and the names of its build dependencies.
+
+    The dependencies are read from package.xml for catkin packages and from
+    manifest.xml for rosbuild packages. They are None if neither file exists.
+    """
+    name = pkg_dir.name
+    dependencies: "Optional[set[str]]" = None
+
+    if (pkg_dir / "package.xml").exists():
+        root = ElementTree.parse(pkg_dir / "package.xml").getroot()
+        name = (root.findtext("name") or name).strip()
+        dependencies = {
+            element.text.strip()
+            for tag in _PACKAGE_XML_BUILD_DEPENDENCY_TAGS
+            for element in root.iter(tag)
+            if element.text
+        }
+    elif (pkg_dir / "manifest.xml").exists():
+        root = ElementTree.parse(pkg_dir / "manifest.xml").getroot()
+        dependencies = {
+            element.get("package", "")
+            for element in root.iter("depend")
+            if element.get("package")
+        }
+
+    return name, dependencies
+
+
+def _get_build_order_dependencies(pkg_dirs: "list[Path]") -> "dict[Path, set[Path]]":
+    """Map each package to the given packages that must be built before it.
+
+    A package without a manifest is built after every package listed before it
+    that does not depend on it, since we cannot know what it depends on.
+    """
+    names = {}
+    declared_dependencies = {}
+    for pkg_dir in pkg_dirs:
+        name, dependencies = get_package_dependencies(pkg_dir)
+        names[name] = pkg_dir
+        declared_dependencies[pkg_dir] = dependencies
+
+    build_order_dependencies = {}
+    for index, pkg_dir in enumerate(pkg_dirs):
+        dependencies = declared_dependencies[pkg_dir]
+        if dependencies is None:
+            build_order_dependencies[pkg_dir] = {
+                earlier_pkg_dir
+                for earlier_pkg_dir in pkg_dirs[:index]
+                if pkg_dir.name not in (declared_dependencies[earlier_pkg_dir] or ())
+            }
+        else:
+            build_order_dependencies[pkg_dir] = {
+                names[name] for name in dependencies if name in names
+            }
+
+    return build_order_dependencies
+
+
+def _build_amrl_package_with_jobserver(
+    pkg_dir: Path, jobserver: _MakeJobserver, live_tail: bool
+) -> bool:
+    token = jobserver.acquire()
+    try:
+        with internal.trace.span(f"build_amrl_package {pkg_dir.stem}"):
+            logger.info(f"Building {pkg_dir.stem}")
+            t_start = time.time()
+
+            process = subprocess.Popen(
+                ["/usr/bin/make"],
+                cwd=pkg_dir.absolute(),
+                env=jobserver.get_env(),
+                pass_fds=(jobserver.read_fd, jobserver.write_fd),
+                stderr=subprocess.STDOUT,
+                stdout=subprocess.PIPE,
+            )
+
+            capture_process_output(process, pkg_dir.stem, live_tail=live_tail)
+            if process.wait() != 0:
+                logger.error(f"Failed to build {pkg_dir.stem}")
+                return False
+
+            logger.success(f"Built {pkg_dir.stem} in {time.time() - t_start:.1f} s")
+            return True
+    finally:
+        jobserver.release(token)
+
+
+@internal.trace.traced
+def build_amrl_packages(
+    pkg_dirs: "list[Path]",
+    manifest: Optional[internal.manifest.BuildManifest] = None,
+) -> None:
+    """Build rosbuild packages concurrently in dependency order.
+
+    Independent packages build at the same time, and every make invocation
+    shares one jobserver, so at most one compile job per CPU runs at a time.
+
+    With a manifest, packages are skipped if neither they, the packages they
+    depend on, nor the catkin workspace have changed since their last build.
+    """
+    build_order_dependencies = _get_build_order_dependencies(pkg_dirs)
+    env = internal.manifest.fingerprint_env(os.environ)
+    rebuild_reasons: "dict[Path, str]" = {}
+
+    def get_rebuild_reason(pkg_dir: Path) -> Optional[str]:
+        if manifest is None:
+            return "no manifest"
+
+        return manifest.get_rebuild_reason(
+            pkg_dir.stem,
+            internal.manifest.fingerprint_source_tree(pkg_dir),
+            env,
+            [internal.manifest.CATKIN_WORKSPACE]
+            + [dep.stem for dep in build_order_dependencies[pkg_dir]],
+            # The rosbuild Makefile builds in build/, which make clean removes.
+            outputs=[pkg_dir / "build"],
+        )
+
+    # Concurrent builds cannot share the live tail.
+    live_tail = len(pkg_dirs) == 1
+
+    pending = list(pkg_dirs)
+    built: "set[Path]" = set()
+    failed = False
+
+    jobs = len(os.sched_getaffinity(0))
+    with _MakeJobserver(jobs) as jobserver, concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(len(pkg_dirs), 1)
+    ) as executor:
+        running: "dict[concurrent.futures.Future[bool], Path]" = {}
+
+        while pending or running:
+            # Skipped packages may make more packages ready, so keep looking
+            # until no more packages can start.
+            while not failed:
+                ready = [
+                    pkg_dir
+                    for pkg_dir in pending
+                    if build_order_dependencies[pkg_dir] <= built
+                ]
+                if not ready:
+                    break
+
+                for pkg_dir in ready:
+                    pending.remove(pkg_dir)
+
+                    reason = get_rebuild_reason(pkg_dir)
+                    if reason is None:
+                        logger.info(f"{pkg_dir.stem} is up to date")
+                        manifest.record_skipped(pkg_dir.stem)  # type: ignore
+                        built.add(pkg_dir)
+                        continue
+                    rebuild_reasons[pkg_dir] = reason
+
+                    future = executor.submit(
+                        _build_amrl_package_with_jobserver,
+                        pkg_dir,
+                        jobserver,
+                        live_tail,
+                    )
+                    running[future] = pkg_dir
+
+            if not running:
+                break
+
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                pkg_dir = running.pop(future)
+                if future.result():
+                    built.add(pkg_dir)
+                    if manifest is not None:
+                        manifest.record_built(
+                            pkg_dir.stem,
+                            internal.manifest.fingerprint_source_tree(pkg_dir),
+                            env,
+                            rebuild_reasons[pkg_dir],
+                        )
+                else:
+                    # Let running builds finish, but do not start new ones.
+                    failed = True
+
+    if failed:
+        critical_build_failure()
+
+    if pending:
+        logger.critical(
+            "Circular dependency between "
+            + ", ".join(pkg_dir.stem for pkg_dir in pending)
+        )
+        critical_build_failure()
@@ -0,0 +1,220 @@
+"""Resolves the workspace's system dependencies with rosdep in one pass.
+
+The result is saved in the cache directory, keyed on the packages' manifests,
+the rosdep database, and the system packages installed in the image, so that
+later builds with unchanged manifests skip resolution.
+"""
+
+import hashlib
+import os
+import re
+import subprocess
+import time
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+import internal.trace
+from internal import logger
+from internal.cache import cache_dir, hash_file, load_json, save_json
+from internal.ros import capture_process_output, critical_build_failure
+
+# The system packages that are installed, which only change with the image.
+# Unlike the image ID, this is also known when a build is started from a shell
+# in the container.
+DPKG_STATUS_FILE = Path("/var/lib/dpkg/status")
+
+# rosdep update downloads the rosdep database into this directory.
+ROSDEP_SOURCES_CACHE = Path.home() / ".ros/rosdep/sources.cache"
+
+# How old the rosdep database may get before rosdep update runs again.
+ROSDEP_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Maps a resolution key to the dependencies rosdep could not satisfy.
+ROSDEP_INDEX_FILE = "rosdep_index.json"
+
+# How many resolutions to keep, e.g. for the images of several tags.
+_MAX_INDEX_ENTRIES = 16
+
+# Files that make rosdep and catkin skip a directory.
+_IGNORE_MARKERS = ["CATKIN_IGNORE", "COLCON_IGNORE", "AMENT_IGNORE"]
+
+_PACKAGE_MANIFESTS = ["package.xml", "manifest.xml"]
+
+# e.g. "apt	libgoogle-glog-dev" after "System dependencies have not been satisfied:"
+_UNSATISFIED_PATTERN = re.compile(r"^(?P<installer>\w+)\t(?P<package>\S+)$")
+
+# e.g. "spot_driver: Cannot locate rosdep definition for [spot_wrapper]"
+_UNRESOLVED_PATTERN = re.compile(
+    r"^(?P<package>\S+): Cannot locate rosdep definition for \[(?P<key>[^\]]+)\]"
+)
+
+
+def _get_cache_age() -> Optional[float]:
+    """Return how many seconds ago rosdep update last succeeded, or None if it
+    never did."""
+    try:
+        mtimes = [entry.stat().st_mtime for entry in os.scandir(ROSDEP_SOURCES_CACHE)]
+    except OSError:
+        return None
+    if not mtimes:
+        return None
+    return time.time() - max(mtimes)
+
+
+@internal.trace.traced
+def update_cache(force: bool = False) -> None:
+    """Run rosdep update if the rosdep database is missing or older than
+    ROSDEP_CACHE_TTL_SECONDS."""
+    age = _get_cache_age()
+    if not force and age is not None and age < ROSDEP_CACHE_TTL_SECONDS:
+        return
+
+    logger.info("Running rosdep update")
+
+    process = subprocess.Popen(
+        ["rosdep", "update"],
+        stderr=subprocess.STDOUT,
+        stdout=subprocess.PIPE,
+    )
+    capture_process_output(process, "rosdep-update")
+    if process.wait() != 0:
+        if age is None:
+            critical_build_failure()
+        # e.g. offline. The old database is usually still good enough.
+        logger.warning(
+            f"rosdep update failed, so using the rosdep database from "
+            f"{age / (24 * 60 * 60):.0f} days ago"
+        )
+
+
+def _find_package_manifests(path: Path) -> "list[Path]":
+    """Return the manifests of the packages under path, the way rosdep finds
+    packages: not below other packages or ignored directories."""
+    manifests = []
+    for root, dirs, files in os.walk(path):
+        if any(marker in files for marker in _IGNORE_MARKERS):
+            dirs.clear()
+            continue
+
+        found = [Path(root) / name for name in _PACKAGE_MANIFESTS if name in files]
+        if found:
+            manifests += found
+            dirs.clear()
+            continue
+
+        dirs[:] = sorted(name for name in dirs if not name.startswith("."))
+    return manifests
+
+
+def _get_resolution_key(paths: "Iterable[Path]") -> str:
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        for manifest in _find_package_manifests(path):
+            digest.update(f"{manifest}\0".encode())
+            digest.update(hash_file(manifest))
+
+    # Resolution also depends on the rosdep database, the packages that are
+    # already installed in the image, and which packages are from source.
+    try:
+        database_mtime = max(
+            entry.stat().st_mtime_ns for entry in os.scandir(ROSDEP_SOURCES_CACHE)
+        )
+    except (OSError, ValueError):
+        database_mtime = 0
+    try:
+        dpkg_status = DPKG_STATUS_FILE.stat()
+        installed_packages = f"{dpkg_status.st_mtime_ns}:{dpkg_status.st_size}"
+    except OSError:
+        installed_packages = ""
+    for value in [
+        str(database_mtime),
+        installed_packages,
+        os.environ.get("ROS_DISTRO", ""),
+        os.environ.get("ROS_PACKAGE_PATH", ""),
+    ]:
+        digest.update(f"{value}\0".encode())
+
+    return digest.hexdigest()
+
+
+def _resolve(paths: "list[Path]") -> "dict[str, list[str]]":
+    """Return the system packages that are missing and the rosdep keys that
+    could not be resolved, for every package under paths."""
+    result = subprocess.run(
+        [
+            "rosdep",
+            "check",
+            "--from-paths",
+            *map(str, paths),
+            "--ignore-src",
+            "--rosdistro",
+            os.environ.get("ROS_DISTRO", "noetic"),
+        ],
+        capture_output=True,
+        text=True,
+    )
+
+    missing = []
+    unresolved = []
+    for line in (result.stdout + result.stderr).splitlines():
+        match = _UNSATISFIED_PATTERN.match(line)
+        if match is not None:
+            missing.append(f"{match['installer']}: {match['package']}")
+            continue
+        match = _UNRESOLVED_PATTERN.match(line)
+        if match is not None:
+            unresolved.append(f"{match['package']}: {match['key']}")
+
+    if result.returncode != 0 and not missing and not unresolved:
+        logger.error("rosdep check failed:\n" + (result.stdout + result.stderr))
+        critical_build_failure()
+
+    return {"missing": sorted(set(missing)), "unresolved": sorted(set(unresolved))}
+
+
+@internal.trace.traced
+def check_dependencies(paths: "Iterable[Path]", force: bool = False) -> None:
+    """Check that the system dependencies of every package under paths are
+    installed, and log every missing one.
+
+    Packages are not installed, since the container does not run as root and
+    anything installed in it is lost when it is recreated. Missing packages
+    belong in the tag's Dockerfile.
+    """
+    paths = [path for path in paths if path.is_dir()]
+    if not paths:
+        return
+
+    update_cache(force=force)
+
+    index_path = cache_dir() / ROSDEP_INDEX_FILE
+    index: "dict[str, dict[str, Any]]" = load_json(index_path, default={})
+    key = _get_resolution_key(paths)
+
+    entry = index.get(key)
+    if entry is None or force:
+        logger.info("Resolving system dependencies with rosdep")
+        entry = {**_resolve(paths), "time": time.time()}
+        index[key] = entry
+        # Keep the most recent resolutions.
+        index = dict(
+            sorted(index.items(), key=lambda item: -item[1]["time"])[
+                :_MAX_INDEX_ENTRIES
+            ]
+        )
+        save_json(index_path, index)
+    else:
+        logger.info("System dependencies are unchanged since the last build")
+
+    if entry["unresolved"]:
+        logger.warning(
+            "rosdep has no definition for these dependencies, so they must come "
+            "from another source:\n"
+            + "\n".join(f"    {line}" for line in entry["unresolved"])
+        )
+    if entry["missing"]:
+        logger.error(
+            "These system dependencies are not installed in the image. Add them "
+            "to the tag's Dockerfile:\n"
+            + "\n".join(f"    {line}" for line in entry["missing"])
+        )
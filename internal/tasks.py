@@ -0,0 +1,135 @@
+"""Runs independent host-side steps concurrently on an asyncio event loop.
+
+Blocking steps run in worker threads. Subprocesses started with
+run_subprocess are killed if their task is cancelled.
+"""
+
+import asyncio
+import contextlib
+import dataclasses
+import subprocess
+import time
+from typing import Any, Callable, Optional
+
+import internal.trace
+from internal import logger
+
+# How often to log which tasks are still running.
+PROGRESS_INTERVAL_SECONDS = 5.0
+
+
+@dataclasses.dataclass
+class Task:
+    name: str
+    # A blocking function or a coroutine function, called without arguments
+    func: Callable[[], Any]
+    # Names of tasks that must finish before this one starts
+    dependencies: "list[str]" = dataclasses.field(default_factory=list)
+    # Whether the task writes to the terminal itself, e.g. a live tail, which
+    # progress messages would break up
+    draws_to_terminal: bool = False
+
+
+def run_tasks(tasks: "list[Task]") -> "dict[str, Any]":
+    """Run tasks concurrently, each after its dependencies, and return each
+    task's result by name.
+
+    If a task raises, the unfinished tasks are cancelled and the exception is
+    re-raised. Blocking functions that already started cannot be interrupted,
+    so they finish in the background.
+    """
+    return asyncio.run(_run_tasks(tasks))
+
+
+async def _run_tasks(tasks: "list[Task]") -> "dict[str, Any]":
+    loop = asyncio.get_running_loop()
+    start_times: "dict[str, float]" = {}
+    tasks_by_name = {task.name: task for task in tasks}
+    futures: "dict[str, asyncio.Future[Any]]" = {}
+
+    async def run(task: Task) -> Any:
+        if task.dependencies:
+            await asyncio.gather(*(futures[name] for name in task.dependencies))
+
+        start_times[task.name] = time.monotonic()
+        try:
+            if asyncio.iscoroutinefunction(task.func):
+                return await task.func()
+            return await loop.run_in_executor(None, task.func)
+        finally:
+            del start_times[task.name]
+
+    for task in tasks:
+        futures[task.name] = asyncio.ensure_future(run(task))
+    progress = asyncio.ensure_future(_log_progress(start_times, tasks_by_name))
+
+    try:
+        await asyncio.gather(*futures.values())
+    except BaseException:
+        for future in futures.values():
+            future.cancel()
+        await asyncio.gather(*futures.values(), return_exceptions=True)
+        raise
+    finally:
+        progress.cancel()
+
+    return {name: future.result() for name, future in futures.items()}
+
+
+async def _log_progress(
+    start_times: "dict[str, float]", tasks_by_name: "dict[str, Task]"
+) -> None:
+    """Log which tasks are still running, when several are and none of them
+    writes to the terminal."""
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL_SECONDS)
+        if len(start_times) > 1 and not any(
+            tasks_by_name[name].draws_to_terminal for name in start_times
+        ):
+            now = time.monotonic()
+            logger.info(
+                "Waiting for "
+                + ", ".join(
+                    f"{name} ({now - start:.0f} s)"
+                    for name, start in start_times.items()
+                )
+            )
+
+
+async def run_subprocess(
+    args: "list[str]", timeout: Optional[float] = None, **kwargs: Any
+) -> "tuple[int, bytes, bytes]":
+    """Run a command and return its exit code, stdout, and stderr.
+
+    The process is killed if it outlives timeout, which raises
+    asyncio.TimeoutError, or if the calling task is cancelled.
+    """
+    kwargs.setdefault("stdout", subprocess.PIPE)
+    kwargs.setdefault("stderr", subprocess.PIPE)
+    # asyncio never waits on the Popen it creates, so TracedPopen does not
+    # record these processes.
+    trace_start = internal.trace.now()
+    starting = asyncio.ensure_future(asyncio.create_subprocess_exec(*args, **kwargs))
+    try:
+        process = await asyncio.shield(starting)
+    except asyncio.CancelledError:
+        # The process starts anyway, so it must still be killed.
+        with contextlib.suppress(Exception):
+            process = await starting
+            process.kill()
+            await process.wait()
+        raise
+
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except BaseException:
+        with contextlib.suppress(ProcessLookupError):
+            process.kill()
+        await process.wait()
+        raise
+    finally:
+        internal.trace.add_subprocess_span(
+            args, trace_start, process.returncode, kwargs.get("cwd")  # type: ignore
+        )
+
+    return process.returncode, stdout or b"", stderr or b""  # type: ignore
@@ -0,0 +1,180 @@
+"""Opt-in timing spans in the Chrome trace event format, which
+https://ui.perfetto.dev and chrome://tracing can open.
+
+Tracing is off unless enable() is called, in which case every subprocess is
+also recorded as a span from when it starts until it is waited on.
+"""
+
+import atexit
+import contextlib
+import functools
+import os
+import shlex
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional, TypeVar
+
+from internal.cache import load_json, save_json
+
+# Set by the host to where the container should write its trace.
+TRACE_FILE_ENV_VAR = "BUILD_TRACE_FILE"
+
+_Popen = subprocess.Popen
+
+_events: "list[dict[str, Any]]" = []
+_events_lock = threading.Lock()
+_enabled = False
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def now() -> float:
+    # Wall clock time in microseconds, so that spans recorded on the host and
+    # in the container line up.
+    return time.time_ns() / 1000
+
+
+def _add_event(event: "dict[str, Any]") -> None:
+    event.setdefault("pid", os.getpid())
+    event.setdefault("tid", threading.get_native_id())
+    with _events_lock:
+        _events.append(event)
+
+
+def _add_span(
+    name: str,
+    category: str,
+    start: float,
+    tid: Optional[int] = None,
+    args: "Optional[dict[str, Any]]" = None,
+) -> None:
+    event = {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": start,
+        "dur": now() - start,
+        "args": args or {},
+    }
+    if tid is not None:
+        event["tid"] = tid
+    _add_event(event)
+
+
+class TracedPopen(_Popen):
+    """A Popen that records a span for the process's lifetime."""
+
+    def __init__(self, args: Any, *popen_args: Any, **popen_kwargs: Any) -> None:
+        self._trace_start = now()
+        self._trace_tid = threading.get_native_id()
+        self._trace_recorded = False
+        self._trace_cwd = popen_kwargs.get("cwd") or os.getcwd()
+        super().__init__(args, *popen_args, **popen_kwargs)
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        returncode = super().wait(timeout)
+        if not self._trace_recorded:
+            self._trace_recorded = True
+            add_subprocess_span(
+                self.args,
+                self._trace_start,
+                returncode,
+                self._trace_cwd,
+                tid=self._trace_tid,
+            )
+        return returncode
+
+
+def add_subprocess_span(
+    args: Any,
+    start: float,
+    returncode: int,
+    cwd: Any = None,
+    tid: Optional[int] = None,
+) -> None:
+    """Record a span for a process that ran from start until now."""
+    if not _enabled:
+        return
+
+    if isinstance(args, (str, bytes, os.PathLike)):
+        command = os.fsdecode(args)
+    else:
+        command = shlex.join(os.fsdecode(arg) for arg in args)
+    _add_span(
+        command if len(command) <= 80 else command[:77] + "...",
+        "subprocess",
+        start,
+        tid=tid,
+        args={
+            "command": command,
+            "cwd": os.fsdecode(cwd or os.getcwd()),
+            "returncode": returncode,
+        },
+    )
+
+
+def enable(process_name: str, path: Path) -> None:
+    """Record spans from now on, and write them to path at exit."""
+    global _enabled
+    if _enabled:
+        return
+    _enabled = True
+
+    # subprocess.run and friends look Popen up on the module when called.
+    subprocess.Popen = TracedPopen  # type: ignore
+    _add_event(
+        {"name": "process_name", "ph": "M", "args": {"name": process_name}}
+    )
+    atexit.register(save, path)
+
+
+def enable_from_env(process_name: str) -> None:
+    """Record spans if the host asked for a trace through the environment."""
+    path = os.environ.get(TRACE_FILE_ENV_VAR)
+    if path:
+        enable(process_name, Path(path))
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+@contextlib.contextmanager
+def span(name: str, **args: Any) -> Iterator[None]:
+    if not _enabled:
+        yield
+        return
+
+    start = now()
+    try:
+        yield
+    finally:
+        _add_span(name, "phase", start, args=args)
+
+
+def traced(func: F) -> F:
+    """Record a span named after func for each call."""
+
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        with span(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper  # type: ignore
+
+
+def merge(path: Path) -> None:
+    """Add the spans from another process's trace file, then delete it."""
+    trace = load_json(path, default={})
+    with _events_lock:
+        _events.extend(trace.get("traceEvents", []))
+    with contextlib.suppress(FileNotFoundError):
+        path.unlink()
+
+
+def save(path: Path) -> None:
+    with _events_lock:
+        events = list(_events)
+    save_json(path, {"displayTimeUnit": "ms", "traceEvents": events})
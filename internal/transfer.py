@@ -0,0 +1,328 @@
+"""Moves images between machines as a compressed stream, without writing a
+whole image archive to disk.
+
+export reads the archive from `docker save` as it is produced, leaves out the
+layers that the target already has, and compresses the rest in chunks on
+every core. import turns the stream back into an archive for `docker load` as
+it arrives.
+
+The stream starts with STREAM_MAGIC, followed by frames of a one-byte kind, a
+four-byte length, and that many bytes:
+
+- R: archive bytes as they are
+- Z: a zlib-compressed chunk of archive bytes
+- E: the end of the stream, with no bytes
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import re
+import struct
+import subprocess
+import sys
+import tarfile
+import time
+import zlib
+from typing import IO, Callable, Deque
+
+import internal.docker_api
+import internal.log_archive
+from internal import logger
+from internal.config import TransferConfig
+from internal.env import _get_container_user
+
+STREAM_MAGIC = b"ros-noetic-docker image stream 1\n"
+
+_FRAME_HEADER = struct.Struct(">cI")
+
+CHUNK_SIZE = 8 * 1024 * 1024
+COMPRESSION_LEVEL = 6
+
+# Since Docker 25, `docker save` stores each layer under its uncompressed
+# digest, which is also its diff ID.
+_LAYER_BLOB_PATTERN = re.compile(r"^blobs/sha256/(?P<digest>[0-9a-f]{64})$")
+
+
+def get_chain_ids(diff_ids: "list[str]") -> "list[str]":
+    """Return the chain ID of each layer, which identifies the layer together
+    with every layer below it."""
+    chain_ids: "list[str]" = []
+    for diff_id in diff_ids:
+        if chain_ids:
+            digest = hashlib.sha256(f"{chain_ids[-1]} {diff_id}".encode())
+            chain_ids.append(f"sha256:{digest.hexdigest()}")
+        else:
+            chain_ids.append(diff_id)
+    return chain_ids
+
+
+def list_layers() -> None:
+    """Print the chain ID of every layer of every local image, for export
+    --exclude-layers."""
+    chain_ids: "set[str]" = set()
+    images = internal.docker_api.inspect(
+        internal.docker_api.list_images(), object_type="image"
+    )
+    for image in images:
+        chain_ids.update(get_chain_ids((image.get("RootFS") or {}).get("Layers") or []))
+    for chain_id in sorted(chain_ids):
+        print(chain_id)
+
+
+def _compress(data: bytes) -> "tuple[bytes, bytes]":
+    compressed = zlib.compress(data, COMPRESSION_LEVEL)
+    # Most layers are already compressed in places, e.g. images and wheels.
+    if len(compressed) < len(data):
+        return b"Z", compressed
+    return b"R", data
+
+
+def _decompress(kind: bytes, data: bytes) -> bytes:
+    return zlib.decompress(data) if kind == b"Z" else data
+
+
+class _OrderedPipeline:
+    """Runs functions on a thread pool and writes their results in the order
+    they were submitted. zlib releases the GIL, so threads use every core.
+
+    At most a few results per thread are held in memory at once.
+    """
+
+    def __init__(self, write: "Callable[[bytes], None]", jobs: int) -> None:
+        self.write = write
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self.pending: "Deque[concurrent.futures.Future[bytes]]" = collections.deque()
+        self.max_pending = 2 * jobs
+
+    def submit(self, func: "Callable[..., bytes]", *args: object) -> None:
+        self.pending.append(self.executor.submit(func, *args))
+        while len(self.pending) > self.max_pending:
+            self.write(self.pending.popleft().result())
+
+    def flush(self) -> None:
+        while self.pending:
+            self.write(self.pending.popleft().result())
+
+    def close(self) -> None:
+        """Drop the results that were not written yet."""
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown()
+
+
+def _pack_frame(kind: bytes, data: bytes) -> bytes:
+    return _FRAME_HEADER.pack(kind, len(data)) + data
+
+
+def _read_exclude_file(path: str) -> "set[str]":
+    with open(path) as f:
+        return {line.strip() for line in f if line.strip() and not line.startswith("#")}
+
+
+def _get_skipped_layers(image_names: "list[str]", exclude_path: str) -> "set[str]":
+    """Return the diff IDs of the layers to leave out of the stream.
+
+    docker load only skips a missing layer if the target has the layer on top
+    of the same layers, so layers are matched on their chain IDs.
+    """
+    excluded = _read_exclude_file(exclude_path)
+    skipped: "set[str]" = set()
+    needed: "set[str]" = set()
+    for image in internal.docker_api.inspect(image_names, object_type="image"):
+        diff_ids = (image.get("RootFS") or {}).get("Layers") or []
+        for diff_id, chain_id in zip(diff_ids, get_chain_ids(diff_ids)):
+            (skipped if chain_id in excluded else needed).add(diff_id)
+    return skipped - needed
+
+
+def export_images(config: TransferConfig) -> None:
+    internal.log_archive.add_tags(config.tags)
+    user = _get_container_user()
+    image_names = [f"{user}-noetic:{tag}" for tag in config.tags]
+    found = internal.docker_api.inspect(image_names, object_type="image")
+    if len(found) < len(image_names):
+        found_names = {name for image in found for name in image.get("RepoTags") or []}
+        missing = [name for name in image_names if name not in found_names]
+        logger.error(f"No image {', '.join(missing)}. Build it first.")
+        sys.exit(1)
+
+    if config.file is None and sys.stdout.isatty():
+        logger.error("Redirect the output to a file or a pipe, or use --output")
+        sys.exit(1)
+
+    skipped_layers: "set[str]" = set()
+    if config.exclude_layers is not None:
+        skipped_layers = _get_skipped_layers(image_names, config.exclude_layers)
+
+    logger.info(f"Exporting {', '.join(image_names)}")
+    t_start = time.time()
+    output = open(config.file, "wb") if config.file else sys.stdout.buffer
+    process = subprocess.Popen(["docker", "save", *image_names], stdout=subprocess.PIPE)
+    assert process.stdout is not None
+
+    archive_bytes = 0
+    skipped_bytes = 0
+    sent_bytes = len(STREAM_MAGIC)
+    unskippable_layers = 0
+
+    def write(frame: bytes) -> None:
+        nonlocal sent_bytes
+        output.write(frame)
+        sent_bytes += len(frame)
+
+    output.write(STREAM_MAGIC)
+    pipeline = _OrderedPipeline(write, config.jobs)
+    stream_error = None
+    try:
+        with tarfile.open(fileobj=process.stdout, mode="r|") as tar:
+            for member in tar:
+                match = _LAYER_BLOB_PATTERN.match(member.name)
+                if match is not None and f"sha256:{match['digest']}" in skipped_layers:
+                    skipped_bytes += member.size
+                    continue
+                if member.name.endswith("/layer.tar"):
+                    # Archives from before Docker 25 do not name layers by
+                    # digest.
+                    unskippable_layers += 1
+
+                header = member.tobuf(tar.format, tar.encoding, tar.errors)
+                pipeline.submit(_pack_frame, b"R", header)
+                archive_bytes += len(header)
+                if not member.isreg():
+                    continue
+
+                f = tar.extractfile(member)
+                assert f is not None
+                remaining = member.size
+                while remaining > 0:
+                    chunk = f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise tarfile.ReadError("unexpected end of archive")
+                    remaining -= len(chunk)
+                    if remaining == 0:
+                        # Pad the member's data to a whole block.
+                        chunk += tarfile.NUL * (-member.size % tarfile.BLOCKSIZE)
+                    pipeline.submit(lambda data: _pack_frame(*_compress(data)), chunk)
+                    archive_bytes += len(chunk)
+
+        end_of_archive = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+        pipeline.submit(_pack_frame, b"R", end_of_archive)
+        archive_bytes += len(end_of_archive)
+        pipeline.flush()
+        write(_pack_frame(b"E", b""))
+        output.flush()
+    except BrokenPipeError:
+        process.kill()
+        logger.error("The importing side closed the stream")
+        sys.exit(1)
+    except tarfile.TarError as e:
+        # Usually docker save failed, and says why. Without an end frame, the
+        # importing side does not load anything.
+        stream_error = e
+        process.kill()
+    finally:
+        pipeline.close()
+        if output is not sys.stdout.buffer:
+            output.close()
+
+    returncode = process.wait()
+    # The archive is incomplete even if docker save exited successfully.
+    if stream_error is not None:
+        logger.error(f"Failed to read the archive from docker save: {stream_error}")
+        sys.exit(1)
+    if returncode != 0:
+        logger.error("docker save failed")
+        sys.exit(1)
+
+    if unskippable_layers and skipped_layers:
+        logger.warning(
+            "This version of Docker does not name layers by digest, so every "
+            "layer was exported"
+        )
+    message = (
+        f"Exported {archive_bytes / 1e6:.0f} MB as {sent_bytes / 1e6:.0f} MB in "
+        f"{time.time() - t_start:.1f} s"
+    )
+    if skipped_layers:
+        message += (
+            f", leaving out {len(skipped_layers)} layers "
+            f"({skipped_bytes / 1e6:.0f} MB) that the target has"
+        )
+    logger.success(message)
+
+
+def _read_exactly(input: IO[bytes], size: int) -> bytes:
+    data = input.read(size)
+    if len(data) < size:
+        raise EOFError
+    return data
+
+
+def import_images(config: TransferConfig) -> None:
+    if config.list_layers:
+        list_layers()
+        return
+
+    if config.file is None and sys.stdin.isatty():
+        logger.error("Pipe a stream from build.py export in, or use --input")
+        sys.exit(1)
+
+    input = open(config.file, "rb") if config.file else sys.stdin.buffer
+    try:
+        if input.read(len(STREAM_MAGIC)) != STREAM_MAGIC:
+            logger.error("The input is not a stream from build.py export")
+            sys.exit(1)
+
+        logger.info("Importing images")
+        t_start = time.time()
+        process = subprocess.Popen(["docker", "load"], stdin=subprocess.PIPE)
+        assert process.stdin is not None
+
+        pipeline = _OrderedPipeline(process.stdin.write, config.jobs)
+        complete = False
+        try:
+            while True:
+                kind, size = _FRAME_HEADER.unpack(
+                    _read_exactly(input, _FRAME_HEADER.size)
+                )
+                if kind == b"E":
+                    break
+                pipeline.submit(_decompress, kind, _read_exactly(input, size))
+            pipeline.flush()
+            process.stdin.close()
+            complete = True
+        except EOFError:
+            logger.error("The stream ended early. Was the export interrupted?")
+        except zlib.error as e:
+            logger.error(f"The stream is corrupt: {e}")
+        except BrokenPipeError:
+            # docker load exited early, and says why.
+            complete = True
+        finally:
+            pipeline.close()
+            if not complete:
+                # Do not load part of an archive.
+                process.kill()
+            process.wait()
+    finally:
+        if input is not sys.stdin.buffer:
+            input.close()
+
+    if not complete:
+        sys.exit(1)
+    if process.returncode != 0:
+        logger.error(
+            "docker load failed. If it is missing layers, export again without "
+            "--exclude-layers."
+        )
+        sys.exit(1)
+    logger.success(f"Imported images in {time.time() - t_start:.1f} s")
+
+
+def transfer_images(config: TransferConfig) -> None:
+    if config.action == "export":
+        export_images(config)
+    else:
+        import_images(config)
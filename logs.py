@@ -0,0 +1,8 @@
+#! /usr/bin/env python3
+
+from internal.config import parse_logs_args
+from internal.log_archive import show_logs
+
+
+if __name__ == "__main__":
+    show_logs(parse_logs_args())
@@ -0,0 +1,8 @@
+#! /usr/bin/env python3
+
+from internal.config import parse_sync_args
+from internal.docker import sync_packages
+
+
+if __name__ == "__main__":
+    sync_packages(parse_sync_args())
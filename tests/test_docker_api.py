@@ -0,0 +1,300 @@
+import http.server
+import io
+import fcntl
+import json
+import os
+import signal
+import socketserver
+import struct
+import tempfile
+import termios
+import threading
+import time
+import unittest
+import unittest.mock
+from pathlib import Path
+
+import internal.docker_api
+
+CONTAINER = {"Id": "c1", "Name": "/app", "State": {"Running": True}}
+IMAGE = {"Id": "sha256:i1", "RepoTags": ["alice-noetic:amrl-base"]}
+INFO = {"Runtimes": {"runc": {}}, "DefaultRuntime": "runc"}
+
+
+class _DaemonHandler(http.server.BaseHTTPRequestHandler):
+    """Answers the requests the client makes like the Docker daemon does."""
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self) -> None:
+        super().setup()
+        self.server.connection_count += 1  # type: ignore
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def send_json(self, status: int, body: object) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        self.server.requests.append(("GET", self.path))  # type: ignore
+        if self.path == "/_ping":
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"OK")
+        elif self.path == "/info":
+            self.send_json(200, INFO)
+        elif self.path == "/containers/app/json":
+            self.send_json(200, CONTAINER)
+        elif self.path == "/images/alice-noetic%3Aamrl-base/json":
+            self.send_json(200, IMAGE)
+        elif self.path == "/exec/e1/json":
+            self.send_json(200, {"ExitCode": 3})
+        else:
+            self.send_json(404, {"message": f"No such object: {self.path}"})
+
+        # Like a daemon that drops idle connections
+        if self.server.drop_connections:  # type: ignore
+            self.close_connection = True
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"null")
+        self.server.requests.append(("POST", self.path, body))  # type: ignore
+        if self.path == "/containers/app/exec":
+            self.send_json(201, {"Id": "e1"})
+        elif self.path.startswith("/containers/") and "/stop?" in self.path:
+            # Only answers once both containers are being stopped.
+            try:
+                self.server.stop_barrier.wait()  # type: ignore
+                self.send_response(204)
+            except threading.BrokenBarrierError:
+                self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path == "/containers/app/wait?condition=not-running":
+            self.server.container_stopped.wait(10)  # type: ignore
+            self.send_json(200, {"StatusCode": 0})
+        elif self.path.startswith("/exec/e1/resize?"):
+            self.server.resizes.append(self.path.split("?")[1])  # type: ignore
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path == "/exec/e1/start" and body["Tty"]:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/vnd.docker.raw-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.flush()
+            # Keeps running until the terminal was resized twice
+            deadline = time.monotonic() + 10
+            while len(self.server.resizes) < 2 and time.monotonic() < deadline:  # type: ignore
+                time.sleep(0.01)
+            self.wfile.write(b"done")
+            self.close_connection = True
+        elif self.path == "/exec/e1/start":
+            self.send_response(200)
+            self.send_header(
+                "Content-Type", "application/vnd.docker.multiplexed-stream"
+            )
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for stream_type, data in [(1, b"out\n"), (2, b"err\n"), (1, b"done\n")]:
+                self.wfile.write(struct.pack(">BxxxI", stream_type, len(data)) + data)
+            self.close_connection = True
+        else:
+            self.send_json(404, {"message": f"No such object: {self.path}"})
+
+
+class DockerAPITest(unittest.TestCase):
+    """Runs the client against a fake daemon on a unix socket."""
+
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        self.socket_path = str(self.tmp / "docker.sock")
+
+        self.daemon = socketserver.ThreadingUnixStreamServer(
+            self.socket_path, _DaemonHandler
+        )
+        self.daemon.daemon_threads = True
+        self.daemon.requests = []  # type: ignore
+        self.daemon.connection_count = 0  # type: ignore
+        self.daemon.drop_connections = False  # type: ignore
+        self.daemon.stop_barrier = threading.Barrier(2, timeout=5)  # type: ignore
+        self.daemon.container_stopped = threading.Event()  # type: ignore
+        self.daemon.resizes = []  # type: ignore
+        threading.Thread(target=self.daemon.serve_forever, daemon=True).start()
+        self.addCleanup(self.daemon.server_close)
+        self.addCleanup(self.daemon.shutdown)
+
+        environ = unittest.mock.patch.dict(
+            os.environ,
+            {
+                "DOCKER_HOST": f"unix://{self.socket_path}",
+                "DOCKER_CONFIG": str(self.tmp),
+            },
+        )
+        environ.start()
+        self.addCleanup(environ.stop)
+        os.environ.pop("DOCKER_CONTEXT", None)
+
+        internal.docker_api._client = None
+        self.addCleanup(self.reset_client)
+
+    def reset_client(self) -> None:
+        if internal.docker_api._client is not None:
+            internal.docker_api._client.close()
+        internal.docker_api._client = None
+
+    def test_info(self) -> None:
+        self.assertEqual(internal.docker_api.info(), INFO)
+
+    def test_inspect(self) -> None:
+        self.assertEqual(
+            internal.docker_api.inspect(["app", "missing", "alice-noetic:amrl-base"]),
+            [CONTAINER, IMAGE],
+        )
+        self.assertEqual(internal.docker_api.inspect(["app"], "image"), [])
+
+    def test_exec(self) -> None:
+        client = internal.docker_api.get_client()
+        assert client is not None
+        stdout = io.BytesIO()
+        stderr = io.BytesIO()
+
+        returncode = client.exec(
+            "app",
+            ["echo", "hi"],
+            env={"A": "1"},
+            workdir="/root",
+            stdout=stdout,
+            stderr=stderr,
+        )
+
+        self.assertEqual(returncode, 3)
+        self.assertEqual(stdout.getvalue(), b"out\ndone\n")
+        self.assertEqual(stderr.getvalue(), b"err\n")
+        self.assertIn(
+            (
+                "POST",
+                "/containers/app/exec",
+                {
+                    "AttachStdout": True,
+                    "AttachStderr": True,
+                    "Cmd": ["echo", "hi"],
+                    "Tty": False,
+                    "Env": ["A=1"],
+                    "WorkingDir": "/root",
+                },
+            ),
+            self.daemon.requests,  # type: ignore
+        )
+
+    def test_tty_exec_follows_terminal_size(self) -> None:
+        client = internal.docker_api.get_client()
+        assert client is not None
+        controller, terminal_fd = os.openpty()
+        self.addCleanup(os.close, controller)
+        terminal = os.fdopen(terminal_fd, "wb")
+        self.addCleanup(terminal.close)
+
+        def set_terminal_size(lines: int, columns: int) -> None:
+            fcntl.ioctl(
+                terminal_fd,
+                termios.TIOCSWINSZ,
+                struct.pack("HHHH", lines, columns, 0, 0),
+            )
+
+        def resize_after_start() -> None:
+            while not self.daemon.resizes:  # type: ignore
+                time.sleep(0.01)
+            set_terminal_size(50, 120)
+            os.kill(os.getpid(), signal.SIGWINCH)
+
+        set_terminal_size(40, 100)
+        threading.Thread(target=resize_after_start, daemon=True).start()
+
+        client.exec("app", ["bash"], tty=True, stdout=terminal)  # type: ignore
+
+        self.assertEqual(self.daemon.resizes, ["h=40&w=100", "h=50&w=120"])  # type: ignore
+        self.assertEqual(os.read(controller, 100), b"done")
+
+    def test_requests_reuse_one_connection(self) -> None:
+        for _ in range(3):
+            internal.docker_api.info()
+
+        # The ping and every request share one connection.
+        self.assertEqual(self.daemon.connection_count, 1)  # type: ignore
+
+    def test_retry_after_dropped_connection(self) -> None:
+        self.daemon.drop_connections = True  # type: ignore
+
+        for _ in range(3):
+            self.assertEqual(internal.docker_api.info(), INFO)
+
+        # Each request after the ping finds its connection closed and retries
+        # on a new one.
+        self.assertEqual(self.daemon.connection_count, 4)  # type: ignore
+
+    def test_requests_from_threads_overlap(self) -> None:
+        threads = [
+            threading.Thread(target=internal.docker_api.stop, args=(name, 0))
+            for name in ["a", "b"]
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertFalse(self.daemon.stop_barrier.broken)  # type: ignore
+
+    def test_wait_does_not_block_other_requests(self) -> None:
+        returncodes = []
+        waiter = threading.Thread(
+            target=lambda: returncodes.append(internal.docker_api.wait("app"))
+        )
+        waiter.start()
+        while ("POST", "/containers/app/wait?condition=not-running", None) not in (
+            self.daemon.requests  # type: ignore
+        ):
+            time.sleep(0.01)
+
+        self.assertEqual(internal.docker_api.info(), INFO)
+        self.assertTrue(waiter.is_alive())
+
+        self.daemon.container_stopped.set()  # type: ignore
+        waiter.join()
+        self.assertEqual(returncodes, [0])
+
+    def test_cli_fallback_for_remote_daemon(self) -> None:
+        bin_dir = self.tmp / "bin"
+        bin_dir.mkdir()
+        docker = bin_dir / "docker"
+        docker.write_text(
+            f"#! /bin/sh\necho '{json.dumps({'ServerVersion': 'cli'})}'\n"
+        )
+        docker.chmod(0o755)
+        os.environ["DOCKER_HOST"] = "tcp://127.0.0.1:2375"
+        os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+
+        self.assertIsNone(internal.docker_api.get_client())
+        self.assertEqual(internal.docker_api.info(), {"ServerVersion": "cli"})
+        self.assertEqual(self.daemon.requests, [])  # type: ignore
+
+    def test_cli_fallback_for_docker_context(self) -> None:
+        (self.tmp / "config.json").write_text(json.dumps({"currentContext": "remote"}))
+
+        self.assertIsNone(internal.docker_api.get_client())
+
+
+if __name__ == "__main__":
+    unittest.main()
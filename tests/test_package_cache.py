@@ -0,0 +1,216 @@
+import functools
+import http.server
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+import internal.package_cache
+
+REPOSITORY_ROOT = Path(__file__).parent.parent
+
+PACKAGE_SIZE = 1000
+
+
+class _MirrorHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.server.requests.append(self.path)  # type: ignore
+        super().do_GET()
+
+
+class PackageCacheTest(unittest.TestCase):
+    """Runs the proxy against a local mirror that stands in for PyPI and an apt
+    mirror."""
+
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        self.mirror_dir = self.tmp / "mirror"
+        for name in ["a", "b", "c"]:
+            path = self.mirror_dir / f"packages/{name}-1.0-py3-none-any.whl"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(name.encode() * PACKAGE_SIZE)
+        (self.mirror_dir / "debian/pool").mkdir(parents=True)
+        (self.mirror_dir / "debian/pool/d_1.0_amd64.deb").write_bytes(b"d" * 10)
+
+        self.mirror = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0),
+            functools.partial(_MirrorHandler, directory=str(self.mirror_dir)),
+        )
+        self.mirror.requests = []  # type: ignore
+        self.mirror_url = f"http://127.0.0.1:{self.mirror.server_address[1]}"
+        threading.Thread(target=self.mirror.serve_forever, daemon=True).start()
+        self.addCleanup(self.mirror.server_close)
+        self.addCleanup(self.stop_mirror)
+
+        index_page = self.mirror_dir / "simple/a/index.html"
+        index_page.parent.mkdir(parents=True)
+        index_page.write_text(
+            f'<a href="{self.mirror_url}/packages/a-1.0-py3-none-any.whl">a</a>'
+        )
+
+    def stop_mirror(self) -> None:
+        if self.mirror is not None:
+            self.mirror.shutdown()
+            self.mirror.server_close()
+            self.mirror = None
+
+    def start_proxy(self, max_size_bytes: int = 1024**3) -> None:
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "internal.package_cache",
+                "--port",
+                "0",
+                "--max-size-gb",
+                str(max_size_bytes / 1024**3),
+                "--cache-dir",
+                str(self.tmp / "cache"),
+                "--pypi-url",
+                self.mirror_url,
+                "--pypi-files-url",
+                self.mirror_url,
+                "--allow-host",
+                urllib.parse.urlsplit(self.mirror_url).netloc,
+            ],
+            cwd=REPOSITORY_ROOT,
+            env={**os.environ, "HOME": str(self.tmp)},
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+        # e.g. "Serving /tmp/cache on port 20000"
+        assert process.stdout is not None
+        self.port = int(process.stdout.readline().split()[-1])
+        self.proxy_url = f"http://127.0.0.1:{self.port}"
+
+    def get(self, url: str) -> bytes:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return response.read()  # type: ignore
+
+    def get_status(self) -> "dict[str, int]":
+        return json.loads(self.get(f"{self.proxy_url}/_status"))["counts"]  # type: ignore
+
+    def wait_for_count(self, result: str, count: int) -> None:
+        """Wait until the proxy has counted count requests as result, which it
+        does after it responds and stores the file."""
+        deadline = time.monotonic() + 10
+        while self.get_status()[result] < count:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def count_mirror_requests(self, path: str) -> int:
+        return self.mirror.requests.count(path)  # type: ignore
+
+    def test_package_file_hit_and_miss(self) -> None:
+        self.start_proxy()
+        url = f"{self.proxy_url}/pypi-files/packages/b-1.0-py3-none-any.whl"
+
+        self.assertEqual(self.get(url), b"b" * PACKAGE_SIZE)
+        self.wait_for_count("misses", 1)
+        self.assertEqual(self.get(url), b"b" * PACKAGE_SIZE)
+        self.wait_for_count("hits", 1)
+
+        self.assertEqual(
+            self.count_mirror_requests("/packages/b-1.0-py3-none-any.whl"), 1
+        )
+        self.assertEqual(self.get_status()["misses"], 1)
+
+    def test_forward_proxy(self) -> None:
+        self.start_proxy()
+        opener = urllib.request.build_opener(
+            urllib.request.ProxyHandler({"http": self.proxy_url})
+        )
+        url = f"{self.mirror_url}/debian/pool/d_1.0_amd64.deb"
+
+        for count in [1, 2]:
+            with opener.open(url, timeout=10) as response:
+                self.assertEqual(response.read(), b"d" * 10)
+            self.wait_for_count("hits" if count == 2 else "misses", 1)
+
+        self.assertEqual(self.count_mirror_requests("/debian/pool/d_1.0_amd64.deb"), 1)
+
+    def test_forward_proxy_only_to_package_mirrors(self) -> None:
+        self.start_proxy()
+        opener = urllib.request.build_opener(
+            urllib.request.ProxyHandler({"http": self.proxy_url})
+        )
+        # The same mirror, under a host name that was not allowed
+        port = self.mirror.server_address[1]  # type: ignore
+        url = f"http://localhost:{port}/debian/pool/d_1.0_amd64.deb"
+
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            opener.open(url, timeout=10)
+
+        self.assertEqual(context.exception.code, 403)
+        self.assertEqual(self.mirror.requests, [])  # type: ignore
+
+    def test_index_links_point_at_the_proxy(self) -> None:
+        self.start_proxy()
+
+        page = self.get(f"{self.proxy_url}/pypi/simple/a/").decode()
+
+        self.assertIn(
+            f"{self.proxy_url}/pypi-files/packages/a-1.0-py3-none-any.whl", page
+        )
+
+    def test_stale_index_served_offline(self) -> None:
+        self.start_proxy()
+        url = f"{self.proxy_url}/pypi/simple/a/"
+        page = self.get(url)
+
+        self.stop_mirror()
+
+        self.assertEqual(self.get(url), page)
+        self.wait_for_count("stale", 1)
+
+    def test_least_recently_used_files_are_evicted(self) -> None:
+        self.start_proxy(max_size_bytes=int(2.5 * PACKAGE_SIZE))
+        urls = {
+            name: f"{self.proxy_url}/pypi-files/packages/{name}-1.0-py3-none-any.whl"
+            for name in ["a", "b", "c"]
+        }
+
+        # Using a again makes b the least recently used file when c is added.
+        for name, result, count in [
+            ("a", "misses", 1),
+            ("b", "misses", 2),
+            ("a", "hits", 1),
+            ("c", "misses", 3),
+            ("a", "hits", 2),
+            ("b", "misses", 4),
+        ]:
+            self.get(urls[name])
+            self.wait_for_count(result, count)
+
+        self.assertEqual(
+            self.count_mirror_requests("/packages/a-1.0-py3-none-any.whl"), 1
+        )
+        self.assertEqual(
+            self.count_mirror_requests("/packages/b-1.0-py3-none-any.whl"), 2
+        )
+
+    def test_listener_uid(self) -> None:
+        self.start_proxy()
+
+        self.assertEqual(
+            internal.package_cache._get_listener_uid(self.port), os.getuid()
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()